@@ -53,7 +53,11 @@ class Analysis(object):
 
         """
         # TODO: Replace this with calls to storage API
-        self._storage = storage.NetCDFStorage(storage_filename, mode='r')
+        if storage.is_manifest(storage_filename):
+            # present the shards of a sharded run as one storage
+            self._storage = storage.ShardedStorageView(storage_filename)
+        else:
+            self._storage = storage.NetCDFStorage(storage_filename, mode='r')
         self._ncfile = self._storage._ncfile
         self.storage_filename = storage_filename
         self._environments = self.get_environments()
@@ -114,13 +118,17 @@ class Analysis(object):
         """
         w_t = {state_transition : [] for state_transition in self._state_transitions[environment]}
 
-        for iteration in range(self._n_exen_iterations[environment]):
-            logP_ncmc_trajectory = self._ncfile.groups[environment]['NCMCEngine']['protocolwork'][iteration, :]
-            state_key = self._storage.get_object(environment, "ExpandedEnsembleSampler", "state_key", iteration)
-            proposed_state_key = self._storage.get_object(environment, "ExpandedEnsembleSampler", "proposed_state_key", iteration)
+        n_iterations = self._n_exen_iterations[environment]
+        state_keys, proposed_state_keys = self._get_state_keys(environment)
+        logP_ncmc_trajectories = self._ncfile.groups[environment]['NCMCEngine']['protocolwork'][:n_iterations, :]
+        ncmc_iterations = self._get_ncmc_iterations(environment)
+        for iteration in range(n_iterations):
+            state_key, proposed_state_key = state_keys[iteration], proposed_state_keys[iteration]
             if state_key == proposed_state_key:
                 continue
-            w_t[(state_key, proposed_state_key)].append(-logP_ncmc_trajectory)
+            if not ncmc_iterations[iteration]:
+                continue
+            w_t[(state_key, proposed_state_key)].append(-logP_ncmc_trajectories[iteration])
 
         w_t_stacked = {state_transition: np.stack(work_trajectories) for state_transition, work_trajectories in w_t.items()}
 
@@ -236,12 +244,7 @@ class Analysis(object):
             # first, find the set of unique state transitions:
             state_transition_list = []
             visited_states = []
-            n_iterations = self._n_exen_iterations[environment]
-            for iteration in range(n_iterations):
-                state_key = self._storage.get_object(environment, "ExpandedEnsembleSampler", "state_key", iteration)
-                proposed_state_key = self._storage.get_object(environment, "ExpandedEnsembleSampler",
-                                                              "proposed_state_key", iteration)
-
+            for state_key, proposed_state_key in zip(*self._get_state_keys(environment)):
                 visited_states.append(state_key)
                 # if they are the same (a self-proposal) just continue
                 if state_key == proposed_state_key:
@@ -256,6 +259,46 @@ class Analysis(object):
 
         return state_transitions_dict, visited_states_dict
 
+    def _get_state_keys(self, environment):
+        """
+        Read the current and proposed chemical state keys of all ExpandedEnsembleSampler iterations of an environment.
+
+        Parameters
+        ----------
+        environment : str
+            The name of the environment
+
+        Returns
+        -------
+        state_keys : np.array of str
+            The chemical state key of every iteration
+        proposed_state_keys : np.array of str
+            The proposed chemical state key of every iteration
+        """
+        n_iterations = self._n_exen_iterations[environment]
+        state_keys = self._storage.get_keys(environment, "ExpandedEnsembleSampler", "state_key")[:n_iterations]
+        proposed_state_keys = self._storage.get_keys(environment, "ExpandedEnsembleSampler", "proposed_state_key")[:n_iterations]
+        return state_keys, proposed_state_keys
+
+    def _get_ncmc_iterations(self, environment):
+        """
+        Find the ExpandedEnsembleSampler iterations of an environment in which the geometry and NCMC stages were run.
+        They were not run if the proposal was rejected by the first (surrogate) stage of delayed acceptance, in which case logP_accept is NaN.
+
+        Parameters
+        ----------
+        environment : str
+            The name of the environment
+
+        Returns
+        -------
+        ncmc_iterations : np.array of bool
+            Whether the geometry and NCMC stages were run in each iteration
+        """
+        n_iterations = self._n_exen_iterations[environment]
+        logP_accepts = np.ma.filled(np.ma.asarray(self._ncfile.groups[environment]['ExpandedEnsembleSampler']['logP_accept'][:n_iterations], dtype=np.float64), np.nan)
+        return ~np.isnan(logP_accepts)
+
     def write_trajectory(self, environmnent, pdb_filename):
         """Write the trajectory of sampled configurations and chemical states.
 
@@ -293,20 +336,25 @@ class Analysis(object):
 
         logP_values = {state_transition: [] for state_transition in self._state_transitions[environment]}
 
+        #read the columns of the requested component (and the SAMS weights) at once
+        state_keys, proposed_state_keys = self._get_state_keys(environment)
+        ncmc_iterations = self._get_ncmc_iterations(environment)
+        logPs = self._ncfile.groups[environment]['ExpandedEnsembleSampler'][logP_accept_component][:n_iterations]
+        if subtract_sams:
+            logPs = logPs - self._ncfile.groups[environment]['ExpandedEnsembleSampler']['logP_sams_weight'][:n_iterations]
+
         #loop through the iterations and
         for iteration in range(n_iterations):
-            state_key = self._storage.get_object(environment, "ExpandedEnsembleSampler", "state_key", iteration)
-            proposed_state_key = self._storage.get_object(environment, "ExpandedEnsembleSampler", "proposed_state_key", iteration)
+            state_key, proposed_state_key = state_keys[iteration], proposed_state_keys[iteration]
 
             #if they are the same (a self-proposal) just continue
             if state_key == proposed_state_key:
                 continue
+            #if the geometry and NCMC stages were not run (NaN placeholders), there is no value
+            if not ncmc_iterations[iteration]:
+                continue
             #retreive the work value (negative logP_work) and add it to the list of work values for that transition
-            logP = self._ncfile.groups[environment]['ExpandedEnsembleSampler'][logP_accept_component][iteration]
-
-            if subtract_sams:
-                sams_weight = self._ncfile.groups[environment]['ExpandedEnsembleSampler']['logP_sams_weight'][iteration]
-                logP = logP - sams_weight
+            logP = logPs[iteration]
 
             logP_values[(state_key, proposed_state_key)].append(logP)
 
@@ -358,11 +406,8 @@ class Analysis(object):
         chemical_state_traj : list of str
             List of chemical states that were visited
          """
-        n_iterations = self._n_exen_iterations[environment]
-        chemical_state_traj = []
-        for iteration in range(n_iterations):
-            chemical_state = self._storage.get_object(environment, "ExpandedEnsembleSampler", "state_key", iteration)
-            chemical_state_traj.append(chemical_state)
+        state_keys, _ = self._get_state_keys(environment)
+        chemical_state_traj = list(state_keys)
 
         return chemical_state_traj
 
@@ -0,0 +1,156 @@
+"""
+Tail reader for monitoring a running perses simulation through its storage file.
+
+Only the iterations written since the previous refresh are read, so a refresh of a long run costs milliseconds.
+Storage written with NetCDFStorage(..., live=True) is read under its live lock, so that every refresh sees a synced file.
+"""
+import os
+import fcntl
+import logging
+import numpy as np
+import netCDF4 as netcdf
+
+_logger = logging.getLogger("analysis/tail")
+
+class StorageTail(object):
+    """
+    Incrementally load the iteration-indexed records (quantities, arrays, keys and state dicts) of a storage file that is being written.
+    """
+    def __init__(self, storage_filename, variables=None):
+        """
+        Arguments
+        ---------
+        storage_filename : str
+            name of the storage file
+        variables : list of str, optional, default=None
+            paths '/<envname>/<modname>/<varname>' of the variables to follow; if None, all the iteration-indexed variables are followed
+        """
+        self.storage_filename = storage_filename
+        self.variables = variables
+        self._values = {} # path : list of the values of all loaded iterations
+        self._file_stamp = None
+
+    def refresh(self):
+        """
+        Load the iterations written since the previous refresh.
+
+        Returns
+        -------
+        new_values : dict of str : list
+            the values of the new iterations of every followed variable path with new iterations
+            (key records are decoded to str and state dict records to dicts of str : float)
+        """
+        stat = os.stat(self.storage_filename)
+        file_stamp = (stat.st_mtime_ns, stat.st_size)
+        if file_stamp == self._file_stamp:
+            return {}
+
+        lock_filename = self.storage_filename + '.lock'
+        lock = open(lock_filename, 'r') if os.path.exists(lock_filename) else None
+        try:
+            if lock is not None:
+                fcntl.flock(lock, fcntl.LOCK_SH)
+            ncfile = netcdf.Dataset(self.storage_filename, mode = 'r')
+            try:
+                new_values = self._read_new_iterations(ncfile)
+            finally:
+                ncfile.close()
+        finally:
+            if lock is not None:
+                lock.close() # releases the lock
+        self._file_stamp = file_stamp
+        _logger.debug(f"loaded {sum(len(values) for values in new_values.values())} new records of {len(new_values)} variables")
+        return new_values
+
+    def _iteration_variables(self, ncfile):
+        """
+        the paths of the iteration-indexed variables of the environment/module groups
+        """
+        paths = []
+        for envgrp in ncfile.groups.values():
+            for modgrp in envgrp.groups.values():
+                for ncvar in modgrp.variables.values():
+                    if (len(ncvar.dimensions) > 0) and (ncvar.dimensions[0] == 'iterations'):
+                        paths.append(f"/{envgrp.name}/{modgrp.name}/{ncvar.name}")
+        return paths
+
+    def _read_new_iterations(self, ncfile):
+        """
+        read the new iterations of every followed variable
+        """
+        key_names = None
+        new_values = {}
+        for path in (self.variables if self.variables is not None else self._iteration_variables(ncfile)):
+            try:
+                ncvar = ncfile[path]
+            except (IndexError, KeyError):
+                continue # not written yet
+            values = self._values.setdefault(path, [])
+            niterations = ncvar.shape[0] # the length of the shared iterations dimension, not the number of rows written to this variable
+            if niterations <= len(values):
+                continue
+            rows = ncvar[len(values):niterations]
+            # rows after the last written row (not written yet, or skipped by the storage policy) are read again on the next refresh
+            nrows = self._count_written_rows(rows)
+            if nrows == 0:
+                continue
+            rows = rows[:nrows]
+            record_type = ncvar.getncattr('perses_record') if 'perses_record' in ncvar.ncattrs() else None
+            if (record_type is not None) and (key_names is None):
+                key_names = [str(key) for key in ncfile.variables['key_names'][:]]
+            if record_type == 'key':
+                rows = [key_names[index] if index >= 0 else None for index in np.asarray(rows, dtype = np.int64)]
+            elif record_type == 'state_dict':
+                rows = np.ma.filled(np.ma.asarray(rows, dtype = np.float64), np.nan)
+                rows = [{key_names[index] : value for (index, value) in enumerate(row) if not np.isnan(value)} for row in rows]
+            else:
+                rows = list(np.ma.filled(rows, np.nan)) if np.ma.isMaskedArray(rows) else list(rows)
+            values.extend(rows)
+            new_values[path] = rows
+        return new_values
+
+    def _count_written_rows(self, rows):
+        """
+        the number of rows up to and including the last row with a written (unmasked) value
+        """
+        if len(rows) == 0:
+            return 0
+        row_masks = np.ma.getmaskarray(rows).reshape(len(rows), -1)
+        written = np.flatnonzero(~np.all(row_masks, axis = 1)) if row_masks.shape[1] > 0 else np.arange(len(rows))
+        return int(written[-1]) + 1 if len(written) > 0 else 0
+
+    def get(self, envname, modname, varname):
+        """
+        the values of all the iterations of a variable loaded so far
+
+        Arguments
+        ---------
+        envname : str
+            the name of the environment of the variable
+        modname : str
+            the name of the module of the variable
+        varname : str
+            the name of the variable
+
+        Returns
+        -------
+        values : list
+            the value of every loaded iteration
+        """
+        return self._values.get(f"/{envname}/{modname}/{varname}", [])
+
+    def acceptance_rate(self, envname, modname = 'ExpandedEnsembleSampler'):
+        """
+        the fraction of accepted proposals of an expanded ensemble sampler at its last loaded iteration (None before the first iteration)
+        """
+        naccepted, nrejected = self.get(envname, modname, 'naccepted'), self.get(envname, modname, 'nrejected')
+        if (len(naccepted) == 0) or (len(nrejected) == 0) or (naccepted[-1] + nrejected[-1] == 0):
+            return None
+        return float(naccepted[-1]) / float(naccepted[-1] + nrejected[-1])
+
+    def logZ(self, envname, modname = 'SAMSSampler'):
+        """
+        the log normalizing constants (dict of state key : logZ) of a SAMS sampler at its last loaded iteration (None before the first iteration)
+        """
+        logZ = self.get(envname, modname, 'logZ')
+        return logZ[-1] if len(logZ) > 0 else None
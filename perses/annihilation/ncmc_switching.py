@@ -47,7 +47,8 @@ class NCMCEngine(object):
     def __init__(self, temperature=default_temperature, functions=None, nsteps=default_nsteps,
                  steps_per_propagation=default_steps_per_propagation, timestep=default_timestep,
                  constraint_tolerance=None, platform=None, write_ncmc_interval=1, measure_shadow_work=False,
-                 integrator_splitting='V R O H R V', storage=None, verbose=False, LRUCapacity=10, pressure=None, bond_softening_constant=1.0, angle_softening_constant=1.0):
+                 integrator_splitting='V R O H R V', storage=None, verbose=False, LRUCapacity=10, pressure=None, bond_softening_constant=1.0, angle_softening_constant=1.0,
+                 storage_policy=None):
         """
         This is the base class for NCMC switching between two different systems.
 
@@ -83,6 +84,9 @@ class NCMCEngine(object):
             Capacity of LRU cache for hybrid systems
         pressure : float, default None
             The pressure to use for the simulation. If None, no barostat
+        storage_policy : perses.storage.StoragePolicy, optional, default=None
+            If specified, selects the atoms, write intervals ('ncmc_configuration' for frames, 'array' for box vectors and protocol work)
+            and position precision of the stored NCMC records.
         """
         # Handle some defaults.
         if functions == None:
@@ -113,8 +117,11 @@ class NCMCEngine(object):
         self._nattempted = 0
 
         self._storage = None
+        self._storage_policy = storage_policy
         if storage is not None:
             self._storage = NetCDFStorageView(storage, modname=self.__class__.__name__)
+            if self._storage_policy is not None:
+                self._storage.write_storage_policy(self._storage_policy)
             self._save_configuration = True
         else:
             self._save_configuration = False
@@ -353,16 +360,24 @@ class NCMCEngine(object):
 
         #write out the positions of the topology
         if self._storage:
-            for frame in range(nframes):
-                self._storage.write_configuration(position_varname, trajectory[frame, :, :], topology, iteration=iteration, frame=frame, nframes=nframes)
+            if self._storage_policy is None:
+                for frame in range(nframes):
+                    self._storage.write_configuration(position_varname, trajectory[frame, :, :], topology, iteration=iteration, frame=frame, nframes=nframes)
+            elif self._storage_policy.should_write('ncmc_configuration', iteration):
+                atom_indices, subset_topology = self._storage_policy.select_atoms(topology)
+                for frame in range(nframes):
+                    self._storage.write_configuration(position_varname, trajectory[frame, atom_indices, :], subset_topology, iteration=iteration, frame=frame, nframes=nframes,
+                                                      precision=self._storage_policy.position_precision)
+
+        write_arrays = self._storage and ((self._storage_policy is None) or self._storage_policy.should_write('array', iteration))
 
         #write out the periodict box vectors:
-        if self._storage:
+        if write_arrays:
             self._storage.write_array(box_vec_varname, box_lengths_and_angles, iteration=iteration)
 
         #retrieve the protocol work and write that out too:
         protocol_work = ne_move.cumulative_work
-        if self._storage:
+        if write_arrays:
             self._storage.write_array("protocolwork", protocol_work, iteration=iteration)
 
         # Return
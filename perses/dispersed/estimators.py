@@ -0,0 +1,167 @@
+"""
+Vectorized work-based estimators for sMC and AIS.
+
+All estimators operate on cumulative work arrays of shape (..., num_particles, num_steps) (in kT), so that every lambda step
+(and, by stacking, every direction or replicate of the same shape) is evaluated at once with logsumexp reductions over the particle axis.
+"""
+import numpy as np
+import logging
+from scipy.special import logsumexp
+
+# Instantiate logger
+logging.basicConfig(level = logging.NOTSET)
+_logger = logging.getLogger("estimators")
+_logger.setLevel(logging.INFO)
+
+def _column_logsumexps(cumulative_works):
+    """
+    compute logsumexp(-w) and logsumexp(-2w) over the particle axis of every column
+    """
+    cumulative_works = np.asarray(cumulative_works, dtype = np.float64)
+    return logsumexp(-cumulative_works, axis = -2), logsumexp(-2. * cumulative_works, axis = -2)
+
+def _EXP(lse, lse2, num_particles):
+    """
+    the EXP free energy and uncertainty from the column logsumexps
+    """
+    free_energies = -(lse - np.log(num_particles))
+    #pymbar.EXP: dDeltaF = std(x) / (sqrt(N) * mean(x)) with x = exp(-w); var(x) / mean(x)**2 = N * sum(x**2) / sum(x)**2 - 1
+    relative_variances = np.clip(num_particles * np.exp(lse2 - 2. * lse) - 1., 0., None)
+    return free_energies, np.sqrt(relative_variances / num_particles)
+
+def EXP(cumulative_works):
+    """
+    compute the exponential averaging (Jarzynski) free energy and its uncertainty at every step, as pymbar.EXP does for each column
+
+    Arguments
+    ---------
+    cumulative_works : np.ndarray of shape (..., num_particles, num_steps)
+        cumulative works (in kT)
+
+    Returns
+    -------
+    free_energies : np.ndarray of shape (..., num_steps)
+        the free energy at every step
+    uncertainties : np.ndarray of shape (..., num_steps)
+        the uncertainty of the free energy at every step
+    """
+    lse, lse2 = _column_logsumexps(cumulative_works)
+    return _EXP(lse, lse2, np.shape(cumulative_works)[-2])
+
+def ESS(cumulative_works):
+    """
+    compute the normalized effective sample size of the particle weights (w_i propto exp(-cumulative work)) at every step;
+    column t is utils.ESS(cumulative_works[:, t-1], cumulative_works[:, t] - cumulative_works[:, t-1])
+
+    Arguments
+    ---------
+    cumulative_works : np.ndarray of shape (..., num_particles, num_steps)
+        cumulative works (in kT)
+
+    Returns
+    -------
+    normalized_ESS : np.ndarray of shape (..., num_steps)
+        effective sample size (divided by the number of particles) at every step
+    """
+    lse, lse2 = _column_logsumexps(cumulative_works)
+    return np.exp(2. * lse - lse2) / np.shape(cumulative_works)[-2]
+
+def CESS(cumulative_works):
+    """
+    compute the conditional effective sample size of every step with respect to the previous step;
+    column t is utils.CESS(cumulative_works[:, t], cumulative_works[:, t+1] - cumulative_works[:, t])
+
+    Arguments
+    ---------
+    cumulative_works : np.ndarray of shape (..., num_particles, num_steps)
+        cumulative works (in kT)
+
+    Returns
+    -------
+    CESS : np.ndarray of shape (..., num_steps - 1)
+        conditional effective sample size of every step after the first
+    """
+    cumulative_works = np.asarray(cumulative_works, dtype = np.float64)
+    previous_works, works = cumulative_works[..., :-1], cumulative_works[..., 1:]
+    #CESS = (sum_i p_i u_i)**2 / sum_i p_i u_i**2 with p_i propto exp(-w_i(t-1)) and u_i = exp(-(w_i(t) - w_i(t-1)))
+    return np.exp(2. * logsumexp(-works, axis = -2) - logsumexp(-previous_works, axis = -2) - logsumexp(previous_works - 2. * works, axis = -2))
+
+def survival_rates(particle_ancestries):
+    """
+    compute the fraction of the starting particles that have surviving descendants at every step (see utils.compute_survival_rate)
+
+    Arguments
+    ---------
+    particle_ancestries : np.ndarray of ints of shape (..., num_steps, num_particles)
+        the ancestor index of every particle at every step
+
+    Returns
+    -------
+    survival_rates : np.ndarray of shape (..., num_steps)
+        the survival rate at every step
+    """
+    particle_ancestries = np.sort(np.asarray(particle_ancestries), axis = -1)
+    num_unique = 1 + np.count_nonzero(np.diff(particle_ancestries, axis = -1), axis = -1)
+    return num_unique / particle_ancestries.shape[-1]
+
+class WorkEstimator():
+    """
+    Incremental version of the vectorized estimators: columns of cumulative works are appended as the lambda steps complete,
+    and only the new columns are reduced.
+    """
+    def __init__(self):
+        self.num_particles = None
+        self._lse, self._lse2, self._cess = [], [], []
+        self._last_works = None
+
+    def __len__(self):
+        """
+        the number of steps collected so far
+        """
+        return sum(len(_lse) for _lse in self._lse)
+
+    def update(self, cumulative_works):
+        """
+        Append columns of cumulative works.
+
+        Arguments
+        ---------
+        cumulative_works : np.ndarray of shape (num_particles,) or (num_particles, num_new_steps)
+            the cumulative works (in kT) of the new steps
+        """
+        cumulative_works = np.asarray(cumulative_works, dtype = np.float64)
+        if cumulative_works.ndim == 1:
+            cumulative_works = cumulative_works[:, np.newaxis]
+        if self.num_particles is None:
+            self.num_particles = cumulative_works.shape[0]
+        assert cumulative_works.shape[0] == self.num_particles, f"the number of particles ({cumulative_works.shape[0]}) does not match the number of particles of the previous steps ({self.num_particles})"
+
+        lse, lse2 = _column_logsumexps(cumulative_works)
+        self._lse.append(lse)
+        self._lse2.append(lse2)
+        if self._last_works is not None:
+            self._cess.append(CESS(np.concatenate((self._last_works[:, np.newaxis], cumulative_works), axis = 1)))
+        elif cumulative_works.shape[1] > 1:
+            self._cess.append(CESS(cumulative_works))
+        self._last_works = cumulative_works[:, -1]
+
+    @property
+    def free_energies(self):
+        """
+        the EXP free energies and their uncertainties at every step
+        """
+        return _EXP(np.concatenate(self._lse), np.concatenate(self._lse2), self.num_particles)
+
+    @property
+    def ESS(self):
+        """
+        the normalized effective sample size at every step
+        """
+        return np.exp(2. * np.concatenate(self._lse) - np.concatenate(self._lse2)) / self.num_particles
+
+    @property
+    def CESS(self):
+        """
+        the conditional effective sample size of every step after the first
+        """
+        return np.concatenate(self._cess) if len(self._cess) > 0 else np.zeros(0)
@@ -10,6 +10,8 @@ from sys import getsizeof
 import time
 from collections import namedtuple
 import random
+import contextlib
+from collections import deque
 import dask.distributed as distributed
 import tqdm
 import time
@@ -27,29 +29,41 @@ class Parallelism(object):
     The class can currently support the following generalized parallel functions:
         - cluster and client activation/deactivation and maintenance
         - scatter local data to distributed memory
+        - broadcast constant data to all workers once and deploy handles to it
         - deploy/gather a function and list arguments to distributed workers
         - deploy/gather a function with a single set of appropriate arguments to all workers
         - launch and perform operations on actors
         - block until computation is complete with 'wait' or monitor progress
+        - iterate over futures as they complete and measure worker utilization
     """
-    supported_libraries = {'dask': ['LSF']}
+    supported_libraries = {'dask': ['LSF', 'local']}
 
     def activate_client(self,
                         library = ('dask', 'LSF'),
                         num_processes = 2,
-                        timeout = 1800):
+                        timeout = 1800,
+                        threads_per_process = None,
+                        count_bytes = False):
         """
         Parameters
         ----------
         library : tuple(str, str), default ('dask', 'LSF')
             parallelism and scheduler tuple
+            the ('dask', 'local') scheduler runs the workers as long-lived processes on the local machine (dask.distributed.LocalCluster);
+            this uses every core of a single workstation and supports worker attributes and actors exactly as a batch-scheduled cluster does.
         num_processes : int or None
             number of workers to run with the new client
             if None, num_processes will be adaptive
         timeout : int
             number of seconds to wait to fulfill the workers order
+        threads_per_process : int, default None
+            number of OpenMM CPU platform threads allotted to each worker; if None, the OpenMM default is used
+        count_bytes : bool, default False
+            whether to count the (pickled) bytes that are scattered, broadcast, and deployed to the workers in self.bytes_shipped;
+            this pickles every payload a second time (dask serializes it again to ship it), so it is meant for debugging
         """
         self.library = library
+        self.count_bytes = count_bytes
         if library is not None:
             _logger.debug(f"library is not None")
             assert library[0] in list(self.supported_libraries.keys()), f"{library[0]} is not a supported parallelism. (supported parallelisms are {self.supported_libraries.keys()})"
@@ -60,6 +74,8 @@ class Parallelism(object):
             self._adapt = False
             self.num_processes = 0
             self.workers = {}
+            self.worker_counter = 0
+            self.bytes_shipped = 0
             return
 
         if library[0] == 'dask':
@@ -69,27 +85,45 @@ class Parallelism(object):
                 from dask_jobqueue import LSFCluster
                 _logger.debug(f"creating cluster...")
                 cluster = LSFCluster()
-                if num_processes is None:
-                    _logger.debug(f"adaptive cluster")
-                    self._adapt = True
+                _maximum_processes = None
+            elif library[1] == 'local':
+                _logger.debug(f"detected local scheduler")
+                _logger.debug(f"creating cluster...")
+                _env = {'OPENMM_CPU_THREADS': str(threads_per_process)} if threads_per_process is not None else {}
+                cluster = distributed.LocalCluster(n_workers = 0, threads_per_worker = 1, processes = True, env = _env)
+                _maximum_processes = os.cpu_count()
+            else:
+                raise Exception(f"{library[1]} is supported, but without client-activation functionality!")
+
+            if num_processes is None:
+                _logger.debug(f"adaptive cluster")
+                self._adapt = True
+                if _maximum_processes is None:
                     cluster.adapt(minimum = 1, interval = '1s')
                 else:
-                    _logger.debug(f"nonadaptive cluster")
-                    self._adapt = False
-                    self.num_processes = num_processes
-                    cluster.scale(self.num_processes)
-
-                _logger.debug(f"creating client with cluster")
-                self.client = distributed.Client(cluster, timeout = timeout)
-                if not self._adapt:
-                    while len(self.client.nthreads()) != self.num_processes:
-                        _logger.debug(f"waiting for worker request fulfillment...")
-                        time.sleep(5)
-                worker_threads = self.client.nthreads()
-                self.workers = {i: _worker for i, _worker in zip(range(len(worker_threads)), worker_threads.keys())}
-                _logger.debug(f"workers initialized: {self.workers}")
+                    cluster.adapt(minimum = 1, maximum = _maximum_processes, interval = '1s')
             else:
-                raise Exception(f"{library[1]} is supported, but without client-activation functionality!")
+                _logger.debug(f"nonadaptive cluster")
+                self._adapt = False
+                self.num_processes = num_processes
+                cluster.scale(self.num_processes)
+
+            _logger.debug(f"creating client with cluster")
+            self.client = distributed.Client(cluster, timeout = timeout)
+            if threads_per_process is not None:
+                #a worker plugin is applied to current workers and to every worker the cluster adds later (e.g. adaptively)
+                _logger.debug(f"setting {threads_per_process} OpenMM CPU threads per worker")
+                _register_plugin = self.client.register_plugin if hasattr(self.client, 'register_plugin') else self.client.register_worker_plugin
+                _register_plugin(OpenMMThreadsPlugin(threads_per_process), name = 'openmm-cpu-threads')
+            if not self._adapt:
+                _logger.debug(f"waiting for worker request fulfillment...")
+                self.client.wait_for_workers(self.num_processes)
+            worker_threads = self.client.nthreads()
+            self.workers = {i: _worker for i, _worker in zip(range(len(worker_threads)), worker_threads.keys())}
+            self.worker_counter = 0
+            self.bytes_shipped = 0
+            self._broadcast_keys = set()
+            _logger.debug(f"workers initialized: {self.workers}")
 
     def deactivate_client(self):
         """
@@ -103,7 +137,9 @@ class Parallelism(object):
                 _logger.debug(f"detected dask parallelism...")
                 if self.client is not None:
                     _logger.debug(f"closing client...")
-                    self.client.cluster.close()
+                    cluster = self.client.cluster
+                    self.client.close()
+                    cluster.close()
                     self.client = None
                     _logger.debug(f"client closed successfully")
                 else:
@@ -111,11 +147,12 @@ class Parallelism(object):
         else:
             _logger.warning(f"the library is NoneType.")
 
-        _attrs_to_delete = ['library', 'client', '_adapt', 'num_processes', 'workers']
+        _attrs_to_delete = ['library', 'client', '_adapt', 'num_processes', 'workers', 'worker_counter', 'bytes_shipped', '_broadcast_keys', 'count_bytes']
         assert self.client is None, f"the client is not None!"
         for _attr in _attrs_to_delete:
-            _logger.debug(f"deleting parallelism attribute {_attr}")
-            delattr(self, _attr)
+            if hasattr(self, _attr):
+                _logger.debug(f"deleting parallelism attribute {_attr}")
+                delattr(self, _attr)
 
     def scatter(self, df, workers = None):
         """
@@ -138,6 +175,8 @@ class Parallelism(object):
             return df
         else:
             if self.library[0] == 'dask':
+                if self.count_bytes:
+                    self.bytes_shipped += payload_size(df)
                 if workers is None:
                     scatter_future = self.client.scatter(df)
                     return scatter_future
@@ -147,7 +186,37 @@ class Parallelism(object):
             else:
                 raise Exception(f"the client is not NoneType but the library is not supported")
 
-    def deploy(self, func, arguments, workers = None):
+    def broadcast(self, obj):
+        """
+        wrapper to send a constant object to every worker once; the returned handle can be deployed in place of the object
+        (e.g. `[handle] * num_tasks`), so that each task carries a reference rather than a serialized copy.
+        identical objects are only shipped once per client.
+
+        Arguments
+        ---------
+        obj : object
+            any python object to be broadcast to all workers
+
+        Return
+        ------
+        handle : <generalized> future
+            broadcast future; if there is no client, this is obj itself
+        """
+        if self.client is None:
+            return obj
+        else:
+            if self.library[0] == 'dask':
+                #wrapping obj in a list keeps dask from scattering the elements of a list-like obj separately
+                handle = self.client.scatter([obj], broadcast = True, hash = True)[0]
+                if handle.key not in self._broadcast_keys:
+                    self._broadcast_keys.add(handle.key)
+                    if self.count_bytes:
+                        self.bytes_shipped += payload_size(obj) * len(self.client.nthreads())
+                return handle
+            else:
+                raise Exception(f"{self.library} is supported, but without broadcast functionality!")
+
+    def deploy(self, func, arguments, workers = None, pure = True):
         """
         wrapper to map a function and its arguments to the client for scheduling
 
@@ -159,6 +228,8 @@ class Parallelism(object):
             if None, then the default workers are all workers
         workers : list of str, default None
             worker address list
+        pure : bool, default True
+            whether identical calls may share a result; set to False to re-execute a call that is already scheduled
 
         Returns
         ---------
@@ -173,8 +244,13 @@ class Parallelism(object):
         else:
             if workers is None:
                 _workers = list(self.workers.values())
+            else:
+                _workers = workers
             if self.library[0] == 'dask':
-                futures = self.client.map(func, *arguments, workers = _workers)
+                #futures (scattered or broadcast arguments) are shipped as references; everything else is serialized into the tasks
+                if self.count_bytes:
+                    self.bytes_shipped += sum(payload_size(arg) for argument in arguments if not isinstance(argument, distributed.Future) for arg in argument if not isinstance(arg, distributed.Future))
+                futures = self.client.map(func, *arguments, workers = _workers, pure = pure)
             else:
                 raise Exception(f"{self.library} is supported, but without deployment functionality!")
 
@@ -271,6 +347,7 @@ class Parallelism(object):
         if self.client is not None:
             if self.library[0] == 'dask':
                 future = self.client.submit(_class, workers = [self.workers[self.worker_counter]], actor=True)  # Create a _class on a worker
+                self.worker_counter = (self.worker_counter + 1) % len(self.workers) #actors are placed on the workers round-robin
                 distributed.progress(future)
                 actor = future.result()                    # Get back a pointer to that object
                 return actor
@@ -298,6 +375,158 @@ class Parallelism(object):
                 raise Exception(f"{self.library} is supported, but without actor launch functionality!")
 
 
+    def as_completed(self, tagged_futures, omit_errors = False):
+        """
+        wrapper to iterate over futures in the order in which they complete; more futures can be added while iterating.
+        every (tag, future) pair is yielded once, even if several pairs share the same future (e.g. identical pure tasks)
+
+        Arguments
+        ---------
+        tagged_futures : list of tuple(object, <generalized> future)
+            (tag, future) pairs; the tag identifies the future to the caller
+        omit_errors : bool, default False
+            whether to raise errors from the workers or to yield (tag, None) for the futures that failed
+
+        Returns
+        -------
+        completed : iterator of tuple(object, object)
+            iterator of (tag, result) pairs with an `add(tagged_futures)` method
+        """
+        if self.client is None:
+            return _LocalAsCompleted(tagged_futures)
+        else:
+            if self.library[0] == 'dask':
+                return _DaskAsCompleted(tagged_futures, omit_errors = omit_errors)
+            else:
+                raise Exception(f"{self.library} is supported, but without as-completed functionality!")
+
+    def task_stream(self):
+        """
+        wrapper to record the tasks that are executed by the workers (see worker_utilization)
+
+        Returns
+        -------
+        task_stream : context manager
+            context manager whose value records the executed tasks (None if there is no client)
+        """
+        if self.client is None:
+            return contextlib.nullcontext(None)
+        else:
+            if self.library[0] == 'dask':
+                return distributed.get_task_stream(client = self.client)
+            else:
+                raise Exception(f"{self.library} is supported, but without task stream functionality!")
+
+    def worker_utilization(self, task_stream, wall_time):
+        """
+        compute the fraction of the available worker time that was spent computing tasks
+
+        Arguments
+        ---------
+        task_stream : <generalized> task stream
+            the value of the task_stream context manager
+        wall_time : float
+            the wall time (seconds) over which the tasks were recorded
+
+        Returns
+        -------
+        utilization : float or None
+            the worker utilization (between 0 and 1); None if there is no client
+        """
+        if self.client is None or task_stream is None:
+            return None
+        else:
+            if self.library[0] == 'dask':
+                busy_time = sum(startstop['stop'] - startstop['start'] for task in task_stream.data for startstop in task['startstops'] if startstop['action'] == 'compute')
+                num_workers = max(len(self.client.nthreads()), 1)
+                return busy_time / (num_workers * wall_time) if wall_time > 0. else None
+            else:
+                raise Exception(f"{self.library} is supported, but without utilization functionality!")
+
+    def queue(self, name):
+        """
+        wrapper to create a shared (first-in, first-out) queue to which workers can publish results while they are running
+
+        Arguments
+        ---------
+        name : str
+            name of the queue
+
+        Returns
+        -------
+        queue : <generalized> queue
+            queue with put(item) and get(timeout = None, batch = False) methods
+        """
+        if self.client is None:
+            return _LocalQueue(name)
+        else:
+            if self.library[0] == 'dask':
+                return distributed.Queue(name = name, client = self.client)
+            else:
+                raise Exception(f"{self.library} is supported, but without queue functionality!")
+
+    def idle_workers(self):
+        """
+        wrapper to list the workers that are not processing any tasks
+
+        Returns
+        -------
+        idle_workers : list of str
+            addresses of the idle workers (empty if there is no client)
+        """
+        if self.client is None:
+            return []
+        else:
+            if self.library[0] == 'dask':
+                return [worker for worker, tasks in self.client.processing().items() if len(tasks) == 0]
+            else:
+                raise Exception(f"{self.library} is supported, but without idle-worker functionality!")
+
+    def executing(self, futures):
+        """
+        wrapper to check which futures are executing on a worker (rather than waiting to be scheduled, or queued behind other tasks of a worker)
+
+        Arguments
+        ---------
+        futures : list of <generalized> futures
+            futures that are to be checked
+
+        Returns
+        -------
+        executing : list of bool
+            whether each future is executing (always False if there is no client, since local futures are complete)
+        """
+        if self.client is None:
+            return [False] * len(futures)
+        else:
+            if self.library[0] == 'dask':
+                executing_keys = set(key for keys in self.client.run(_executing_keys).values() for key in keys)
+                return [future.key in executing_keys for future in futures]
+            else:
+                raise Exception(f"{self.library} is supported, but without executing functionality!")
+
+    def done(self, futures):
+        """
+        wrapper to check whether futures are complete (finished or failed) without waiting for them
+
+        Arguments
+        ---------
+        futures : list of <generalized> futures
+            futures that are to be checked
+
+        Returns
+        -------
+        done : bool
+            whether all of the futures are complete (always True if there is no client)
+        """
+        if self.client is None:
+            return True
+        else:
+            if self.library[0] == 'dask':
+                return all(future.done() for future in futures)
+            else:
+                raise Exception(f"{self.library} is supported, but without done functionality!")
+
     def wait(self, futures):
         """
         wrapper to wait until futures are complete.
@@ -311,3 +540,127 @@ class Parallelism(object):
             pass
         else:
             distributed.wait(futures)
+
+def _executing_keys(dask_worker):
+    """
+    the keys of the tasks that a dask worker is executing
+    """
+    state = getattr(dask_worker, 'state', dask_worker)
+    return [getattr(task, 'key', task) for task in state.executing]
+
+class _LocalAsCompleted():
+    """
+    as-completed iterator of local (already computed) results
+    """
+    def __init__(self, tagged_futures):
+        self._queue = deque(tagged_futures)
+
+    def add(self, tagged_futures):
+        self._queue.extend(tagged_futures)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if len(self._queue) == 0:
+            raise StopIteration
+        return self._queue.popleft()
+
+class _LocalQueue():
+    """
+    local version of a shared queue; since local tasks are complete when they are deployed, getting more items than were put raises
+    """
+    def __init__(self, name):
+        self.name = name
+        self._queue = deque()
+
+    def put(self, item):
+        self._queue.append(item)
+
+    def qsize(self):
+        return len(self._queue)
+
+    def get(self, timeout = None, batch = False):
+        if batch is True:
+            num_items = len(self._queue)
+        else:
+            num_items = 1 if batch is False else batch
+        if num_items > len(self._queue):
+            raise Exception(f"{num_items} items were requested from the local queue {self.name}, but only {len(self._queue)} were put")
+        items = [self._queue.popleft() for _ in range(num_items)]
+        return items if batch is not False else items[0]
+
+class _DaskAsCompleted():
+    """
+    as-completed iterator of dask futures
+    """
+    def __init__(self, tagged_futures, omit_errors = False):
+        self._tags = {} #future key : deque of the tags of the futures with that key (identical tasks share a key)
+        self._omit_errors = omit_errors
+        self._as_completed = distributed.as_completed([], with_results = True, raise_errors = not omit_errors)
+        self.add(tagged_futures)
+
+    def add(self, tagged_futures):
+        for tag, future in tagged_futures:
+            self._tags.setdefault(future.key, deque()).append(tag)
+            self._as_completed.add(future)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        future, result = next(self._as_completed)
+        tags = self._tags[future.key]
+        tag = tags.popleft()
+        if len(tags) == 0:
+            del self._tags[future.key]
+        if future.status != 'finished':
+            #only reached if errors are omitted
+            _logger.warning(f"the future {future.key} (tag {tag}) failed with status {future.status}")
+            result = None
+        return tag, result
+
+def payload_size(obj):
+    """
+    the number of bytes of the pickled object (0 if it cannot be pickled)
+
+    Arguments
+    ---------
+    obj : object
+        any python object
+
+    Returns
+    -------
+    size : int
+        pickled size in bytes
+    """
+    try:
+        return len(pickle.dumps(obj, protocol = pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 0
+
+def set_openmm_cpu_threads(num_threads):
+    """
+    set the number of threads used by the OpenMM CPU platform in the current (worker) process
+
+    Arguments
+    ---------
+    num_threads : int
+        number of CPU threads
+    """
+    os.environ['OPENMM_CPU_THREADS'] = str(num_threads)
+    try:
+        import simtk.openmm as openmm
+        openmm.Platform.getPlatformByName('CPU').setPropertyDefaultValue('Threads', str(num_threads))
+    except Exception as e:
+        _logger.warning(f"could not set the OpenMM CPU platform threads: {e}")
+
+class OpenMMThreadsPlugin(distributed.WorkerPlugin):
+    """
+    dask worker plugin that sets the number of OpenMM CPU platform threads on every worker it is registered with
+    """
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+
+    def setup(self, worker):
+        set_openmm_cpu_threads(self.num_threads)
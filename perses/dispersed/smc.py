@@ -28,9 +28,11 @@ from perses.annihilation.lambda_protocol import LambdaProtocol
 from perses.annihilation.lambda_protocol import RelativeAlchemicalState, LambdaProtocol
 from perses.dispersed import *
 import random
+import uuid
 import pymbar
 import dask.distributed as distributed
 from perses.dispersed.parallel import Parallelism
+from perses.dispersed import estimators
 import tqdm
 import time
 from openmmtools import mcmc, utils
@@ -69,6 +71,9 @@ class SequentialMonteCarlo():
                  measure_shadow_work = False,
                  neq_integrator = 'langevin',
                  compute_endstate_correction = True,
+                 neq_work_in_context = False,
+                 neq_trajectory_chunk_size = 100,
+                 neq_trajectory_quantization = None,
                  external_parallelism = None,
                  internal_parallelism = {'library': ('dask', 'LSF'),
                                          'num_processes': 2}
@@ -106,6 +111,14 @@ class SequentialMonteCarlo():
             which integrator to use
         compute_endstate_correction : bool, default True
             whether to compute the importance weight to the alchemical endstates
+        neq_work_in_context : bool, default False
+            whether the annealing workers compute the protocol work from the potential energies of their contexts (without copying positions
+            out of the context at every lambda step) rather than from reduced potentials of sampler states
+        neq_trajectory_chunk_size : int, default 100
+            number of nonequilibrium frames (saved every ncmc_save_interval steps) a worker buffers before appending them to disk
+        neq_trajectory_quantization : str or float, default None
+            quantization of the saved nonequilibrium positions: None (float32), 'float16', or a fixed precision in nanometers
+            (see perses.dispersed.utils.NonequilibriumTrajectoryWriter)
         external_parallelism : dict('parallelism': perses.dispersed.parallel.Parallelism, 'available_workers': list(str)), default None
             an external parallelism dictionary;
             external_parallelism is used if the entire SequentialMonteCarlo class is allocated workers by an external client (i.e.
@@ -115,7 +128,9 @@ class SequentialMonteCarlo():
             dictionary of parameters to instantiate a client and run parallel computation internally.  internal parallelization is handled by default
             if None, external worker arguments have to be specified, otherwise, no parallel computation will be conducted, and annealing will be conducted locally.
             internal_parallelism is used when the SequentialMonteCarlo class is allowed to create its own Parallelism.client object to allocate workers on a
-            cluster.
+            cluster.  the 'library' may be any supported (library, scheduler) pair of perses.dispersed.parallel.Parallelism (e.g. ('dask', 'local') to use
+            every core of a single workstation); an optional 'threads_per_process' key sets the number of OpenMM CPU threads per worker, and an
+            optional 'count_bytes' key (default False) counts the bytes shipped to the workers in self.bytes_shipped (see Parallelism.activate_client).
         """
         _logger.info(f"Initializing SequentialMonteCarlo")
 
@@ -135,6 +150,7 @@ class SequentialMonteCarlo():
 
         self.measure_shadow_work = measure_shadow_work
         self.neq_integrator = neq_integrator
+        self.neq_work_in_context = neq_work_in_context
         if measure_shadow_work:
             raise Exception(f"measure_shadow_work is not currently supported.  Aborting!")
 
@@ -150,6 +166,8 @@ class SequentialMonteCarlo():
         #handle neq parameters
         self.neq_splitting_string = neq_splitting_string
         self.ncmc_save_interval = ncmc_save_interval
+        self.neq_trajectory_chunk_size = neq_trajectory_chunk_size
+        self.neq_trajectory_quantization = neq_trajectory_quantization
 
         #lambda states:
         self.lambda_endstates = {'forward': [0.0,1.0], 'reverse': [1.0, 0.0]}
@@ -176,8 +194,9 @@ class SequentialMonteCarlo():
             self.atom_selection_indices = None
 
         # instantiating equilibrium file/rp collection dicts
-        self._eq_dict = {0: [], 1: [], '0_decorrelated': None, '1_decorrelated': None, '0_reduced_potentials': [], '1_reduced_potentials': []}
-        self._eq_files_dict = {0: [], 1: []}
+        self._eq_dict = {0: [], 1: [], '0_decorrelated': None, '1_decorrelated': None, '0_reduced_potentials': [], '1_reduced_potentials': [], '0_replicas': [], '1_replicas': []}
+        self.snapshot_pools = {0: None, 1: None}
+        self._timeseries_estimators = {0: StatisticalInefficiencyEstimator(), 1: StatisticalInefficiencyEstimator()}
         self._eq_timers = {0: [], 1: []}
         self._neq_timers = {'forward': [], 'reverse': []}
 
@@ -253,7 +272,9 @@ class SequentialMonteCarlo():
             _logger.debug(f"found internal parallelism; activating client with the following parallelism parameters: {self.parallelism_parameters}")
             #we have to activate the client
             self.parallelism.activate_client(library = self.parallelism_parameters['library'],
-                                             num_processes = self.parallelism_parameters['num_processes'])
+                                             num_processes = self.parallelism_parameters['num_processes'],
+                                             threads_per_process = self.parallelism_parameters.get('threads_per_process', None),
+                                             count_bytes = self.parallelism_parameters.get('count_bytes', False))
             workers = list(self.parallelism.workers.values())
         elif self.external_parallelism:
             #the client is already active
@@ -278,7 +299,10 @@ class SequentialMonteCarlo():
                                                           self.atom_selection_indices, #arg: subset atoms
                                                           self.measure_shadow_work, #arg: measure_shadow_work
                                                           self.neq_integrator, #arg: integrator,
-                                                          self.compute_endstate_correction #arg: compute_endstate_correction
+                                                          self.compute_endstate_correction, #arg: compute_endstate_correction
+                                                          self.neq_work_in_context, #arg: work_in_context
+                                                          self.neq_trajectory_chunk_size, #arg: trajectory_chunk_size
+                                                          self.neq_trajectory_quantization #arg: trajectory_quantization
                                                          ),
                                              workers = workers) #workers
     def _deactivate_annealing_workers(self):
@@ -307,7 +331,14 @@ class SequentialMonteCarlo():
             protocols = {'forward': np.linspace(0,1, 1000), 'reverse': np.linspace(1,0,1000)},
             num_integration_steps = 1,
             return_timer = False,
-            rethermalize = False):
+            rethermalize = False,
+            checkpoint_filename = None,
+            resume_from = None,
+            asynchronous = False,
+            target_uncertainty = None,
+            min_particles = 20,
+            wave_size = None,
+            equilibration = None):
         """
         Conduct vanilla AIS (i.e. nonequilibrium switching FEP) with a given protocol (for each direction), specified annealing time per lambda, and support for rethermalization (i.e. velocity resampling)
         NOTE: AIS is NaN-safe
@@ -324,6 +355,36 @@ class SequentialMonteCarlo():
             whether to time the annealing protocol
         rethermalize : bool, default False
             whether to rethermalize velocities after proposal
+        checkpoint_filename : str, default None
+            if specified, the particles of the current wave, the random number generator states, and the results of every collected direction (of every wave) are
+            checkpointed (atomically) to this file
+        resume_from : str, default None
+            checkpoint filename from which to resume an interrupted AIS run; collected directions are not rerun
+        asynchronous : bool, default False
+            if True, particles are collected as they complete and each direction is processed (and checkpointed) as soon as all of its own particles
+            return, rather than after a barrier over both directions
+        target_uncertainty : float, default None
+            if specified, num_particles is the maximum particle budget per direction: particles are launched in waves, and no more waves are launched
+            once the uncertainty (kT) of the free energy (BAR if both directions are run, else EXP) is at most target_uncertainty.
+            the particles used versus the budget are reported in self.particle_budget
+        min_particles : int, default 20
+            minimum number of particles per direction (at most num_particles) that are collected before the target_uncertainty can stop AIS,
+            since the uncertainty estimate of a few particles is itself unreliable
+        wave_size : int, default None
+            number of particles per direction in each wave; if None, all particles are launched at once (or, with a target_uncertainty or a
+            pipelined equilibration, a tenth of them)
+        equilibration : dict, default None
+            if specified, the endstates are equilibrated while annealing (instead of before, with equilibrate): after 'burn_in' iterations, the
+            equilibrium workers publish a snapshot to a shared queue at most every 'snapshot_spacing' iterations (or every statistical inefficiency
+            of the reduced potentials, if it is larger), and every wave starts as soon as its snapshots are available.  the equilibrium runs stop
+            once num_particles snapshots are published, or after 'n_equilibration_iterations' iterations.  drawing snapshots raises if an
+            equilibrium run fails or stops before it has published them, or if no snapshot is published for 'snapshot_timeout' seconds.
+            the dict may have the following keys:
+                {'n_steps_per_equilibration': int (default 5000), 'snapshot_spacing': int (default 1), 'burn_in': int (default 10),
+                 'n_equilibration_iterations': int (default burn_in + 10 * num_particles * snapshot_spacing), 'minimize': bool (default False),
+                 'snapshot_timeout': float (default 3600)}
+            with distributed annealing, one worker per endstate is reserved for equilibrium.  the wall time saved with respect to equilibrating
+            first is estimated in self.pipeline_report
         """
         _logger.debug(f"conducting vanilla AIS")
         directions = list(protocols.keys())
@@ -332,6 +393,13 @@ class SequentialMonteCarlo():
 
         self.protocols = protocols
 
+        if equilibration is not None:
+            #the equilibrium runs must at least be long enough to publish a snapshot for every particle
+            snapshot_spacing, burn_in = equilibration.get('snapshot_spacing', 1), equilibration.get('burn_in', 10)
+            n_equilibration_iterations = equilibration.get('n_equilibration_iterations', burn_in + 10 * num_particles * snapshot_spacing)
+            if n_equilibration_iterations < burn_in + num_particles * snapshot_spacing:
+                raise Exception(f"{n_equilibration_iterations} equilibration iterations cannot publish {num_particles} snapshots after a burn-in of {burn_in} iterations with a snapshot spacing of {snapshot_spacing}")
+
         self._activate_annealing_workers()
         if self.internal_parallelism:
             workers = None
@@ -341,54 +409,141 @@ class SequentialMonteCarlo():
         remote_worker = 'remote' if self.parallelism.client is not None else self
         _logger.debug(f"\tthe remote worker is: {remote_worker}")
 
-        sMC_futures = {_direction: None for _direction in directions} # initialize futures with None objects (we only collect these once)
-        sMC_sampler_states = {_direction: np.array([self.pull_trajectory_snapshot(int(self.protocols[_direction][0])) for _ in range(num_particles)]) for _direction in directions}
-        #Note: we can also add functionality to launch jobs on-the-fly, but for now we just randomly pull equilibrium snapshots from a pre-computed equilibrium distribution
+        if equilibration is not None:
+            #equilibrate the endstates while annealing: the equilibrium workers publish snapshots to shared queues as they are produced
+            endstates = sorted(set(int(self.protocols[_direction][0]) for _direction in directions))
+            snapshot_timeout = equilibration.get('snapshot_timeout', 3600)
+            snapshot_queues = {state: self.parallelism.queue(f"snapshots_{state}_{uuid.uuid4().hex}") for state in endstates}
+            eq_tasks = self._equilibrium_tasks(endstates = endstates,
+                                               n_equilibration_iterations = n_equilibration_iterations,
+                                               n_steps_per_equilibration = equilibration.get('n_steps_per_equilibration', 5000),
+                                               minimize = equilibration.get('minimize', False),
+                                               snapshot_queues = snapshot_queues,
+                                               snapshot_spacing = snapshot_spacing,
+                                               snapshot_burn_in = burn_in,
+                                               n_snapshots = num_particles)
+            if self.parallelism.client is not None:
+                #reserve a worker per endstate for equilibrium so that annealing waves do not queue behind the equilibrium tasks
+                all_workers = list(self.parallelism.workers.values()) if workers is None else list(workers)
+                assert len(all_workers) > len(endstates), f"pipelined equilibration needs more workers ({len(all_workers)}) than endstates ({len(endstates)})"
+                eq_workers, workers = all_workers[:len(endstates)], all_workers[len(endstates):]
+            else:
+                eq_workers = None
+            start_pipeline = time.time()
+            eq_futures = self.parallelism.deploy(run_equilibrium, (self.parallelism.scatter(eq_tasks, workers = eq_workers),), workers = eq_workers)
+        else:
+            snapshot_queues = None
+
+        def _draw_snapshots(endstate, num_snapshots):
+            """
+            draw snapshots from the equilibrium snapshot pool or (if pipelined) from the snapshot queue, waiting until they are published
+            """
+            if snapshot_queues is None:
+                return self.pull_trajectory_snapshots(endstate, num_snapshots)
+            eq_future = eq_futures[endstates.index(endstate)]
+            snapshots, start_wait = [], time.time()
+            while len(snapshots) < num_snapshots:
+                if snapshot_queues[endstate].qsize() > 0:
+                    snapshots.append(snapshot_queues[endstate].get())
+                    start_wait = time.time()
+                elif self.parallelism.done([eq_future]):
+                    #a failed equilibrium run raises its error here; a finished one may have published its last snapshots since the check
+                    self.parallelism.gather_results([eq_future])
+                    if snapshot_queues[endstate].qsize() == 0:
+                        raise Exception(f"the equilibrium run of endstate {endstate} stopped before publishing the {num_snapshots - len(snapshots)} more snapshots that are needed; increase 'n_equilibration_iterations'")
+                elif snapshot_timeout is not None and time.time() - start_wait > snapshot_timeout:
+                    raise Exception(f"no snapshot of endstate {endstate} was published in {snapshot_timeout} seconds")
+                else:
+                    time.sleep(0.1)
+            return snapshots
+
+        sMC_futures = {_direction: None for _direction in directions} # initialize futures with None objects
         self.sMC_timers = {_direction: None for _direction in directions} #the timers are collected once per particle
-        sMC_cumulative_works = {_direction : None for _direction in directions} #again, theses are only collected once
+        sMC_cumulative_works = {_direction : None for _direction in directions} #the cumulative works of the collected particles (appended per wave)
         worker_retrieval = {} #this is an on-the-fly timer for each direction...
         self.particle_failures = {_direction: None for _direction in directions} #log the particle failures
         self.endstate_corrections = {_direction: None for _direction in directions} # log the endstate corrections
+        self.bytes_shipped = {_direction: [] for _direction in directions} # log the bytes shipped to the workers per wave
+        self.particles_used = {_direction: 0 for _direction in directions} #the number of particles collected in each direction
+        self.annealing_wave_times = [] #the time from the launch to the collection of every wave
 
-        for _direction in directions:
-            worker_retrieval[_direction] = time.time()
-            _logger.info(f"entering {_direction} direction to launch annealing jobs.")
-            #make iterable lists for anneal deployment
-            iterables = []
-            iterables.append([remote_worker] * num_particles) #remote_worker
-            iterables.append(list(sMC_sampler_states[_direction])) #sampler_state
-            iterables.append([self.protocols[_direction]] * num_particles) #lambdas
-            iterables.append([None]*num_particles) #noneq_trajectory_filename
-            iterables.append([num_integration_steps] * num_particles) #num_integration_steps
-            iterables.append([return_timer] * num_particles) #return timer
-            iterables.append([False] * num_particles)
-            iterables.append([rethermalize] * num_particles) #rethermalize
-            _compute_incremental_works = [True] * num_particles #only compute incremental work remotely if it is AIS
-            iterables.append(_compute_incremental_works) # whether to compute incremental works
+        if wave_size is None:
+            wave_size = num_particles if target_uncertainty is None and equilibration is None else max(num_particles // 10, 2)
+        uncertainty = None
 
-            for job in range(num_particles):
+        if resume_from is None:
+            wave_sampler_states = {} #the particles of the current wave that have not been collected
+        else:
+            _logger.info(f"resuming AIS from checkpoint {resume_from}")
+            checkpoint = read_checkpoint(resume_from)
+            assert checkpoint['method'] == 'AIS' and checkpoint['num_particles'] == num_particles and checkpoint['directions'] == directions, f"the checkpoint {resume_from} does not match this AIS run"
+            wave_sampler_states = checkpoint['wave_sampler_states']
+            sMC_cumulative_works = checkpoint['cumulative_works']
+            self.sMC_timers = checkpoint['timers']
+            self.particle_failures = checkpoint['particle_failures']
+            self.endstate_corrections = checkpoint['endstate_corrections']
+            self.bytes_shipped = checkpoint['bytes_shipped']
+            self.particles_used = checkpoint['particles_used']
+            uncertainty = checkpoint['uncertainty']
+            random.setstate(checkpoint['random_state'])
+            np.random.set_state(checkpoint['numpy_random_state'])
+
+        def _checkpoint():
+            if checkpoint_filename is not None:
+                write_checkpoint({'method': 'AIS',
+                                  'num_particles': num_particles,
+                                  'directions': directions,
+                                  'wave_sampler_states': wave_sampler_states,
+                                  'cumulative_works': sMC_cumulative_works,
+                                  'timers': self.sMC_timers,
+                                  'particle_failures': self.particle_failures,
+                                  'endstate_corrections': self.endstate_corrections,
+                                  'bytes_shipped': self.bytes_shipped,
+                                  'particles_used': self.particles_used,
+                                  'uncertainty': uncertainty,
+                                  'random_state': random.getstate(),
+                                  'numpy_random_state': np.random.get_state()}, checkpoint_filename)
+
+        def _launch(_direction):
+            """
+            deploy the annealing jobs of the current wave of a direction
+            """
+            worker_retrieval[_direction] = time.time()
+            _num_particles = len(wave_sampler_states[_direction])
+            _logger.info(f"entering {_direction} direction to launch {_num_particles} annealing jobs.")
+            #make iterable lists for anneal deployment; per-particle arguments are scattered and constants are broadcast once
+            _bytes_shipped = self.parallelism.bytes_shipped
+            noneq_trajectory_filenames = [None] * _num_particles
+            for job in range(_num_particles):
                 if self.ncmc_save_interval is not None: #check if we should make 'trajectory_filename' not None
-                    iterables[3][job] = self.neq_traj_filename[_direction] + f".iteration_{job:04}.h5"
-
+                    noneq_trajectory_filenames[job] = self.neq_traj_filename[_direction] + f".iteration_{self.particles_used[_direction] + job:04}.h5"
+
+            arguments = []
+            arguments.append([self.parallelism.broadcast(remote_worker)] * _num_particles) #remote_worker
+            arguments.append(self.parallelism.scatter(list(wave_sampler_states[_direction]))) #sampler_state
+            arguments.append([self.parallelism.broadcast(self.protocols[_direction])] * _num_particles) #lambdas
+            arguments.append(self.parallelism.scatter(noneq_trajectory_filenames)) #noneq_trajectory_filename
+            arguments.append([self.parallelism.broadcast(num_integration_steps)] * _num_particles) #num_integration_steps
+            arguments.append([self.parallelism.broadcast(return_timer)] * _num_particles) #return timer
+            arguments.append([self.parallelism.broadcast(False)] * _num_particles) #return_sampler_state
+            arguments.append([self.parallelism.broadcast(rethermalize)] * _num_particles) #rethermalize
+            arguments.append([self.parallelism.broadcast(True)] * _num_particles) #only compute incremental work remotely if it is AIS
 
-            scattered_futures = [self.parallelism.scatter(iterable) for iterable in iterables]
             sMC_futures[_direction] = self.parallelism.deploy(func = call_anneal_method,
-                                                              arguments = tuple(scattered_futures),
+                                                              arguments = tuple(arguments),
                                                               workers = workers)
-            assert len(sMC_futures[_direction]) == num_particles, f"num_particles ({num_particles}) and the length of futures ({len(sMC_futures[_direction])}) do not match"
-
-        #collect futures into one list and see progress
-        all_futures = [item for sublist in list(sMC_futures.values()) for item in sublist]
-        self.parallelism.progress(futures = all_futures)
-
-        #now we collect the finished futures
-        _collected_observables = {}
-        for _direction in directions:
-            _logger.debug(f"collecting annealing jobs in direction {_direction}...")
-            _futures = self.parallelism.gather_results(futures = sMC_futures[_direction], omit_errors = True)
+            assert len(sMC_futures[_direction]) == _num_particles, f"the number of particles ({_num_particles}) and the length of futures ({len(sMC_futures[_direction])}) do not match"
+            self.bytes_shipped[_direction].append(self.parallelism.bytes_shipped - _bytes_shipped)
+            if self.parallelism.count_bytes:
+                _logger.info(f"\tshipped {self.bytes_shipped[_direction][-1]} bytes to launch the {_direction} annealing jobs")
+
+        def _collect(_direction, _futures):
+            """
+            append the cumulative works of a direction from the results of its annealing jobs
+            """
+            _num_particles = len(wave_sampler_states[_direction])
             if remote_worker == 'remote':
-                assert len(_futures) == num_particles, f"num_particles ({num_particles}) and the length of the collected futures ({len(_futures)}) do not match.  _all_anneal_method is supposed to be safe!"
-
+                assert len(_futures) == _num_particles, f"the number of particles ({_num_particles}) and the length of the collected futures ({len(_futures)}) do not match.  _all_anneal_method is supposed to be safe!"
 
             #collect tuple results
             _incremental_works = [_iter[0] for _iter in _futures]
@@ -396,27 +551,102 @@ class SequentialMonteCarlo():
             _timers = [_iter[2] for _iter in _futures]
             _passes = [_iter[3] for _iter in _futures]
             return_endstate_corrections = [_iter[4] for _iter in _futures]
-            pass_indices = [index for index in range(num_particles) if _passes[index] == True]
             successful_incremental_works = [item for index, item in enumerate(_incremental_works) if _passes[index] == True]
-            failed_annealing_jobs = [index for index, item in enumerate(_incremental_works) if _passes[index] == False]
+            failed_annealing_jobs = [self.particles_used[_direction] + index for index, item in enumerate(_incremental_works) if _passes[index] == False]
             assert all(q is not None for q in successful_incremental_works), f"all passing annealing jobs have been filtered but are still returning NoneType objects"
             _logger.debug(f"\tfailed annealing jobs: {failed_annealing_jobs}")
-            self.particle_failures[_direction] = failed_annealing_jobs if len(failed_annealing_jobs) > 0 else None
-            self.endstate_corrections[_direction] = [item for index, item in enumerate(return_endstate_corrections) if _passes[index] == True]
+            if len(failed_annealing_jobs) > 0:
+                self.particle_failures[_direction] = (self.particle_failures[_direction] or []) + failed_annealing_jobs
+            self.endstate_corrections[_direction] = (self.endstate_corrections[_direction] or []) + [item for index, item in enumerate(return_endstate_corrections) if _passes[index] == True]
 
             #append the incremental works
-            _logger.debug(f"\tincremental works for direction {_direction}: {np.array(_incremental_works).shape}")
-            _concatenated_incremental_work = np.concatenate((np.array([np.zeros(len(successful_incremental_works))]).T, np.array(successful_incremental_works)), axis = 1)
-            sMC_cumulative_works[_direction] = np.cumsum(_concatenated_incremental_work, axis = 1)
-            _logger.debug(f"\tsMC cumulative works for direction {_direction}: {sMC_cumulative_works[_direction]}")
-            assert np.std(sMC_cumulative_works[_direction][:,0]) <= np.std(sMC_cumulative_works[_direction][:,-1]), f"the variance of the particle weights is not increasing..."
-
+            _logger.debug(f"\tincremental works for direction {_direction}: {np.array(successful_incremental_works).shape}")
+            if len(successful_incremental_works) > 0:
+                _concatenated_incremental_work = np.concatenate((np.array([np.zeros(len(successful_incremental_works))]).T, np.array(successful_incremental_works)), axis = 1)
+                _cumulative_works = np.cumsum(_concatenated_incremental_work, axis = 1)
+                sMC_cumulative_works[_direction] = _cumulative_works if sMC_cumulative_works[_direction] is None else np.concatenate((sMC_cumulative_works[_direction], _cumulative_works))
+                _logger.debug(f"\tsMC cumulative works for direction {_direction}: {sMC_cumulative_works[_direction]}")
+                assert np.std(sMC_cumulative_works[_direction][:,0]) <= np.std(sMC_cumulative_works[_direction][:,-1]), f"the variance of the particle weights is not increasing..."
 
             #append the _timers
-            self.sMC_timers[_direction] = _timers if return_timer else None
+            if return_timer:
+                self.sMC_timers[_direction] = (self.sMC_timers[_direction] or []) + _timers
 
             print(f"\t{_direction} retrieval time: {time.time() - worker_retrieval[_direction]}")
 
+            self.particles_used[_direction] += _num_particles
+            del wave_sampler_states[_direction]
+            _checkpoint()
+
+        with self.parallelism.task_stream() as task_stream:
+            start_annealing = time.time()
+            while True:
+                if len(wave_sampler_states) == 0:
+                    #decide whether to launch another wave
+                    if target_uncertainty is not None and uncertainty is not None and uncertainty <= target_uncertainty and all(self.particles_used[_direction] >= min(min_particles, num_particles) for _direction in directions):
+                        _logger.info(f"the free energy uncertainty ({uncertainty}) is below the target ({target_uncertainty}); terminating.")
+                        break
+                    if all(self.particles_used[_direction] >= num_particles for _direction in directions):
+                        break
+                    #Note: we can also add functionality to launch jobs on-the-fly, but for now we just randomly pull equilibrium snapshots from a pre-computed equilibrium distribution
+                    wave_sampler_states = {_direction: _draw_snapshots(int(self.protocols[_direction][0]), min(wave_size, num_particles - self.particles_used[_direction])) for _direction in directions if self.particles_used[_direction] < num_particles}
+                    _checkpoint()
+
+                start_wave = time.time()
+                wave_directions = [_direction for _direction in directions if _direction in wave_sampler_states]
+                for _direction in wave_directions:
+                    _launch(_direction)
+
+                if not asynchronous:
+                    #collect futures into one list and see progress
+                    all_futures = [item for _direction in wave_directions for item in sMC_futures[_direction]]
+                    self.parallelism.progress(futures = all_futures)
+
+                    #now we collect the finished futures
+                    for _direction in wave_directions:
+                        _logger.debug(f"collecting annealing jobs in direction {_direction}...")
+                        _collect(_direction, self.parallelism.gather_results(futures = sMC_futures[_direction], omit_errors = True))
+                else:
+                    #process each direction as soon as all of its particles are collected
+                    _results = {_direction: [None] * len(sMC_futures[_direction]) for _direction in wave_directions}
+                    _num_collected = {_direction: 0 for _direction in wave_directions}
+                    completed = self.parallelism.as_completed([((_direction, index), future) for _direction in wave_directions for index, future in enumerate(sMC_futures[_direction])], omit_errors = True)
+                    for (_direction, index), result in completed:
+                        #a job that raised on its worker is collected as a failed annealing job
+                        _results[_direction][index] = result if result is not None else (None, None, None, False, None)
+                        _num_collected[_direction] += 1
+                        if _num_collected[_direction] == len(_results[_direction]):
+                            _logger.debug(f"collected all annealing jobs in direction {_direction}")
+                            _collect(_direction, _results[_direction])
+
+                self.annealing_wave_times.append(time.time() - start_wave)
+                uncertainty = self.compute_AIS_uncertainty(sMC_cumulative_works)
+                _logger.info(f"particles used: {self.particles_used}; free energy uncertainty: {uncertainty}")
+            annealing_time = time.time() - start_annealing
+
+            if equilibration is not None:
+                eq_results = self.parallelism.gather_results(eq_futures)
+                pipelined_wall_time = time.time() - start_pipeline
+                self._collect_equilibrium(endstates = endstates, eq_results = eq_results)
+                #equilibrating first would have taken the equilibrium time followed by the annealing time of every wave
+                serial_wall_time = max(eq_result.outputs['wall_time'] for eq_result in eq_results) + sum(self.annealing_wave_times)
+                self.pipeline_report = {'particles_used': dict(self.particles_used),
+                                        'equilibration_time': max(eq_result.outputs['wall_time'] for eq_result in eq_results),
+                                        'annealing_time': sum(self.annealing_wave_times),
+                                        'pipelined_wall_time': pipelined_wall_time,
+                                        'serial_wall_time_estimate': serial_wall_time,
+                                        'wall_time_reduction': serial_wall_time - pipelined_wall_time}
+                _logger.info(f"pipelined equilibration and annealing: {self.pipeline_report}")
+
+        self.worker_utilization = self.parallelism.worker_utilization(task_stream, annealing_time)
+        _logger.info(f"annealing took {annealing_time} seconds; worker utilization: {self.worker_utilization}")
+        self.particle_budget = {'particles_used': dict(self.particles_used),
+                                'max_particles': num_particles,
+                                'fraction_used': {_direction: self.particles_used[_direction] / num_particles for _direction in directions},
+                                'uncertainty': uncertainty,
+                                'target_uncertainty': target_uncertainty}
+        _logger.info(f"particle budget: {self.particle_budget}")
+
         _logger.debug(f"deactivating annealing workers...")
         self._deactivate_annealing_workers()
         self.compute_sMC_free_energy(sMC_cumulative_works)
@@ -432,7 +662,14 @@ class SequentialMonteCarlo():
             directions = ['forward','reverse'],
             num_integration_steps = 1,
             return_timer = False,
-            rethermalize = False):
+            rethermalize = False,
+            checkpoint_interval = 1,
+            checkpoint_filename = None,
+            resume_from = None,
+            asynchronous = False,
+            particle_chunk_size = 1,
+            speculation = True,
+            max_restarts = 3):
         """
         Conduct SequentialMonteCarlo sampling with a trailblazed protocol.  Resampling is supported.
 
@@ -458,6 +695,25 @@ class SequentialMonteCarlo():
             whether to time the annealing protocol
         rethermalize : bool, default False
             whether to rethermalize velocities after proposal
+        checkpoint_interval : int, default 1
+            number of lambda steps between checkpoints
+        checkpoint_filename : str, default None
+            if specified, the particles (sampler states, cumulative works, ancestries), the lambda history, and the random number generator states
+            are checkpointed (atomically) to this file every checkpoint_interval lambda steps.  with asynchronous annealing, a direction whose
+            lambda step is in flight is checkpointed as it was before that step, which is rerun on resume
+        resume_from : str, default None
+            checkpoint filename from which to resume an interrupted sMC run at its last checkpointed lambda step
+        asynchronous : bool, default False
+            if True, the forward and reverse directions are driven independently: a direction resamples, increments lambda, and relaunches
+            as soon as all of its own particles are collected, rather than waiting on the other direction (the per-direction resampling barrier is kept)
+        particle_chunk_size : int or 'auto', default 1
+            number of particles annealed in a single task; if 'auto', the chunk size is tuned from the measured annealing time and scheduling overhead
+            (see perses.dispersed.utils.ParticleChunker).  the effective per-particle overhead of every step is logged in self.particle_overheads
+        speculation : bool, default True
+            whether to speculatively re-execute straggling annealing jobs on idle workers (see perses.dispersed.utils.AnnealingSupervisor)
+        max_restarts : int, default 3
+            number of times a failed particle is restarted from its last good configuration (with freshly drawn velocities) before the run is aborted.
+            restarts, speculative re-executions, and errors are logged in self.supervision_events
         """
         _logger.debug(f"conducting generalized sMC...")
 
@@ -486,11 +742,13 @@ class SequentialMonteCarlo():
         #create end-to-ends
         _logger.debug(f"conducting end-to-end builds...")
         if 'forward' in directions:
-            assert protocols['forward'][0] == 0.0 and protocols['forward'][-1] == 1.0, f"the forward protocol must start at 0.0 and end at 1.0"
+            if protocols is not None:
+                assert protocols['forward'][0] == 0.0 and protocols['forward'][-1] == 1.0, f"the forward protocol must start at 0.0 and end at 1.0"
             starting_lines['forward'] = 0.0
             finish_lines['forward'] = 1.0
         if 'reverse' in directions:
-            assert protocols['reverse'][0] == 1.0 and protocols['reverse'][-1] == 0.0, f"the reverse protocol must start at 1.0 and end at 0.0"
+            if protocols is not None:
+                assert protocols['reverse'][0] == 1.0 and protocols['reverse'][-1] == 0.0, f"the reverse protocol must start at 1.0 and end at 0.0"
             starting_lines['reverse'] = 1.0
             finish_lines['reverse'] = 0.0
 
@@ -524,7 +782,6 @@ class SequentialMonteCarlo():
         sMC_futures = {_direction: None for _direction in directions}
         _logger.debug(f"\tsMC_futures: {sMC_futures}")
 
-        sMC_sampler_states = {_direction: np.array([self.pull_trajectory_snapshot(int(self.protocols[_direction][0])) for _ in range(num_particles)]) for _direction in directions}
         sMC_sampler_states = {_direction: None for _direction in directions}
         _logger.debug(f"\tsMC_sampler_states: {sMC_sampler_states}")
 
@@ -532,190 +789,353 @@ class SequentialMonteCarlo():
         _logger.debug(f"sMC_timers: {sMC_timers}")
 
         sMC_incremental_works = {_direction: None for _direction in directions}
-        _logger.debug(f"\tsMC_incremental_works: {sMC_cumulative_works}")
+        _logger.debug(f"\tsMC_incremental_works: {sMC_incremental_works}")
 
 
         sMC_cumulative_works = {_direction : [np.zeros(num_particles)] for _direction in directions}
         _logger.debug(f"\tsMC_cumulative_works: {sMC_cumulative_works}")
 
-        sMC_observables = {_direction : [] for _direction in directions}
+        sMC_observables = {_direction : [1.] for _direction in directions} #the initial (equilibrium) particles are unweighted
         _logger.debug(f"\tsMC_observables: {sMC_observables}")
 
         sMC_particle_ancestries = {_direction : [np.arange(num_particles)] for _direction in directions}
         _logger.debug(f"\tsMC_particle_ancestries: {sMC_particle_ancestries}")
 
+        self.bytes_shipped = {_direction: [] for _direction in directions} # log the bytes shipped to the workers per lambda step
+
+        #chunk particles into tasks to amortize the scheduling overhead
+        chunker = ParticleChunker(num_particles = num_particles,
+                                  num_workers = len(workers) if workers is not None else len(self.parallelism.workers),
+                                  chunk_size = particle_chunk_size)
+        sMC_chunks = {_direction: None for _direction in directions} #the particle indices of each deployed chunk
+
+        #supervise the annealing jobs to restart failed particles and re-execute stragglers
+        supervisor = AnnealingSupervisor(parallelism = self.parallelism,
+                                         speculation = speculation,
+                                         max_restarts = max_restarts)
+
         worker_retrieval = {}
         _lambdas = {}
 
         #now we can launch annealing jobs and manage them on-the-fly
-        current_lambdas = starting_lines
+        current_lambdas = copy.deepcopy(starting_lines)
+        direction_iterations = {_direction: 0 for _direction in directions} #the number of completed lambda steps of each direction
         iteration_number = 0
+        launch_order = list(directions) #the order in which the directions are (re)launched
+
+        if resume_from is not None:
+            _logger.info(f"resuming sMC from checkpoint {resume_from}")
+            checkpoint = read_checkpoint(resume_from)
+            assert checkpoint['method'] == 'sMC' and checkpoint['num_particles'] == num_particles and checkpoint['directions'] == directions, f"the checkpoint {resume_from} does not match this sMC run"
+            iteration_number = checkpoint['iteration_number']
+            direction_iterations = checkpoint['direction_iterations']
+            current_lambdas = checkpoint['current_lambdas']
+            self.protocols = checkpoint['protocols']
+            sMC_sampler_states = checkpoint['sampler_states']
+            sMC_incremental_works = checkpoint['incremental_works']
+            sMC_cumulative_works = checkpoint['cumulative_works']
+            sMC_observables = checkpoint['observables']
+            sMC_particle_ancestries = checkpoint['particle_ancestries']
+            sMC_timers = checkpoint['timers']
+            self.bytes_shipped = checkpoint['bytes_shipped']
+            chunker.chunk_size = checkpoint['particle_chunk_size']
+            chunker.particle_overheads = checkpoint['particle_overheads']
+            random.setstate(checkpoint['random_state'])
+            np.random.set_state(checkpoint['numpy_random_state'])
+            launch_order = checkpoint['launch_order']
+            _logger.info(f"\tresuming at iteration {iteration_number}; current_lambdas are {current_lambdas}")
+
+        def _sample(_direction):
+            """
+            sample (first lambda step) or resample the particles of a direction
+            """
+            if direction_iterations[_direction] == 0: #this is the first iteration and we have to pull sampler states unbiasedly
+                sMC_sampler_states.update({_direction: self.pull_trajectory_snapshots(int(starting_lines[_direction]), num_particles)})
+            elif _resample:
+                _logger.debug(f"\tattempting to resample particles...")
+                #Note: the cumulative works we pull for resampling are not the last cumulative works, but the second to last.
+                    #the last cumulative works are the penultimate cumulative works plus the incremental works;
+                    #however, often, the resampling criteria (if conditional, require the separation of cumulative and incremental works)
+                    #implicitly, self._resample will compute the ultimate cumulative works
+                normalized_observable_value, resampled_works, resampled_indices, resample_bool = self._resample(incremental_works = sMC_incremental_works[_direction],
+                                                                                             cumulative_works = sMC_cumulative_works[_direction][-2],
+                                                                                             observable = resample['criterion'],
+                                                                                             resampling_method = resample['method'],
+                                                                                             resample_observable_threshold = resample['threshold'])
+                if resample_bool:
+                    _logger.debug(f"\tresample is True")
+                    sMC_observables[_direction][-1] = normalized_observable_value #update the previous observables with the resampled observable
+                    sMC_cumulative_works[_direction][-1] = resampled_works #update the ultimate cumulative work
+
+                    #we need a deepcopy to prevent annealing over the same sampler state in a single iteration with local annealing
+                    new_sampler_states = np.array([copy.deepcopy(sMC_sampler_states[_direction][i]) for i in resampled_indices])
+                    sMC_sampler_states.update({_direction: new_sampler_states})
+                else:
+                    #we don't need to update the ultimate observables, cumulative works, or sampler_states
+                    pass
+
+                #however, we do need to update the particle ancestries...
+                new_particle_ancestries = np.array([sMC_particle_ancestries[_direction][-1][i] for i in resampled_indices])
+                sMC_particle_ancestries[_direction].append(new_particle_ancestries)
+            else: #we are not resampling
+                #the sampler states are updated by gathering the workers' sampler states
+                #the observables are calculated in the trailblaze attempt pass
+                #the cumulative works are unchanged
+                #we do not return particle ancestries if no resampling is conducted
+                _logger.debug(f"not resampling.  omitting sMC updates")
+                pass
+
+        def _increment_lambda(_direction):
+            """
+            trailblaze (or read from the protocol) the next lambda of a direction and compute the incremental works locally
+            """
+            if _trailblaze:
+                _logger.debug(f"\ttrailblazing lambdas in {_direction} direction")
+                #gather sampler states and cumulative works in a concurrent manner (i.e. flatten them)
+                sampler_states = sMC_sampler_states[_direction]
+                cumulative_works = sMC_cumulative_works[_direction][-1]
+                if direction_iterations[_direction] == 0:
+                    initial_guess = None
+                else:
+                    initial_guess = min([2 * self.protocols[_direction][-1] - self.protocols[_direction][-2], 1.0]) if _direction == 'forward' else max([2 * self.protocols[_direction][-1] - self.protocols[_direction][-2], 0.0])
+
+                _new_lambda, normalized_observable, incremental_works = self.binary_search(sampler_states = sampler_states,
+                                                                                           cumulative_works = cumulative_works,
+                                                                                           start_val = current_lambdas[_direction],
+                                                                                           end_val = finish_lines[_direction],
+                                                                                           observable = self.supported_observables[trailblaze['criterion']],
+                                                                                           observable_threshold = trailblaze['threshold'] * sMC_observables[_direction][-1],
+                                                                                           initial_guess = initial_guess)
+                sMC_incremental_works.update({_direction: incremental_works})
+                _logger.info(f"\t\tlambda increments: {current_lambdas[_direction]} to {_new_lambda}.")
+                _logger.info(f"\t\tnormalized observable: {normalized_observable}.  Observable threshold is {trailblaze['threshold'] * sMC_observables[_direction][-1]}")
+                self.protocols[_direction].append(_new_lambda)
+                sMC_observables[_direction].append(normalized_observable)
+                _lambdas.update({_direction: np.array([current_lambdas[_direction], _new_lambda])})
+                #the current lambdas will be updated once the annealing step is collected
+            else:
+                start_val, end_val = protocols[_direction][direction_iterations[_direction]], protocols[_direction][direction_iterations[_direction] + 1]
+                _logger.debug(f"\tnot trailblazing; annealing lambda from {start_val} to {end_val}")
+                self.thermodynamic_state.set_alchemical_parameters(start_val, LambdaProtocol(functions = self.lambda_protocol))
+                current_rps = np.array([compute_reduced_potential(self.thermodynamic_state, sampler_state) for sampler_state in sMC_sampler_states[_direction]])
+                #if we are not trailblazing, then the local observable is computed from the resampling observable (or the ESS if we are not resampling)
+                _observable = self.supported_observables[resample['criterion']] if _resample else self.supported_observables['ESS']
+                normalized_observable, incremental_works = self.compute_lambda_increment(end_val, sMC_sampler_states[_direction], _observable, current_rps, sMC_cumulative_works[_direction][-1])
+                sMC_incremental_works.update({_direction: incremental_works})
+                self.protocols[_direction].append(end_val)
+                sMC_observables[_direction].append(normalized_observable)
+                _lambdas.update({_direction: np.array([start_val, end_val])})
+                #the current lambdas will be updated once the annealing step is collected
+
+        def _launch(_direction):
+            """
+            deploy the annealing jobs of a direction
+            """
+            worker_retrieval[_direction] = time.time()
+            _logger.info(f"\t\tentering {_direction} direction to launch annealing jobs.")
+
+            _logger.info(f"\t\tthe current lambdas for annealing are {_lambdas[_direction]}")
+
+            #make construct argument lists for distributed annealing; per-particle arguments are scattered and constants are broadcast once
+            _bytes_shipped = self.parallelism.bytes_shipped
+            noneq_trajectory_filenames = [None] * num_particles
+            for job in range(num_particles):
+                if self.ncmc_save_interval is not None: #check if we should make 'trajectory_filename' not None
+                    noneq_trajectory_filenames[job] = self.neq_traj_filename[_direction] + f".iteration_{job:04}.h5"
+
+            #each chunk of particles is scattered as a single object so that it is resident on a single worker
+            sMC_chunks[_direction] = chunker.chunk(list(range(num_particles)))
+            num_chunks = len(sMC_chunks[_direction])
+            _logger.debug(f"\t\tdeploying {num_particles} particles in {num_chunks} chunks of at most {chunker.chunk_size}")
+
+            arguments = []
+            arguments.append([self.parallelism.broadcast(remote_worker)] * num_chunks) #remote_worker
+            arguments.append(self.parallelism.scatter([[sMC_sampler_states[_direction][i] for i in chunk] for chunk in sMC_chunks[_direction]])) #sampler_states
+            arguments.append([self.parallelism.broadcast(_lambdas[_direction])] * num_chunks) #lambdas
+            arguments.append(self.parallelism.scatter([[noneq_trajectory_filenames[i] for i in chunk] for chunk in sMC_chunks[_direction]])) #noneq_trajectory_filenames
+            arguments.append([self.parallelism.broadcast(num_integration_steps)] * num_chunks) #num_integration_steps
+            arguments.append([self.parallelism.broadcast(return_timer)] * num_chunks) #return timer
+            arguments.append([self.parallelism.broadcast(True)] * num_chunks) #return_sampler_state
+            arguments.append([self.parallelism.broadcast(rethermalize)] * num_chunks) #rethermalize
+            arguments.append([self.parallelism.broadcast(True)] * num_chunks) # whether to compute incremental works
+
+            def resubmit(particles, random_seed, _workers, speculative):
+                #restarted and speculative jobs are deployed from the (last good) configurations of this lambda step;
+                #a speculative copy runs concurrently with the original job, so it writes its own trajectory files
+                _filenames = [noneq_trajectory_filenames[i] for i in particles]
+                if speculative:
+                    _filenames = [filename[:-3] + '.speculative.h5' if filename is not None else None for filename in _filenames]
+                return self.parallelism.deploy(func = call_anneal_method_chunk,
+                                               arguments = ([remote_worker], [[sMC_sampler_states[_direction][i] for i in particles]], [_lambdas[_direction]],
+                                                            [_filenames], [num_integration_steps], [return_timer],
+                                                            [True], [rethermalize], [True], [random_seed]),
+                                               workers = _workers if _workers is not None else workers,
+                                               pure = False)[0]
+
+            sMC_futures.update({_direction: self.parallelism.deploy(func = call_anneal_method_chunk,
+                                                              arguments = tuple(arguments),
+                                                              workers = workers)})
+            self.bytes_shipped[_direction].append(self.parallelism.bytes_shipped - _bytes_shipped)
+            if self.parallelism.count_bytes:
+                _logger.info(f"\t\tshipped {self.bytes_shipped[_direction][-1]} bytes to launch the {_direction} annealing jobs")
+            for index, (chunk, future) in enumerate(zip(sMC_chunks[_direction], sMC_futures[_direction])):
+                supervisor.add((_direction, index), future, chunk, resubmit)
+
+        def _collect(_direction, _chunk_results):
+            """
+            update the particles of a direction with the results of its annealing chunks and complete the lambda step
+            """
+            #unchunk the particle results
+            _futures = [result for _results, task_time, timings in _chunk_results for result in _results]
+
+            #collect tuple results
+            _incremental_works = [_iter[0] for _iter in _futures]
+            _sampler_states = [_iter[1] for _iter in _futures]
+            _timers = [_iter[2] for _iter in _futures]
+
+            #make sure incremental works are the same on distributed annealing as they are locally with trailblaze/not-trailblaze
+            assert all(abs(i - j) < DISTRIBUTED_ERROR_TOLERANCE for i, j in zip(np.array(_incremental_works).flatten(), sMC_incremental_works[_direction])), f"the incremental works between the local and distributed platforms do not match"
+            #if this is true, we can update the cumulative work dict
+            sMC_cumulative_works[_direction].append(np.add(sMC_cumulative_works[_direction][-1], sMC_incremental_works[_direction]))
+
+            #append the sampler_states
+            sMC_sampler_states[_direction] = np.array(_sampler_states)
+
+            #append the _timers
+            sMC_timers[_direction].append(_timers)
+
+            print(f"\t{_direction} retrieval time: {time.time() - worker_retrieval[_direction]}")
+
+            current_lambdas[_direction] = _lambdas[_direction][-1] #update the lambda with the current lambda
+            direction_iterations[_direction] += 1
+
+        def _direction_state(_direction):
+            """
+            the per-direction state that a lambda step (sampling, incrementing lambda, launching) modifies before the step is collected
+            """
+            return {'protocols': self.protocols[_direction],
+                    'sampler_states': sMC_sampler_states[_direction],
+                    'incremental_works': sMC_incremental_works[_direction],
+                    'cumulative_works': sMC_cumulative_works[_direction],
+                    'observables': sMC_observables[_direction],
+                    'particle_ancestries': sMC_particle_ancestries[_direction],
+                    'timers': sMC_timers[_direction],
+                    'bytes_shipped': self.bytes_shipped[_direction]}
+
+        _prelaunch_states = {} #the state of every in-flight direction (in launch order) before its lambda step was started (asynchronous annealing)
+
+        def _checkpoint():
+            if checkpoint_filename is not None:
+                _logger.debug(f"\tcheckpointing iteration {iteration_number} to {checkpoint_filename}")
+                #an in-flight direction is checkpointed as it was before its lambda step (random states included); on resume, it is relaunched first
+                _in_flight = list(_prelaunch_states.keys())
+                _states = {_direction: _prelaunch_states[_direction] if _direction in _prelaunch_states else _direction_state(_direction) for _direction in directions}
+                _random_states = _prelaunch_states[_in_flight[0]] if len(_in_flight) > 0 else {'random_state': random.getstate(), 'numpy_random_state': np.random.get_state()}
+                _checkpointed = lambda key: {_direction: _states[_direction][key] for _direction in directions}
+                write_checkpoint({'method': 'sMC',
+                                  'num_particles': num_particles,
+                                  'directions': directions,
+                                  'iteration_number': iteration_number,
+                                  'direction_iterations': direction_iterations,
+                                  'current_lambdas': current_lambdas,
+                                  'protocols': _checkpointed('protocols'),
+                                  'sampler_states': _checkpointed('sampler_states'),
+                                  'incremental_works': _checkpointed('incremental_works'),
+                                  'cumulative_works': _checkpointed('cumulative_works'),
+                                  'observables': _checkpointed('observables'),
+                                  'particle_ancestries': _checkpointed('particle_ancestries'),
+                                  'timers': _checkpointed('timers'),
+                                  'bytes_shipped': _checkpointed('bytes_shipped'),
+                                  'particle_chunk_size': chunker.chunk_size,
+                                  'particle_overheads': chunker.particle_overheads,
+                                  'launch_order': _in_flight + [_direction for _direction in directions if _direction not in _in_flight],
+                                  'random_state': _random_states['random_state'],
+                                  'numpy_random_state': _random_states['numpy_random_state']}, checkpoint_filename)
 
         _logger.debug(f"commencing annealing...")
-        while current_lambdas != finish_lines:
-            _logger.debug(f"entering iteration {iteration_number}; current_lambdas are {current_lambdas}")
-            start_timer = time.time()
-
-            #sample/resample
-            _logger.debug(f"\tattempting sampling/resampling...")
-            for _direction in directions:
-                if current_lambdas[_direction] == finish_lines[_direction]: #if this direction is done...
-                    _logger.info(f"\tdirection {_direction} is complete.  omitting resample.")
-                    continue
-
-                if iteration_number == 0: #this is the first iteration and we have to pull sampler states unbiasedly
-                    sMC_sampler_states.update({_direction: np.array([self.pull_trajectory_snapshot(int(self.protocols[_direction][0])) for _ in range(num_particles)])})
-                elif _resample:
-                    _logger.debug(f"\tattempting to resample particles...")
-                    #Note: the cumulative works we pull for resampling are not the last cumulative works, but the second to last.
-                        #the last cumulative works are the penultimate cumulative works plus the incremental works;
-                        #however, often, the resampling criteria (if conditional, require the separation of cumulative and incremental works)
-                        #implicitly, self._resample will compute the ultimate cumulative works
-                    normalized_observable_value, resampled_works, resampled_indices, resample_bool = self._resample(incremental_works = sMC_incremental_works[_direction],
-                                                                                                 cumulative_works = sMC_cumulative_works[_direction][-2],
-                                                                                                 observable = resample['criterion'],
-                                                                                                 resampling_method = resample['method'],
-                                                                                                 resample_observable_threshold = resample['threshold'])
-                    if resample_bool:
-                        _logger.debug(f"\tresample is True")
-                        sMC_observables[_direction][-1] = normalized_observable_value #update the previous observables with the resampled observable
-                        sMC_cumulative_works[_direction][-1] = resampled_works #update the ultimate cumulative work
-
-                        #we need a deepcopy to prevent annealing over the same sampler state in a single iteration with local annealing
-                        new_sampler_states = np.array([copy.deepcopy(sMC_sampler_states[_direction][i]) for i in resampled_indices])
-                        sMC_sampler_states.update({_direction: new_sampler_states})
+        with self.parallelism.task_stream() as task_stream:
+            start_annealing = time.time()
+            if not asynchronous:
+                #both directions (and all particles) advance in lock-step
+                while current_lambdas != finish_lines:
+                    _logger.debug(f"entering iteration {iteration_number}; current_lambdas are {current_lambdas}")
+                    start_timer = time.time()
+                    active_directions = [_direction for _direction in directions if current_lambdas[_direction] != finish_lines[_direction]]
+
+                    #sample/resample
+                    _logger.debug(f"\tattempting sampling/resampling...")
+                    for _direction in active_directions:
+                        _sample(_direction)
+
+                    #attempt to trailblaze lambdas and launch workers
+                    _logger.debug(f"\tincrementing lambdas...")
+                    for _direction in active_directions:
+                        _increment_lambda(_direction)
+
+                    #now we want to execute distributed/local annealing depending on the remote worker
+                    _logger.debug(f"\tconducting annealing execution...")
+                    for _direction in active_directions:
+                        _launch(_direction)
+
+                    #now we collect the finished (supervised) jobs
+                    _logger.debug(f"\tretreiving annealing executions...")
+                    _chunk_results = {_direction: [None] * len(sMC_chunks[_direction]) for _direction in active_directions}
+                    for (_direction, index), result in supervisor:
+                        _chunk_results[_direction][index] = result
+                        chunker.record(len(sMC_chunks[_direction][index]), result[1], result[2])
+                    for _direction in active_directions:
+                        _logger.debug(f"\t\tcollecting annealing jobs in direction {_direction}...")
+                        _collect(_direction, _chunk_results[_direction])
+
+                    end_timer = time.time() - start_timer
+                    iteration_number += 1
+                    _logger.info(f"iteration took {end_timer} seconds; effective per-particle overhead: {chunker.update()} seconds.")
+
+                    if iteration_number % checkpoint_interval == 0:
+                        _checkpoint()
+                    _logger.debug(f"\n")
+            else:
+                #each direction advances as soon as all of its own particles are collected; the resampling barrier (within a direction) is the only barrier
+                def _advance(_direction):
+                    if checkpoint_filename is not None:
+                        _prelaunch_states[_direction] = copy.deepcopy(_direction_state(_direction))
+                        _prelaunch_states[_direction].update({'random_state': random.getstate(), 'numpy_random_state': np.random.get_state()})
+                    _sample(_direction)
+                    _increment_lambda(_direction)
+                    _launch(_direction)
+                    _results[_direction] = [None] * len(sMC_chunks[_direction])
+                    _num_collected[_direction] = 0
+
+                _results, _num_collected = {}, {}
+                for _direction in launch_order:
+                    if current_lambdas[_direction] != finish_lines[_direction]:
+                        _advance(_direction)
+
+                for (_direction, index), result in supervisor:
+                    _results[_direction][index] = result
+                    _num_collected[_direction] += 1
+                    chunker.record(len(sMC_chunks[_direction][index]), result[1], result[2], window = _direction)
+                    if _num_collected[_direction] < len(sMC_chunks[_direction]):
+                        continue
+
+                    _logger.debug(f"\tcollected all annealing jobs of direction {_direction} (lambda step {direction_iterations[_direction]})")
+                    _collect(_direction, _results[_direction])
+                    _prelaunch_states.pop(_direction, None)
+                    _logger.info(f"\teffective per-particle overhead: {chunker.update(window = _direction)} seconds.")
+                    iteration_number += 1
+                    if iteration_number % checkpoint_interval == 0:
+                        _checkpoint()
+                    if current_lambdas[_direction] != finish_lines[_direction]:
+                        _advance(_direction)
                     else:
-                        #we don't need to update the ultimate observables, cumulative works, or sampler_states
-                        pass
-
-                    #however, we do need to update the particle ancestries...
-                    new_particle_ancestries = np.array([sMC_particle_ancestries[_direction][-1][i] for i in resampled_indices])
-                    sMC_particle_ancestries[_direction].append(new_particle_ancestries)
-                else: #we are not resampling
-                    #the sampler states are updated by gathering the workers' sampler states
-                    #the observables are calculated in the trailblaze attempt pass
-                    #the cumulative works are unchanged
-                    #we do not return particle ancestries if no resampling is conducted
-                    _logger.debug(f"not resampling.  omitting sMC updates")
-                    pass
+                        _logger.info(f"\tdirection {_direction} is complete.")
+            annealing_time = time.time() - start_annealing
 
-            #attempt to trailblaze lambdas and launch workers
-            _logger.debug(f"\tincrementing lambdas...")
-            for _direction in directions:
-                if current_lambdas[_direction] == finish_lines[_direction]: #if this direction is done...
-                    _logger.debug(f"\tdirection {_direction} is complete.  omitting trailblazing.")
-                    continue
-
-                if _trailblaze:
-                    _logger.debug(f"\ttrailblazing lambdas in {_direction} direction")
-                    #gather sampler states and cumulative works in a concurrent manner (i.e. flatten them)
-                    sampler_states = sMC_sampler_states[_direction]
-                    cumulative_works = sMC_cumulative_works[_direction][-1]
-                    if iteration_number == 0:
-                        initial_guess = None
-                    else:
-                        initial_guess = min([2 * self.protocols[_direction][-1] - self.protocols[_direction][-2], 1.0]) if _direction == 'forward' else max([2 * self.protocols[_direction][-1] - self.protocols[_direction][-2], 0.0])
-
-                    _new_lambda, normalized_observable, incremental_works = self.binary_search(sampler_states = sampler_states,
-                                                                                               cumulative_works = cumulative_works,
-                                                                                               start_val = current_lambdas[_direction],
-                                                                                               end_val = finish_lines[_direction],
-                                                                                               observable = self.supported_observables[trailblaze['criterion']],
-                                                                                               observable_threshold = trailblaze['threshold'] * sMC_observables[_direction][-1],
-                                                                                               initial_guess = initial_guess)
-                    sMC_incremental_works.update({_direction: incremental_works})
-                    _logger.info(f"\t\tlambda increments: {current_lambdas[_direction]} to {_new_lambda}.")
-                    _logger.info(f"\t\tnormalized observable: {normalized_observable}.  Observable threshold is {trailblaze['threshold'] * sMC_observables[_direction][-1]}")
-                    self.protocols[_direction].append(_new_lambda)
-                    sMC_observables[_direction].append(normalized_observable)
-                    _lambdas.update({_direction: np.array([current_lambdas[_direction], _new_lambda])})
-                    #the current lambdas will be updated at the end of the loop
-                else:
-                    start_val, end_val = self.protocols[_direction][iteration_number], self.protocols[_direction][iteration_number + 1]
-                    _logger.debug(f"\tnot trailblazing; annealing lambda from {start_val} to {end_val}")
-                    self.thermodynamic_state.set_alchemical_parameters(start_val, LambdaProtocol(functions = self.lambda_protocol))
-                    current_rps = np.array([compute_reduced_potential(self.thermodynamic_state, sampler_state) for sampler_state in sampler_states])
-                    #if we are not trailblazing, then the local observable is computed from the resampling observable
-                    normalized_observable, incremental_works = compute_lambda_increment(new_val, sMC_sampler_states[_direction], resample['criterion'], current_rps, sMC_cumulative_works[_direction][-1])
-                    sMC_incremental_works.update({_direction: incremental_works})
-                    sMC_observables[_direction].append(normalized_observable)
-                    _lambdas.update({_direction: np.array(start_val, end_val)})
-                    #the current lambdas will be updated at the end of the loop
-
-            #now we want to execute distributed/local annealing depending on the remote worker
-            _logger.debug(f"\tconducting annealing execution...")
-            for _direction in directions:
-                if current_lambdas[_direction] == finish_lines[_direction]:
-                    _logger.info(f"\tdirection {_direction} is complete.  omitting annealing")
-                    continue
-                worker_retrieval[_direction] = time.time()
-                _logger.info(f"\t\tentering {_direction} direction to launch annealing jobs.")
-
-                _logger.info(f"\t\tthe current lambdas for annealing are {_lambdas[_direction]}")
-
-                #make construct iterable list for distributed annealing
-                iterables = []
-                iterables.append([remote_worker] * num_particles) #remote_worker
-                iterables.append(list(sMC_sampler_states[_direction])) #sampler_state
-                iterables.append([_lambdas[_direction]] * num_particles) #lambdas
-                iterables.append([None]*num_particles) #noneq_trajectory_filename
-                iterables.append([num_integration_steps] * num_particles) #num_integration_steps
-                iterables.append([return_timer] * num_particles) #return timer
-                iterables.append([True] * num_particles) #return_sampler_state
-                iterables.append([rethermalize] * num_particles) #rethermalize
-                iterables.append([True] * num_particles) # whether to compute incremental works
-
-                for job in range(num_particles):
-                    if self.ncmc_save_interval is not None: #check if we should make 'trajectory_filename' not None
-                        iterables[2][job] = self.neq_traj_filename[_direction] + f".iteration_{job:04}.h5"
-
-
-                scattered_futures = [self.parallelism.scatter(iterable) for iterable in iterables]
-                sMC_futures.update({_direction: self.parallelism.deploy(func = call_anneal_method,
-                                                                  arguments = tuple(scattered_futures),
-                                                                  workers = workers)})
-
-            #collect futures into one list and see progress
-            all_futures = [item for sublist in list(sMC_futures.values()) for item in sublist]
-            self.parallelism.progress(futures = all_futures)
-
-            #now we collect the finished futures
-            _logger.debug(f"\tretreiving annealing executions...")
-            for _direction in directions:
-                if current_lambdas[_direction] == finish_lines[_direction]:
-                    _logger.info(f"\tdirection {_direction} is complete.  omitting job collection")
-                    continue
-                _logger.debug(f"\t\tcollecting annealing jobs in direction {_direction}...")
-                _futures = self.parallelism.gather_results(futures = sMC_futures[_direction])
-
-                #collect tuple results
-                _incremental_works = [_iter[0] for _iter in _futures]
-                _sampler_states = [_iter[1] for _iter in _futures]
-                _timers = [_iter[2] for _iter in _futures]
-
-
-                #make sure incremental works are the same on distributed annealing as they are locally with trailblaze/not-trailblaze
-                assert all(abs(i - j) < DISTRIBUTED_ERROR_TOLERANCE for i, j in zip(np.array(_incremental_works).flatten(), sMC_incremental_works[_direction])), f"the incremental works between the local and distributed platforms do not match"
-                #if this is true, we can update the cumulative work dict
-                sMC_cumulative_works[_direction].append(np.add(sMC_cumulative_works[_direction][-1], sMC_incremental_works[_direction]))
-
-                #append the sampler_states
-                sMC_sampler_states[_direction] = np.array(_sampler_states)
-
-                #append the _timers
-                sMC_timers[_direction].append(_timers)
-
-                print(f"\t{_direction} retrieval time: {time.time() - worker_retrieval[_direction]}")
-
-            #report the updated logger dicts and observables
-            for _direction in directions:
-                if current_lambdas[_direction] != finish_lines[_direction]:
-                    current_lambdas[_direction] = _lambdas[_direction][-1] #update the lambda with the current lambda
-
-            end_timer = time.time() - start_timer
-            iteration_number += 1
-            _logger.info(f"iteration took {end_timer} seconds.")
-            _logger.debug(f"\n")
+        self.worker_utilization = self.parallelism.worker_utilization(task_stream, annealing_time)
+        _logger.info(f"annealing took {annealing_time} seconds; worker utilization: {self.worker_utilization}")
+        self.sMC_timers = sMC_timers
+        self.particle_overheads = chunker.particle_overheads
+        self.supervision_events = supervisor.events
 
         _logger.debug(f"deactivating annealing workers...")
         self._deactivate_annealing_workers()
@@ -751,11 +1171,39 @@ class SequentialMonteCarlo():
         self.dg_EXP = {}
         for _direction, _lst in cumulative_work_dict.items():
             self.cumulative_work[_direction] = _lst
-            self.dg_EXP[_direction] = np.array([pymbar.EXP(_lst[:,i]) for i in range(_lst.shape[1])])
+            self.dg_EXP[_direction] = np.stack(estimators.EXP(_lst), axis = 1) #all columns at once; equivalent to pymbar.EXP on each column
             _logger.debug(f"cumulative_work for {_direction}: {self.cumulative_work[_direction]}")
         if len(list(self.cumulative_work.keys())) == 2:
             self.dg_BAR = pymbar.BAR(self.cumulative_work['forward'][:, -1], self.cumulative_work['reverse'][:, -1])
 
+    def compute_AIS_uncertainty(self, cumulative_work_dict):
+        """
+        Method to compute the uncertainty of the free energy of the cumulative works collected so far; BAR if both directions have been collected, else EXP.
+
+        Arguments
+        ---------
+        cumulative_work_dict : dict
+            dictionary of the form {_direction <str>: np.ndarray of shape (num_particles, iterations) or None}
+
+        Returns
+        -------
+        uncertainty : float
+            the free energy uncertainty (kT); None if there are fewer than two particles in a direction, or if the estimate fails or is not finite
+        """
+        final_works = {_direction: _works[:, -1] for _direction, _works in cumulative_work_dict.items() if _works is not None and len(_works) > 1}
+        if len(final_works) < len(cumulative_work_dict):
+            return None
+        try:
+            if len(final_works) == 2:
+                uncertainty = pymbar.BAR(final_works['forward'], final_works['reverse'])[1]
+            else:
+                uncertainty = estimators.EXP(list(final_works.values())[0][:, np.newaxis])[1][-1]
+        except Exception as e:
+            #e.g. BAR does not converge when the work distributions do not overlap; the free energy is then not converged either
+            _logger.warning(f"the free energy uncertainty could not be estimated: {e}")
+            return None
+        return uncertainty if np.isfinite(uncertainty) else None
+
     def minimize_sampler_states(self):
         """
         simple wrapper function to minimize the input sampler states
@@ -767,7 +1215,7 @@ class SequentialMonteCarlo():
 
     def pull_trajectory_snapshot(self, endstate):
         """
-        Draw randomly a single snapshot from self._eq_files_dict
+        Draw randomly a single snapshot from the equilibrium snapshot pool
 
         Parameters
         ----------
@@ -778,21 +1226,43 @@ class SequentialMonteCarlo():
         sampler_state: openmmtools.SamplerState
             sampler state with positions and box vectors if applicable
         """
-        #pull a random index
+        return self.pull_trajectory_snapshots(endstate, 1)[0]
+
+    def pull_trajectory_snapshots(self, endstate, num_snapshots):
+        """
+        Draw randomly (with replacement) a number of snapshots from the equilibrium snapshot pool.
+        Each equilibrium file is read at most once.
+
+        Parameters
+        ----------
+        endstate: int
+            lambda endstate from which to extract equilibrated snapshots, either 0 or 1
+        num_snapshots : int
+            number of snapshots to draw
+
+        Returns
+        -------
+        sampler_states: np.array of openmmtools.SamplerState
+            sampler states with positions and box vectors if applicable
+        """
         assert endstate in [0,1], f"the endstate ({endstate}) is not 0 or 1"
-        index = random.choice(self._eq_dict[f"{endstate}_decorrelated"])
-        files = [key for key in self._eq_files_dict[endstate].keys() if index in self._eq_files_dict[endstate][key]]
-        assert len(files) == 1, f"files: {files} doesn't have one entry; index: {index}, eq_files_dict: {self._eq_files_dict[endstate]}"
-        file = files[0]
-        file_index = self._eq_files_dict[endstate][file].index(index)
+        if self.snapshot_pools[endstate] is None:
+            self.build_snapshot_pool(endstate)
+        return self.snapshot_pools[endstate].draw(num_snapshots)
 
-        #now we load file as a traj and create a sampler state with it
-        traj = md.load_frame(file, file_index)
-        positions = traj.openmm_positions(0)
-        box_vectors = traj.openmm_boxes(0)
-        sampler_state = SamplerState(positions, box_vectors = box_vectors)
+    def build_snapshot_pool(self, endstate):
+        """
+        Build the indexed snapshot pool of an endstate from the decorrelated equilibrium snapshots.
 
-        return sampler_state
+        Parameters
+        ----------
+        endstate: int
+            lambda endstate for which to build the pool, either 0 or 1
+        """
+        assert self._eq_dict[f"{endstate}_decorrelated"] is not None, f"there are no decorrelated snapshots at endstate {endstate}; equilibrate with decorrelate = True"
+        self.snapshot_pools[endstate] = SnapshotPool(file_numsnapshots = self._eq_dict[endstate],
+                                                     decorrelated_indices = self._eq_dict[f"{endstate}_decorrelated"])
+        _logger.debug(f"\tsnapshot pool for endstate {endstate}: {self.snapshot_pools[endstate].statistics}")
 
     def equilibrate(self,
                     n_equilibration_iterations = 1,
@@ -801,7 +1271,9 @@ class SequentialMonteCarlo():
                     max_size = 1024*1e3,
                     decorrelate=False,
                     timer = False,
-                    minimize = False):
+                    minimize = False,
+                    n_uncorrelated_samples = None,
+                    n_replicas = 1):
         """
         Run the equilibrium simulations a specified number of times at the lambda 0, 1 states. This can be used to equilibrate
         the simulation before beginning the free energy calculation.
@@ -815,7 +1287,7 @@ class SequentialMonteCarlo():
         endstates : list, default [0,1]
             at which endstate(s) to conduct n_equilibration_iterations (either [0] ,[1], or [0,1])
         max_size : float, default 1.024e6 (bytes)
-            number of bytes allotted to the current writing-to file before it is finished and a new equilibrium file is initiated.
+            number of bytes of positions buffered in memory before they are appended to the current equilibrium file.
         decorrelate : bool, default False
             whether to parse all written files serially and remove correlated snapshots; this returns an ensemble of iid samples in theory.
         timer : bool, default False
@@ -823,6 +1295,13 @@ class SequentialMonteCarlo():
             processes in the feptask equilibration scheme.
         minimize : bool, default False
             Whether to minimize the sampler state before conducting equilibration. This is passed directly to feptasks.run_equilibration
+        n_uncorrelated_samples : int, default None
+            if specified, each endstate's equilibrium run stops once this many effectively uncorrelated samples (including those of previous
+            calls) have been collected; n_equilibration_iterations is then the maximum number of iterations.
+        n_replicas : int, default 1
+            number of independent equilibrium replicas to run in parallel at each endstate.  Each replica has its own (minimized, if minimize)
+            start with randomized velocities and its own trajectory files, and is decorrelated separately; the decorrelated snapshots of all
+            replicas are merged into the snapshot pool of the endstate.  With n_uncorrelated_samples, each replica collects its share.
 
         Returns
         -------
@@ -833,52 +1312,26 @@ class SequentialMonteCarlo():
         _logger.debug(f"conducting equilibration")
         for endstate in endstates:
             assert endstate in [0, 1], f"the endstates contains {endstate}, which is not in [0, 1]"
+        assert n_replicas >= 1, f"the number of replicas ({n_replicas}) must be at least 1"
 
         # run a round of equilibrium
-        _logger.debug(f"iterating through endstates to submit equilibrium jobs")
-        EquilibriumFEPTask_list = []
-        for state in endstates: #iterate through the specified endstates (0 or 1) to create appropriate EquilibriumFEPTask inputs
-            _logger.debug(f"\tcreating lambda state {state} EquilibriumFEPTask")
-            self.thermodynamic_state.set_alchemical_parameters(float(state), lambda_protocol = LambdaProtocol(functions = self.lambda_protocol))
-            input_dict = {'thermodynamic_state': copy.deepcopy(self.thermodynamic_state),
-                          'nsteps_equil': n_steps_per_equilibration,
-                          'topology': self.factory.hybrid_topology,
-                          'n_iterations': n_equilibration_iterations,
-                          'splitting': self.eq_splitting_string,
-                          'atom_indices_to_save': None,
-                          'trajectory_filename': None,
-                          'max_size': max_size,
-                          'timer': timer,
-                          '_minimize': minimize,
-                          'file_iterator': 0,
-                          'timestep': self.timestep}
-
-
-            if self.write_traj:
-                _logger.debug(f"\twriting traj to {self.eq_trajectory_filename[state]}")
-                equilibrium_trajectory_filename = self.eq_trajectory_filename[state]
-                input_dict['trajectory_filename'] = equilibrium_trajectory_filename
-            else:
-                _logger.debug(f"\tnot writing traj")
-
-            if self._eq_dict[state] == []:
-                _logger.debug(f"\tself._eq_dict[{state}] is empty; initializing file_iterator at 0 ")
-            else:
-                last_file_num = int(self._eq_dict[state][-1][0][-7:-3])
-                _logger.debug(f"\tlast file number: {last_file_num}; initiating file iterator as {last_file_num + 1}")
-                file_iterator = last_file_num + 1
-                input_dict['file_iterator'] = file_iterator
-            task = EquilibriumFEPTask(sampler_state = self.sampler_states[state], inputs = input_dict, outputs = None)
-            EquilibriumFEPTask_list.append(task)
+        EquilibriumFEPTask_list = self._equilibrium_tasks(endstates = endstates,
+                                                          n_equilibration_iterations = n_equilibration_iterations,
+                                                          n_steps_per_equilibration = n_steps_per_equilibration,
+                                                          max_size = max_size,
+                                                          timer = timer,
+                                                          minimize = minimize,
+                                                          n_uncorrelated_samples = n_uncorrelated_samples,
+                                                          n_replicas = n_replicas)
 
         _logger.debug(f"scattering and mapping run_equilibrium task")
-        #we need not concern ourselves with _adaptive here since we are only running vanilla MD on 1 or 2 endstates
+        #we need not concern ourselves with _adaptive here since we are only running vanilla MD on n_replicas chains per endstate
 
 
         if self.external_parallelism:
             #the client is already active
-            #we only run a max of 2 parallel runs at once, so we can pull 2 workers
-            num_available_workers = min(len(endstates), len(self.parallelism_parameters['available_workers']))
+            #we run a max of len(endstates) * n_replicas parallel runs at once, so we pull at most that many workers
+            num_available_workers = min(len(EquilibriumFEPTask_list), len(self.parallelism_parameters['available_workers']))
             workers = np.random.choice(self.parallelism_parameters['available_workers'], size = num_available_workers, replace = False)
             scatter_futures = self.parallelism.scatter(EquilibriumFEPTask_list, workers = workers)
             futures = self.parallelism.deploy(run_equilibrium, (scatter_futures,), workers = workers)
@@ -887,9 +1340,12 @@ class SequentialMonteCarlo():
             if self.parallelism_parameters['library'] is None: #then we are running locally
                 _parallel_processes = 0
             else:
-                _parallel_processes = min(len(endstates), self.parallelism_parameters['num_processes'])
+                _parallel_processes = min(len(EquilibriumFEPTask_list), self.parallelism_parameters['num_processes'])
 
-            self.parallelism.activate_client(library = self.parallelism_parameters['library'], num_processes = _parallel_processes)
+            self.parallelism.activate_client(library = self.parallelism_parameters['library'],
+                                             num_processes = _parallel_processes,
+                                             threads_per_process = self.parallelism_parameters.get('threads_per_process', None),
+                                             count_bytes = self.parallelism_parameters.get('count_bytes', False))
             scatter_futures = self.parallelism.scatter(EquilibriumFEPTask_list)
             futures = self.parallelism.deploy(run_equilibrium, (scatter_futures,))
         else:
@@ -906,14 +1362,103 @@ class SequentialMonteCarlo():
             pass
 
         #the rest of the function is independent of the dask workers...
+        self._collect_equilibrium(endstates = endstates,
+                                  eq_results = eq_results,
+                                  decorrelate = decorrelate,
+                                  n_uncorrelated_samples = n_uncorrelated_samples)
 
+    def _replica_key(self, state, replica):
+        """
+        the key of an equilibrium replica in self.sampler_states and self._timeseries_estimators; the first replica of an endstate is keyed by the endstate
+        """
+        return state if replica == 0 else (state, replica)
+
+    def _equilibrium_tasks(self,
+                           endstates,
+                           n_equilibration_iterations,
+                           n_steps_per_equilibration,
+                           max_size = 1024*1e3,
+                           timer = False,
+                           minimize = False,
+                           n_uncorrelated_samples = None,
+                           snapshot_queues = None,
+                           snapshot_spacing = 1,
+                           snapshot_burn_in = 0,
+                           n_snapshots = None,
+                           n_replicas = 1):
+        """
+        create the EquilibriumFEPTasks of the n_replicas replicas of the endstates (see equilibrate); if snapshot_queues ({endstate: queue})
+        is specified, the tasks publish n_snapshots snapshots to the queue of their endstate after snapshot_burn_in iterations, at least
+        snapshot_spacing iterations (and a statistical inefficiency) apart (see run_equilibrium)
+        """
+        _logger.debug(f"iterating through endstates to submit equilibrium jobs")
+        EquilibriumFEPTask_list = []
+        for state, replica in [(state, replica) for state in endstates for replica in range(n_replicas)]: #iterate through the specified endstates (0 or 1) and their replicas to create appropriate EquilibriumFEPTask inputs
+            _logger.debug(f"\tcreating lambda state {state} (replica {replica}) EquilibriumFEPTask")
+            self.thermodynamic_state.set_alchemical_parameters(float(state), lambda_protocol = LambdaProtocol(functions = self.lambda_protocol))
+            replica_key = self._replica_key(state, replica)
+            if replica_key not in self.sampler_states:
+                #a new replica starts from the current state of the first replica, and is decorrelated from it by randomized velocities
+                self.sampler_states[replica_key] = copy.deepcopy(self.sampler_states[state])
+                self._timeseries_estimators[replica_key] = StatisticalInefficiencyEstimator()
+            replica_mask = np.array(self._eq_dict[f"{state}_replicas"]) == replica
+            input_dict = {'thermodynamic_state': copy.deepcopy(self.thermodynamic_state),
+                          'nsteps_equil': n_steps_per_equilibration,
+                          'topology': self.factory.hybrid_topology,
+                          'n_iterations': n_equilibration_iterations,
+                          'splitting': self.eq_splitting_string,
+                          'atom_indices_to_save': None,
+                          'trajectory_filename': None,
+                          'max_size': max_size,
+                          'timer': timer,
+                          '_minimize': minimize,
+                          'file_iterator': 0,
+                          'timestep': self.timestep,
+                          'n_uncorrelated_samples': int(np.ceil(n_uncorrelated_samples / n_replicas)) if n_uncorrelated_samples is not None else None,
+                          'reduced_potentials_history': list(np.array(self._eq_dict[f"{state}_reduced_potentials"])[replica_mask]) if n_uncorrelated_samples is not None else None,
+                          'snapshot_queue': snapshot_queues[state] if snapshot_queues is not None else None,
+                          'snapshot_spacing': snapshot_spacing,
+                          'snapshot_burn_in': snapshot_burn_in,
+                          'n_snapshots': n_snapshots,
+                          'randomize_velocities': replica > 0 and not replica_mask.any(),
+                          'endstate': state,
+                          'replica': replica}
+
+
+            if self.write_traj:
+                equilibrium_trajectory_filename = self.eq_trajectory_filename[state] if replica == 0 else self.eq_trajectory_filename[state][:-3] + f".replica_{replica}.h5"
+                _logger.debug(f"\twriting traj to {equilibrium_trajectory_filename}")
+                input_dict['trajectory_filename'] = equilibrium_trajectory_filename
+                replica_files = [filename for filename, _ in self._eq_dict[state] if filename[:-7] == equilibrium_trajectory_filename[:-2]]
+            else:
+                _logger.debug(f"\tnot writing traj")
+                replica_files = []
 
-        for state, eq_result in zip(endstates, eq_results):
-            _logger.debug(f"\tcomputing equilibrium task future for state = {state}")
+            if replica_files == []:
+                _logger.debug(f"\tthere are no files of replica {replica} in self._eq_dict[{state}]; initializing file_iterator at 0 ")
+            else:
+                last_file_num = int(replica_files[-1][-7:-3])
+                _logger.debug(f"\tlast file number: {last_file_num}; initiating file iterator as {last_file_num + 1}")
+                file_iterator = last_file_num + 1
+                input_dict['file_iterator'] = file_iterator
+            task = EquilibriumFEPTask(sampler_state = self.sampler_states[replica_key], inputs = input_dict, outputs = None)
+            EquilibriumFEPTask_list.append(task)
+        return EquilibriumFEPTask_list
+
+    def _collect_equilibrium(self, endstates, eq_results, decorrelate = False, n_uncorrelated_samples = None):
+        """
+        update the equilibrium files, reduced potentials, sampler states, and (if decorrelate) snapshot pools with the results of the equilibrium tasks
+        """
+        for eq_result in eq_results:
+            state, replica = eq_result.inputs['endstate'], eq_result.inputs['replica']
+            _logger.debug(f"\tcomputing equilibrium task future for state = {state} (replica {replica})")
             self._eq_dict[state].extend(eq_result.outputs['files'])
             self._eq_dict[f"{state}_reduced_potentials"].extend(eq_result.outputs['reduced_potentials'])
-            self.sampler_states.update({state: eq_result.sampler_state})
+            self._eq_dict[f"{state}_replicas"].extend([replica] * len(eq_result.outputs['reduced_potentials']))
+            self._timeseries_estimators[self._replica_key(state, replica)].update(eq_result.outputs['reduced_potentials'])
+            self.sampler_states.update({self._replica_key(state, replica): eq_result.sampler_state})
             self._eq_timers[state].append(eq_result.outputs['timers'])
+            self.snapshot_pools[state] = None #the pool is stale once new snapshots are collected
 
         _logger.debug(f"collections complete.")
         if decorrelate: # if we want to decorrelate all sample
@@ -921,22 +1466,26 @@ class SequentialMonteCarlo():
             for state in endstates:
                 _logger.debug(f"\tdecorrelating lambda = {state} data.")
                 traj_filename = self.eq_trajectory_filename[state]
-                if os.path.exists(traj_filename[:-2] + f'0000' + '.h5'):
-                    _logger.debug(f"\tfound traj filename: {traj_filename[:-2] + f'0000' + '.h5'}; proceeding...")
-                    [t0, g, Neff_max, A_t, uncorrelated_indices] = compute_timeseries(np.array(self._eq_dict[f"{state}_reduced_potentials"]))
-                    _logger.debug(f"\tt0: {t0}; Neff_max: {Neff_max}; uncorrelated_indices: {uncorrelated_indices}")
-                    self._eq_dict[f"{state}_decorrelated"] = uncorrelated_indices
-
-                    #now we just have to turn the file tuples into an array
-                    _logger.debug(f"\treorganizing decorrelated data; files w/ num_snapshots are: {self._eq_dict[state]}")
-                    iterator, corrected_dict = 0, {}
-                    for tupl in self._eq_dict[state]:
-                        new_list = [i + iterator for i in range(tupl[1])]
-                        iterator += len(new_list)
-                        decorrelated_list = [i for i in new_list if i in uncorrelated_indices]
-                        corrected_dict[tupl[0]] = decorrelated_list
-                    self._eq_files_dict[state] = corrected_dict
-                    _logger.debug(f"\t corrected_dict for state {state}: {corrected_dict}")
+                if len(self._eq_dict[state]) > 0:
+                    _logger.debug(f"\tfound {len(self._eq_dict[state])} trajectory files for {traj_filename}; proceeding...")
+                    #every replica is a separate chain: it is decorrelated on its own, and its uncorrelated indices are mapped to the global
+                    #(file-contiguous) snapshot indices, in which the snapshots of the replicas are interleaved in the order they were collected
+                    replicas = np.array(self._eq_dict[f"{state}_replicas"])
+                    uncorrelated_indices = []
+                    for replica in np.unique(replicas):
+                        replica_indices = np.where(replicas == replica)[0]
+                        if n_uncorrelated_samples is None:
+                            #without automatic stopping, the equilibration is detected exactly with pymbar
+                            [t0, g, Neff_max, A_t, replica_uncorrelated_indices] = compute_timeseries(np.array(self._eq_dict[f"{state}_reduced_potentials"])[replica_indices])
+                        else:
+                            t0, g, Neff_max = self._timeseries_estimators[self._replica_key(state, int(replica))].estimate()
+                            replica_uncorrelated_indices = self._timeseries_estimators[self._replica_key(state, int(replica))].uncorrelated_indices()
+                        _logger.debug(f"\treplica {replica}: t0: {t0}; Neff_max: {Neff_max}; uncorrelated_indices: {replica_uncorrelated_indices}")
+                        uncorrelated_indices.extend(replica_indices[np.asarray(replica_uncorrelated_indices, dtype = np.int64)])
+                    self._eq_dict[f"{state}_decorrelated"] = sorted(int(index) for index in uncorrelated_indices)
+
+                    #build the snapshot pool (global index -> file, offset) from which annealing particles are drawn
+                    self.build_snapshot_pool(state)
 
     def _resample(self,
                   incremental_works,
@@ -11,6 +11,7 @@ import numpy as np
 import mdtraj as md
 from perses.annihilation.relative import HybridTopologyFactory
 import mdtraj.utils as mdtrajutils
+import tables
 import pickle
 import simtk.unit as unit
 import tqdm
@@ -21,10 +22,13 @@ import logging
 import tqdm
 from sys import getsizeof
 import time
-from collections import namedtuple
+from collections import namedtuple, deque
 from perses.annihilation.lambda_protocol import LambdaProtocol
 from perses.annihilation.lambda_protocol import RelativeAlchemicalState, LambdaProtocol
+from perses.dispersed.estimators import survival_rates
 import random
+import socket
+import threading
 import pymbar
 import dask.distributed as distributed
 import tqdm
@@ -113,14 +117,7 @@ def compute_survival_rate(sMC_particle_ancestries):
     survival_rate : dict of {_direction : np.array(float)}
         the particle survival rate as a function of step
     """
-    survival_rate = {}
-    for _direction, _lst in sMC_particle_ancestries.items():
-        rate = []
-        num_starting_particles = len(_lst[0])
-        for step in range(len(sMC_particle_ancestries[_direction])):
-            rate.append(float(len(set(sMC_particle_ancestries[_direction][step]))) / num_starting_particles)
-        survival_rate[_direction] = rate
-
+    survival_rate = {_direction: survival_rates(np.array(_lst)) for _direction, _lst in sMC_particle_ancestries.items()}
     return survival_rate
 
 def minimize(thermodynamic_state,
@@ -253,6 +250,164 @@ def compute_timeseries(reduced_potentials):
 
     return [t0, g, Neff_max, A_t, full_uncorrelated_indices]
 
+def statistical_inefficiency(A_n, mintime = 3):
+    """
+    Compute the statistical inefficiency of a timeseries with an FFT-based autocorrelation function.
+    This is the estimator of pymbar.timeseries.statisticalInefficiency (fast = False), evaluated in O(N log N).
+
+    Arguments
+    ---------
+    A_n : np.array of floats
+        timeseries
+    mintime : int, default 3
+        minimum lag time to compute before the autocorrelation function is truncated at its first non-positive value
+
+    Returns
+    -------
+    g : float
+        statistical inefficiency; if the timeseries has no variance, this is N + 1, the value pymbar.timeseries.detectEquilibration assigns
+        to a timeseries of length N whose statistical inefficiency cannot be computed
+    """
+    A_n = np.asarray(A_n, dtype = np.float64)
+    N = len(A_n)
+    if N < 2:
+        return 1.0
+    dA_n = A_n - A_n.mean()
+    sigma2 = np.mean(dA_n**2)
+    if sigma2 == 0.0:
+        return float(N + 1)
+
+    n_fft = 2 ** int(np.ceil(np.log2(2 * N)))
+    fft = np.fft.rfft(dA_n, n = n_fft)
+    autocovariance = np.fft.irfft(fft * np.conjugate(fft), n = n_fft)[:N]
+    t = np.arange(1, N - 1)
+    C_t = autocovariance[1:N - 1] / ((N - t) * sigma2)
+    truncations = np.where((C_t <= 0.0) & (t > mintime))[0]
+    cutoff = truncations[0] if len(truncations) > 0 else len(t)
+    g = 1.0 + 2.0 * np.sum(C_t[:cutoff] * (1.0 - t[:cutoff] / N))
+
+    return max(g, 1.0)
+
+def next_check(num_samples, interval, growth = 0.1):
+    """
+    The number of samples at which a periodic check of a growing timeseries (e.g. a StatisticalInefficiencyEstimator estimate) is next due:
+    at least interval samples later, and at least growth times the current number of samples later.  Checks whose cost grows as N log N
+    then cost O(N log N / growth) in total, rather than O(N^2 log N / interval) if they are made every interval samples.
+
+    Arguments
+    ---------
+    num_samples : int
+        number of samples at the current check
+    interval : int
+        minimum number of samples between checks
+    growth : float, default 0.1
+        minimum relative growth of the timeseries between checks
+
+    Returns
+    -------
+    next_num_samples : int
+        the number of samples at the next check
+    """
+    return num_samples + max(interval, int(np.ceil(growth * num_samples)))
+
+class StatisticalInefficiencyEstimator():
+    """
+    Estimator of the equilibration time and statistical inefficiency of a growing reduced potential timeseries.
+    Blocks of reduced potentials are appended as they arrive; the equilibration time is chosen (as in pymbar.timeseries.detectEquilibration)
+    to maximize the number of effectively uncorrelated samples, but only over a fixed number of candidate equilibration times so that
+    an estimate costs O(num_candidates * N log N) rather than pymbar's O(N^2).  An estimate is not updated incrementally: it is recomputed
+    from the whole timeseries (and cached until the next update), so callers that update often should request estimates on a geometric
+    schedule (see next_check), which keeps their total cost O(num_candidates * N log N).
+    """
+    def __init__(self, mintime = 3, num_candidates = 50):
+        """
+        Arguments
+        ---------
+        mintime : int, default 3
+            minimum lag time of the autocorrelation function (see statistical_inefficiency)
+        num_candidates : int, default 50
+            number of equally spaced candidate equilibration times
+        """
+        self.mintime = mintime
+        self.num_candidates = num_candidates
+        self._data = np.zeros(1024)
+        self._n = 0
+        self._estimate = None
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def timeseries(self):
+        """
+        the collected timeseries
+        """
+        return self._data[:self._n]
+
+    def update(self, values):
+        """
+        Append a block of values to the timeseries.
+
+        Arguments
+        ---------
+        values : np.array of floats
+            block of reduced potentials
+        """
+        values = np.asarray(values, dtype = np.float64).ravel()
+        if self._n + len(values) > len(self._data):
+            _data = np.zeros(max(2 * len(self._data), self._n + len(values)))
+            _data[:self._n] = self._data[:self._n]
+            self._data = _data
+        self._data[self._n:self._n + len(values)] = values
+        self._n += len(values)
+        self._estimate = None
+
+    def estimate(self):
+        """
+        Estimate the equilibration time and statistical inefficiency of the timeseries collected so far.
+
+        Returns
+        -------
+        t0 : int
+            production region index
+        g : float
+            statistical inefficiency of the production region
+        Neff_max : float
+            effective number of samples in production region
+        """
+        if self._estimate is None:
+            A_t, T = self.timeseries, self._n
+            if T < 2:
+                self._estimate = (0, 1.0, float(T))
+            else:
+                candidates = np.unique(np.linspace(0, T - 2, min(T - 1, self.num_candidates)).astype(np.int64))
+                g_t = np.array([statistical_inefficiency(A_t[t:], mintime = self.mintime) for t in candidates])
+                Neff_t = (T - candidates + 1) / g_t
+                index = np.argmax(Neff_t)
+                self._estimate = (int(candidates[index]), g_t[index], Neff_t[index])
+        return self._estimate
+
+    def uncorrelated_indices(self):
+        """
+        Subsample the production region with a stride of the statistical inefficiency (as in pymbar.timeseries.subsampleCorrelatedData).
+
+        Returns
+        -------
+        uncorrelated_indices : list of int
+            indices of the effectively uncorrelated samples in the full timeseries
+        """
+        t0, g, _ = self.estimate()
+        n_production = self._n - t0
+        indices = np.unique(np.round(np.arange(int(np.ceil(n_production / g)) + 1) * g).astype(np.int64))
+        return [int(index) + t0 for index in indices[indices < n_production]]
+
+    @property
+    def n_uncorrelated_samples(self):
+        """
+        the number of effectively uncorrelated samples collected so far
+        """
+        return len(self.uncorrelated_indices())
+
 def run_equilibrium(task):
     """
     Run n_iterations*nsteps_equil integration steps.  n_iterations mcmc moves are conducted in the initial equilibration, returning n_iterations
@@ -272,11 +427,26 @@ def run_equilibrium(task):
          splitting: (<str>; The splitting string for the dynamics),
          atom_indices_to_save: (<list of int, default None>; list of indices to save when excluding waters, for instance. If None, all indices are saved.),
          trajectory_filename: (<str, optional, default None>; Full filepath of trajectory files. If none, trajectory files are not written.),
-         max_size: (<float>; maximum size of the trajectory numpy array allowable until it is written to disk),
+         max_size: (<float>; maximum size (bytes) of the buffered trajectory positions before they are appended to disk),
          timer: (<bool, default False>; whether to time all parts of the equilibrium run),
          _minimize: (<bool, default False>; whether to minimize the sampler_state before conducting equilibration),
          file_iterator: (<int, default 0>; which index to begin writing files),
-         timestep: (<unit.Quantity=float*unit.femtoseconds>; dynamical timestep)
+         timestep: (<unit.Quantity=float*unit.femtoseconds>; dynamical timestep),
+         n_uncorrelated_samples: (<int, optional, default None>; if specified, stop once this many effectively uncorrelated samples have been collected;
+                                  n_iterations is then the maximum number of iterations),
+         stopping_interval: (<int, optional, default 10>; minimum number of iterations between checks of the n_uncorrelated_samples stopping
+                             criterion; the checks are also spaced by a tenth of the samples collected so far (see next_check)),
+         reduced_potentials_history: (<list of float, optional, default None>; reduced potentials of previous equilibrium runs from this state that
+                                      count toward n_uncorrelated_samples),
+         snapshot_queue: (<perses.dispersed.parallel queue, optional, default None>; if specified, snapshots are published to this queue as they are produced),
+         snapshot_spacing: (<int, optional, default 1>; minimum number of iterations between the snapshots that are published to the snapshot_queue;
+                            it is raised to the statistical inefficiency of the reduced potentials after the burn-in, which is estimated on the
+                            schedule of the stopping criterion (the first snapshot is published after the first estimate)),
+         snapshot_burn_in: (<int, optional, default 0>; number of iterations that are discarded before snapshots are published),
+         n_snapshots: (<int, optional, default None>; if specified, stop once this many snapshots have been published to the snapshot_queue;
+                       n_iterations is then the maximum number of iterations),
+         randomize_velocities: (<bool, optional, default False>; whether to draw the initial velocities from the Maxwell-Boltzmann distribution
+                                (e.g. to decorrelate equilibrium replicas that start from the same configuration))
          }
 
     Returns
@@ -318,76 +488,110 @@ def run_equilibrium(task):
     #construct the MCMove:
     mc_move = mcmc.LangevinSplittingDynamicsMove(n_steps=inputs['nsteps_equil'], splitting=inputs['splitting'], timestep = inputs['timestep'])
     mc_move.n_restart_attempts = 10
+    if inputs.get('randomize_velocities', False):
+        #the first move reassigns the velocities
+        initial_mc_move = mcmc.LangevinSplittingDynamicsMove(n_steps=inputs['nsteps_equil'], splitting=inputs['splitting'], timestep = inputs['timestep'], reassign_velocities = True)
+        initial_mc_move.n_restart_attempts = 10
+    else:
+        initial_mc_move = mc_move
 
-    #create a numpy array for the trajectory
-    trajectory_positions, trajectory_box_lengths, trajectory_box_angles = list(), list(), list()
+    #create a streaming writer for the trajectory
     reduced_potentials = list()
-
-    #loop through iterations and apply MCMove, then collect positions into numpy array
+    if inputs['trajectory_filename'] is not None:
+        new_filename = inputs['trajectory_filename'][:-2] + f'{file_iterator:04}' + '.h5'
+        trajectory_writer = EquilibriumTrajectoryWriter(new_filename, subset_topology, buffer_size = inputs['max_size'])
+    else:
+        trajectory_writer = None
+
+    #create a timeseries estimator if we stop automatically
+    if inputs.get('n_uncorrelated_samples', None) is not None:
+        timeseries_estimator = StatisticalInefficiencyEstimator()
+        if inputs.get('reduced_potentials_history', None) is not None:
+            timeseries_estimator.update(inputs['reduced_potentials_history'])
+        stopping_interval = inputs.get('stopping_interval', 10)
+        next_stopping_check = next_check(len(timeseries_estimator), stopping_interval)
+    else:
+        timeseries_estimator = None
+
+    #publish snapshots for pipelined annealing: after the burn-in, and no more often than the statistical inefficiency of the reduced
+    #potentials, so that the published snapshots are equilibrated and effectively uncorrelated
+    snapshot_queue = inputs.get('snapshot_queue', None)
+    if snapshot_queue is not None:
+        snapshot_spacing, snapshot_burn_in = inputs.get('snapshot_spacing', 1), inputs.get('snapshot_burn_in', 0)
+        snapshot_estimation_interval = inputs.get('stopping_interval', 10)
+        next_snapshot_estimate = snapshot_estimation_interval
+        n_snapshots = inputs.get('n_snapshots', None)
+        snapshot_g = None
+        last_snapshot, n_published = None, 0
+
+    #loop through iterations and apply MCMove, then stream positions to disk
     _logger.debug(f"conducting {inputs['n_iterations']} of production")
     if timer: eq_times = []
+    start_run = time.time()
 
-    init_file_iterator = inputs['file_iterator']
-    for iteration in tqdm.trange(inputs['n_iterations']):
+    try:
+        for iteration in tqdm.trange(inputs['n_iterations']):
+            if timer: start = time.time()
+            _logger.debug(f"\tconducting iteration {iteration}")
+            (initial_mc_move if iteration == 0 else mc_move).apply(thermodynamic_state, sampler_state)
+
+            #add reduced potential to reduced_potential_final_frame_list
+            reduced_potential = thermodynamic_state.reduced_potential(sampler_state)
+            reduced_potentials.append(reduced_potential)
+
+            if trajectory_writer is not None:
+                trajectory_writer.append(sampler_state.positions[atom_indices, :].value_in_unit_system(unit.md_unit_system), sampler_state.box_vectors, reduced_potential)
+
+            if snapshot_queue is not None and iteration >= snapshot_burn_in:
+                if iteration + 1 - snapshot_burn_in >= next_snapshot_estimate:
+                    snapshot_g = statistical_inefficiency(reduced_potentials[snapshot_burn_in:])
+                    next_snapshot_estimate = next_check(iteration + 1 - snapshot_burn_in, snapshot_estimation_interval)
+                if snapshot_g is not None and (last_snapshot is None or iteration - last_snapshot >= max(snapshot_spacing, int(np.ceil(snapshot_g)))):
+                    snapshot_queue.put(SamplerState(copy.deepcopy(sampler_state.positions), box_vectors = copy.deepcopy(sampler_state.box_vectors)))
+                    last_snapshot, n_published = iteration, n_published + 1
+
+            if timer: eq_times.append(time.time() - start)
+
+            if timeseries_estimator is not None:
+                timeseries_estimator.update([reduced_potential])
+                #the criterion is checked on a geometric schedule, and only once enough samples exist to possibly satisfy it
+                if len(timeseries_estimator) >= next_stopping_check:
+                    next_stopping_check = next_check(len(timeseries_estimator), stopping_interval)
+                    if len(timeseries_estimator) >= inputs['n_uncorrelated_samples'] and timeseries_estimator.n_uncorrelated_samples >= inputs['n_uncorrelated_samples']:
+                        _logger.debug(f"\tcollected {timeseries_estimator.n_uncorrelated_samples} uncorrelated samples after {iteration + 1} iterations; stopping")
+                        break
+
+            if snapshot_queue is not None and n_snapshots is not None and n_published >= n_snapshots:
+                _logger.debug(f"\tpublished {n_published} snapshots after {iteration + 1} iterations (statistical inefficiency: {snapshot_g}); stopping")
+                break
+    finally:
+        #If there is a trajectory filename passed, flush the remaining frames here (even if a move fails):
         if timer: start = time.time()
-        _logger.debug(f"\tconducting iteration {iteration}")
-        mc_move.apply(thermodynamic_state, sampler_state)
-
-        #add reduced potential to reduced_potential_final_frame_list
-        reduced_potentials.append(thermodynamic_state.reduced_potential(sampler_state))
-
-        #trajectory_positions[iteration, :,:] = sampler_state.positions[atom_indices, :].value_in_unit_system(unit.md_unit_system)
-        trajectory_positions.append(sampler_state.positions[atom_indices, :].value_in_unit_system(unit.md_unit_system))
-
-        #get the box lengths and angles
-        a, b, c, alpha, beta, gamma = mdtrajutils.unitcell.box_vectors_to_lengths_and_angles(*sampler_state.box_vectors)
-        trajectory_box_lengths.append([a,b,c])
-        trajectory_box_angles.append([alpha, beta, gamma])
-
-        #if tajectory positions is too large, we have to write it to disk and start fresh
-        if np.array(trajectory_positions).nbytes > inputs['max_size']:
-            trajectory = md.Trajectory(np.array(trajectory_positions), subset_topology, unitcell_lengths=np.array(trajectory_box_lengths), unitcell_angles=np.array(trajectory_box_angles))
-            if inputs['trajectory_filename'] is not None:
-                new_filename = inputs['trajectory_filename'][:-2] + f'{file_iterator:04}' + '.h5'
-                file_numsnapshots.append((new_filename, len(trajectory_positions)))
-                file_iterator +=1
-                write_equilibrium_trajectory(trajectory, new_filename)
-
-                #re_initialize the trajectory positions, box_lengths, box_angles
-                trajectory_positions, trajectory_box_lengths, trajectory_box_angles = list(), list(), list()
-
-        if timer: eq_times.append(time.time() - start)
+        if trajectory_writer is not None:
+            trajectory_writer.close()
+        if timer: timers['write_traj'] = time.time() - start
 
     if timer: timers['run_eq'] = eq_times
     _logger.debug(f"production done")
 
-    #If there is a trajectory filename passed, write out the results here:
-    if timer: start = time.time()
-    if inputs['trajectory_filename'] is not None:
-        #construct trajectory object:
-        if trajectory_positions != list():
-            #if it is an empty list, then the last iteration satistifed max_size and wrote the trajectory to disk;
-            #in this case, we can just skip this
-            trajectory = md.Trajectory(np.array(trajectory_positions), subset_topology, unitcell_lengths=np.array(trajectory_box_lengths), unitcell_angles=np.array(trajectory_box_angles))
-            if file_iterator == init_file_iterator: #this means that no files have been written yet
-                new_filename = inputs['trajectory_filename'][:-2] + f'{file_iterator:04}' + '.h5'
-                file_numsnapshots.append((new_filename, len(trajectory_positions)))
-            else:
-                new_filename = inputs['trajectory_filename'][:-2] + f'{file_iterator+1:04}' + '.h5'
-                file_numsnapshots.append((new_filename, len(trajectory_positions)))
-            write_equilibrium_trajectory(trajectory, new_filename)
-
-    if timer: timers['write_traj'] = time.time() - start
+    if trajectory_writer is not None:
+        if trajectory_writer.n_frames > 0:
+            file_numsnapshots.append((new_filename, trajectory_writer.n_frames))
+        else:
+            os.remove(new_filename) #do not leave empty trajectory files behind
 
     if not timer:
         timers = {}
 
-    out_task = EquilibriumFEPTask(sampler_state = sampler_state, inputs = task.inputs, outputs = {'reduced_potentials': reduced_potentials, 'files': file_numsnapshots, 'timers': timers})
+    #the snapshot queue is not returned to the driver
+    out_inputs = {key: val for key, val in task.inputs.items() if key != 'snapshot_queue'}
+    out_task = EquilibriumFEPTask(sampler_state = sampler_state, inputs = out_inputs, outputs = {'reduced_potentials': reduced_potentials, 'files': file_numsnapshots, 'timers': timers, 'wall_time': time.time() - start_run})
     return out_task
 
 def write_equilibrium_trajectory(trajectory: md.Trajectory, trajectory_filename: str) -> float:
     """
     Write the results of an equilibrium simulation to disk. This task will append the results to the given filename.
+    Frames are appended to the extendable datasets of an existing file in place; the file is never re-read or rewritten.
 
     Arguments
     ----------
@@ -405,12 +609,259 @@ def write_equilibrium_trajectory(trajectory: md.Trajectory, trajectory_filename:
         _logger.debug(f"{trajectory_filename} does not exist; instantiating and writing to.")
     else:
         _logger.debug(f"{trajectory_filename} exists; appending.")
-        written_traj = md.load_hdf5(trajectory_filename)
-        concatenated_traj = written_traj.join(trajectory)
-        concatenated_traj.save_hdf5(trajectory_filename)
+        with tables.open_file(trajectory_filename, mode = 'r') as handle:
+            _periodic = 'cell_lengths' in handle.root if 'coordinates' in handle.root else None
+        if _periodic is not None and _periodic != (trajectory.unitcell_lengths is not None):
+            raise Exception(f"cannot append a {'periodic' if trajectory.unitcell_lengths is not None else 'nonperiodic'} trajectory to the {'periodic' if _periodic else 'nonperiodic'} trajectory {trajectory_filename}")
+        with md.formats.HDF5TrajectoryFile(trajectory_filename, mode = 'a') as trajectory_file:
+            trajectory_file.write(coordinates = trajectory.xyz,
+                                  time = trajectory.time,
+                                  cell_lengths = trajectory.unitcell_lengths,
+                                  cell_angles = trajectory.unitcell_angles)
 
     return True
 
+class EquilibriumTrajectoryWriter():
+    """
+    Append-only writer for equilibrium trajectories.
+    Positions, box (unitcell lengths and angles), and reduced potentials are collected in a preallocated in-memory buffer and
+    appended to extendable HDF5 datasets (mdtraj HDF5 format) whenever the buffer exceeds a byte threshold, so the cost of writing
+    is linear in the number of frames.  The file is only open while a buffer is flushed, so it is complete and readable between flushes.
+    """
+    def __init__(self, filename, topology, buffer_size = 1024*1e3, append = False):
+        """
+        Arguments
+        ---------
+        filename : str
+            mdtraj hdf5 trajectory filename
+        topology : mdtraj.Topology
+            topology of the (subset) atoms that are written
+        buffer_size : float, default 1.024e6 (bytes)
+            number of bytes of positions to buffer in memory before flushing to disk
+        append : bool, default False
+            whether to append to the file if it exists; otherwise, the file is overwritten
+        """
+        self.filename = filename
+        self.topology = topology
+        self._periodic = None
+        if append and os.path.exists(filename):
+            with tables.open_file(filename, mode = 'r') as handle:
+                self._n_written = len(handle.root.coordinates) if 'coordinates' in handle.root else 0
+                if self._n_written > 0:
+                    self._periodic = 'cell_lengths' in handle.root
+        else:
+            with md.formats.HDF5TrajectoryFile(filename, mode = 'w') as trajectory_file:
+                trajectory_file.topology = topology
+            self._n_written = 0
+
+        #preallocate the buffer
+        frame_size = topology.n_atoms * 3 * np.dtype(np.float32).itemsize
+        self._capacity = max(1, int(buffer_size // frame_size))
+        self._positions = np.zeros((self._capacity, topology.n_atoms, 3), dtype = np.float32)
+        self._box_lengths = np.zeros((self._capacity, 3), dtype = np.float32)
+        self._box_angles = np.zeros((self._capacity, 3), dtype = np.float32)
+        self._reduced_potentials = np.zeros(self._capacity, dtype = np.float64)
+        self._n_buffered = 0
+        self.n_flushes = 0
+
+    @property
+    def n_frames(self):
+        """
+        total number of frames appended (written and buffered)
+        """
+        return self._n_written + self._n_buffered
+
+    def append(self, positions, box_vectors, reduced_potential):
+        """
+        Append a single frame to the buffer, flushing to disk if the buffer is full.
+
+        Arguments
+        ---------
+        positions : np.array of shape (n_atoms, 3)
+            unitless positions (in nanometers) of the subset atoms
+        box_vectors : simtk.unit.Quantity of shape (3,3) or None
+            box vectors of the frame; None if the system is nonperiodic
+        reduced_potential : float
+            reduced potential of the frame
+        """
+        _periodic = box_vectors is not None
+        if self._periodic is None:
+            self._periodic = _periodic
+        elif self._periodic != _periodic:
+            raise Exception(f"cannot append a {'periodic' if _periodic else 'nonperiodic'} frame to the {'periodic' if self._periodic else 'nonperiodic'} trajectory {self.filename}")
+
+        self._positions[self._n_buffered] = positions
+        if _periodic:
+            a, b, c, alpha, beta, gamma = mdtrajutils.unitcell.box_vectors_to_lengths_and_angles(*box_vectors)
+            self._box_lengths[self._n_buffered] = [a, b, c]
+            self._box_angles[self._n_buffered] = [alpha, beta, gamma]
+        self._reduced_potentials[self._n_buffered] = reduced_potential
+        self._n_buffered += 1
+        if self._n_buffered == self._capacity:
+            self.flush()
+
+    def flush(self):
+        """
+        Append the buffered frames to the extendable datasets on disk and empty the buffer.
+        """
+        if self._n_buffered == 0:
+            return
+        n = self._n_buffered
+        with md.formats.HDF5TrajectoryFile(self.filename, mode = 'a') as trajectory_file:
+            trajectory_file.write(coordinates = self._positions[:n],
+                                  time = np.arange(self._n_written, self._n_written + n, dtype = np.float32),
+                                  cell_lengths = self._box_lengths[:n] if self._periodic else None,
+                                  cell_angles = self._box_angles[:n] if self._periodic else None)
+
+        #reduced potentials are not part of the mdtraj schema, so they get their own extendable array
+        with tables.open_file(self.filename, mode = 'a') as handle:
+            if 'reduced_potentials' not in handle.root:
+                handle.create_earray(handle.root, 'reduced_potentials', atom = tables.Float64Atom(), shape = (0,))
+            handle.root.reduced_potentials.append(self._reduced_potentials[:n])
+
+        self._n_written += n
+        self._n_buffered = 0
+        self.n_flushes += 1
+
+    def close(self):
+        """
+        Flush the remaining buffered frames.
+        """
+        self.flush()
+
+class SnapshotPool():
+    """
+    Indexed pool of decorrelated equilibrium snapshots from which annealing particles are initialized.
+    The pool is built once (after equilibration) and holds a global index of pool frame -> (file, offset).
+    Only the pooled rows of each (mdtraj hdf5) file are read, lazily and with a single indexed read per file,
+    so drawing N snapshots costs at most one read per file rather than N file opens, and unpooled frames never enter memory.
+    """
+    def __init__(self, file_numsnapshots, decorrelated_indices, atom_indices = None):
+        """
+        Arguments
+        ---------
+        file_numsnapshots : list of tuple(str, int)
+            list of (filename, number of snapshots in the file) in the order in which the files were written (see run_equilibrium)
+        decorrelated_indices : list of int
+            global indices (counted contiguously across the files in file_numsnapshots) of the snapshots to pool
+        atom_indices : list of int, default None
+            atom indices to load; if None, all atoms are loaded
+        """
+        self.atom_indices = atom_indices
+        self._filenames = [filename for filename, _ in file_numsnapshots]
+
+        #global frame index: pool frame -> (file index, offset within file)
+        file_starts = np.cumsum([0] + [num_snapshots for _, num_snapshots in file_numsnapshots])
+        decorrelated_indices = np.sort(np.asarray(decorrelated_indices, dtype = np.int64))
+        assert len(decorrelated_indices) == 0 or decorrelated_indices[-1] < file_starts[-1], f"decorrelated index {decorrelated_indices[-1]} exceeds the number of written snapshots ({file_starts[-1]})"
+        self._file_indices = np.searchsorted(file_starts, decorrelated_indices, side = 'right') - 1
+        self._offsets = decorrelated_indices - file_starts[self._file_indices]
+
+        #in-memory frames of each loaded file (only the pooled offsets are retained) and the row of each pool frame within its block
+        self._positions = {}
+        self._box_vectors = {}
+        self._rows = np.zeros(len(self._offsets), dtype = np.int64)
+
+        #diagnostics
+        self._n_draws = 0
+        self._n_file_reads = 0
+        self._draw_counts = np.zeros(len(self._offsets), dtype = np.int64)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def _load_file(self, file_index):
+        """
+        bulk-load the pooled frames (and atoms) of a file into memory with a single read; the other frames are never read
+        """
+        pool_indices = np.where(self._file_indices == file_index)[0]
+        offsets = np.unique(self._offsets[pool_indices]) #indexed reads require increasing, unique rows
+        with tables.open_file(self._filenames[file_index], mode = 'r') as handle:
+            positions = handle.root.coordinates[offsets, :, :]
+            if 'cell_lengths' in handle.root:
+                cell_lengths, cell_angles = handle.root.cell_lengths[offsets, :], handle.root.cell_angles[offsets, :]
+            else:
+                cell_lengths, cell_angles = None, None
+        self._n_file_reads += 1
+
+        self._positions[file_index] = positions if self.atom_indices is None else positions[:, self.atom_indices, :]
+        if cell_lengths is not None:
+            a, b, c = mdtrajutils.unitcell.lengths_and_angles_to_box_vectors(*cell_lengths.T, *cell_angles.T)
+            self._box_vectors[file_index] = np.stack([a, b, c], axis = 1)
+        else:
+            self._box_vectors[file_index] = None
+        self._rows[pool_indices] = np.searchsorted(offsets, self._offsets[pool_indices])
+
+    def draw(self, num_snapshots, replace = True):
+        """
+        Draw snapshots uniformly at random from the pool.
+        Like the rest of SequentialMonteCarlo, this draws from the python `random` generator.
+
+        Arguments
+        ---------
+        num_snapshots : int
+            number of snapshots to draw
+        replace : bool, default True
+            whether to draw with replacement
+
+        Returns
+        -------
+        sampler_states : np.array of openmmtools.states.SamplerState
+            sampler states with positions and box vectors (if applicable)
+        """
+        assert len(self) > 0, f"the snapshot pool is empty"
+        if replace:
+            pool_indices = [random.randrange(len(self)) for _ in range(num_snapshots)]
+        else:
+            pool_indices = random.sample(range(len(self)), num_snapshots)
+        return self.get(pool_indices)
+
+    def get(self, pool_indices):
+        """
+        Retrieve sampler states for the given pool indices; each file is read at most once.
+
+        Arguments
+        ---------
+        pool_indices : np.array of int
+            indices of the pool frames to retrieve
+
+        Returns
+        -------
+        sampler_states : np.array of openmmtools.states.SamplerState
+            sampler states with positions and box vectors (if applicable)
+        """
+        pool_indices = np.asarray(pool_indices, dtype = np.int64)
+        for file_index in np.unique(self._file_indices[pool_indices]):
+            if file_index not in self._positions:
+                self._load_file(file_index)
+
+        sampler_states = []
+        for pool_index in pool_indices:
+            file_index, row = self._file_indices[pool_index], self._rows[pool_index]
+            positions = self._positions[file_index][row] * unit.nanometers
+            box_vectors = self._box_vectors[file_index][row] * unit.nanometers if self._box_vectors[file_index] is not None else None
+            sampler_states.append(SamplerState(positions, box_vectors = box_vectors))
+
+        np.add.at(self._draw_counts, pool_indices, 1)
+        self._n_draws += len(pool_indices)
+        return np.array(sampler_states)
+
+    @property
+    def statistics(self):
+        """
+        Returns
+        -------
+        statistics : dict
+            pool diagnostics (number of pooled frames and files, file reads, draws, and the spread of draws across frames)
+        """
+        return {'n_frames': len(self),
+                'n_files': len(self._filenames),
+                'frames_per_file': {filename: int(np.sum(self._file_indices == file_index)) for file_index, filename in enumerate(self._filenames)},
+                'n_file_reads': self._n_file_reads,
+                'n_draws': self._n_draws,
+                'n_unique_frames_drawn': int(np.sum(self._draw_counts > 0)),
+                'max_draws_per_frame': int(self._draw_counts.max()) if len(self) > 0 else 0}
+
 def write_nonequilibrium_trajectory(nonequilibrium_trajectory, trajectory_filename):
     """
     Write the results of a nonequilibrium switching trajectory to a file. The trajectory is written to an
@@ -432,6 +883,188 @@ def write_nonequilibrium_trajectory(nonequilibrium_trajectory, trajectory_filena
 
     return True
 
+class NonequilibriumTrajectoryWriter():
+    """
+    Chunked writer for nonequilibrium (annealing) trajectories.
+    Saved frames are collected in a preallocated buffer of chunk_size frames that is appended to extendable (compressed) HDF5 datasets
+    in the mdtraj HDF5 layout whenever it fills, so the memory of a worker is bounded by chunk_size frames regardless of the protocol length.
+    Positions may optionally be quantized:
+        - 'float16' stores half-precision positions (readable with mdtraj.load_hdf5)
+        - a float precision (in nanometers) stores positions as integer multiples of the precision (readable with read_nonequilibrium_trajectory)
+    """
+    def __init__(self, filename, topology, periodic = True, chunk_size = 100, quantization = None):
+        """
+        Arguments
+        ---------
+        filename : str
+            mdtraj hdf5 trajectory filename; an existing file is overwritten
+        topology : mdtraj.Topology
+            topology of the (subset) atoms that are written
+        periodic : bool, default True
+            whether box vectors are written
+        chunk_size : int, default 100
+            number of frames buffered in memory before they are appended to disk
+        quantization : str or float, default None
+            None (float32), 'float16', or the fixed precision (in nanometers) of the positions
+        """
+        if quantization is None:
+            _atom, _dtype = tables.Float32Atom(), np.float32
+        elif quantization == 'float16':
+            _atom, _dtype = tables.Float16Atom(), np.float16
+        elif isinstance(quantization, float) and quantization > 0.:
+            _atom, _dtype = tables.Int32Atom(), np.int32
+        else:
+            raise Exception(f"quantization {quantization} is not supported; use None, 'float16', or a positive float precision (nanometers)")
+        self.filename = filename
+        self.periodic = periodic
+        self.quantization = quantization
+
+        #the topology is written by mdtraj; the extendable datasets are appended to with PyTables
+        with md.formats.HDF5TrajectoryFile(filename, mode = 'w') as trajectory_file:
+            trajectory_file.topology = topology
+        _filters = tables.Filters(complevel = 1, complib = 'zlib', shuffle = True)
+        with tables.open_file(filename, mode = 'a') as handle:
+            coordinates = handle.create_earray(handle.root, 'coordinates', atom = _atom, shape = (0, topology.n_atoms, 3), filters = _filters)
+            coordinates.attrs['units'] = 'nanometers'
+            if isinstance(quantization, float):
+                coordinates.attrs['precision'] = quantization
+            handle.create_earray(handle.root, 'time', atom = tables.Float32Atom(), shape = (0,)).attrs['units'] = 'picoseconds'
+            if periodic:
+                handle.create_earray(handle.root, 'cell_lengths', atom = tables.Float32Atom(), shape = (0, 3)).attrs['units'] = 'nanometers'
+                handle.create_earray(handle.root, 'cell_angles', atom = tables.Float32Atom(), shape = (0, 3)).attrs['units'] = 'degrees'
+
+        #preallocate the buffer
+        self._capacity = max(1, int(chunk_size))
+        self._positions = np.zeros((self._capacity, topology.n_atoms, 3), dtype = _dtype)
+        self._time = np.zeros(self._capacity, dtype = np.float32)
+        self._box_lengths = np.zeros((self._capacity, 3), dtype = np.float32)
+        self._box_angles = np.zeros((self._capacity, 3), dtype = np.float32)
+        self._n_buffered = 0
+        self._n_written = 0
+        self.n_flushes = 0
+
+    @property
+    def n_frames(self):
+        """
+        total number of frames appended (written and buffered)
+        """
+        return self._n_written + self._n_buffered
+
+    def append(self, positions, box_vectors = None, time = None):
+        """
+        Append a single frame to the buffer, flushing to disk if the buffer is full.
+
+        Arguments
+        ---------
+        positions : np.array of shape (n_atoms, 3)
+            unitless positions (in nanometers) of the subset atoms
+        box_vectors : np.array of shape (3,3), default None
+            unitless box vectors (in nanometers) of the frame; required if the writer is periodic
+        time : float, default None
+            time (or protocol index) of the frame; if None, the frame index is used
+        """
+        if isinstance(self.quantization, float):
+            self._positions[self._n_buffered] = np.round(positions / self.quantization)
+        else:
+            self._positions[self._n_buffered] = positions
+        self._time[self._n_buffered] = self.n_frames if time is None else time
+        if self.periodic:
+            a, b, c, alpha, beta, gamma = mdtrajutils.unitcell.box_vectors_to_lengths_and_angles(*box_vectors)
+            self._box_lengths[self._n_buffered] = [a, b, c]
+            self._box_angles[self._n_buffered] = [alpha, beta, gamma]
+        self._n_buffered += 1
+        if self._n_buffered == self._capacity:
+            self.flush()
+
+    def flush(self):
+        """
+        Append the buffered frames to the extendable datasets on disk and empty the buffer.
+        """
+        if self._n_buffered == 0:
+            return
+        n = self._n_buffered
+        with tables.open_file(self.filename, mode = 'a') as handle:
+            handle.root.coordinates.append(self._positions[:n])
+            handle.root.time.append(self._time[:n])
+            if self.periodic:
+                handle.root.cell_lengths.append(self._box_lengths[:n])
+                handle.root.cell_angles.append(self._box_angles[:n])
+        self._n_written += n
+        self._n_buffered = 0
+        self.n_flushes += 1
+
+    def close(self):
+        """
+        Flush the remaining buffered frames.
+        """
+        self.flush()
+
+def read_nonequilibrium_trajectory(trajectory_filename):
+    """
+    Read a nonequilibrium trajectory written by NonequilibriumTrajectoryWriter (or write_nonequilibrium_trajectory), dequantizing fixed-precision positions.
+
+    Arguments
+    ---------
+    trajectory_filename : str
+        The full filepath of the trajectory
+
+    Returns
+    -------
+    trajectory : md.Trajectory
+        the nonequilibrium trajectory
+    """
+    with tables.open_file(trajectory_filename, mode = 'r') as handle:
+        coordinates = handle.root.coordinates
+        precision = coordinates.attrs['precision'] if 'precision' in coordinates.attrs._v_attrnames else None
+    if precision is None:
+        return md.load_hdf5(trajectory_filename)
+
+    with md.formats.HDF5TrajectoryFile(trajectory_filename, mode = 'r') as trajectory_file:
+        topology = trajectory_file.topology
+    with tables.open_file(trajectory_filename, mode = 'r') as handle:
+        xyz = handle.root.coordinates[:].astype(np.float32) * precision
+        time = handle.root.time[:]
+        cell_lengths = handle.root.cell_lengths[:] if 'cell_lengths' in handle.root else None
+        cell_angles = handle.root.cell_angles[:] if 'cell_angles' in handle.root else None
+    return md.Trajectory(xyz, topology, time = time, unitcell_lengths = cell_lengths, unitcell_angles = cell_angles)
+
+def write_checkpoint(checkpoint, checkpoint_filename):
+    """
+    Atomically write a checkpoint of a SequentialMonteCarlo run; the checkpoint is pickled to a temporary file that replaces
+    checkpoint_filename only once it is complete, so an interruption never leaves a partially-written checkpoint.
+
+    Arguments
+    ---------
+    checkpoint : dict
+        the (picklable) state of the run
+    checkpoint_filename : str
+        the full filepath of the checkpoint
+    """
+    tmp_filename = checkpoint_filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        pickle.dump(checkpoint, f, protocol = pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, checkpoint_filename)
+
+def read_checkpoint(checkpoint_filename):
+    """
+    Read a checkpoint written by write_checkpoint.
+
+    Arguments
+    ---------
+    checkpoint_filename : str
+        the full filepath of the checkpoint
+
+    Returns
+    -------
+    checkpoint : dict
+        the state of the run
+    """
+    with open(checkpoint_filename, 'rb') as f:
+        checkpoint = pickle.load(f)
+    return checkpoint
+
 def compute_reduced_potential(thermodynamic_state: states.ThermodynamicState, sampler_state: states.SamplerState) -> float:
     """
     Compute the reduced potential of the given SamplerState under the given ThermodynamicState.
@@ -527,7 +1160,10 @@ def activate_LocallyOptimalAnnealing(thermodynamic_state,
                                      subset_atoms = None,
                                      measure_shadow_work = False,
                                      integrator = 'langevin',
-                                     compute_endstate_correction = True):
+                                     compute_endstate_correction = True,
+                                     work_in_context = False,
+                                     trajectory_chunk_size = 100,
+                                     trajectory_quantization = None):
     """
     Function to set worker attributes for annealing.
     """
@@ -550,7 +1186,10 @@ def activate_LocallyOptimalAnnealing(thermodynamic_state,
                                              subset_atoms = subset_atoms,
                                              measure_shadow_work = measure_shadow_work,
                                              integrator = integrator,
-                                             compute_endstate_correction = compute_endstate_correction)
+                                             compute_endstate_correction = compute_endstate_correction,
+                                             work_in_context = work_in_context,
+                                             trajectory_chunk_size = trajectory_chunk_size,
+                                             trajectory_quantization = trajectory_quantization)
 
 def deactivate_worker_attributes(remote_worker):
     """
@@ -576,7 +1215,8 @@ def call_anneal_method(remote_worker,
                        return_timer = False,
                        return_sampler_state = False,
                        rethermalize = False,
-                       compute_incremental_work = True):
+                       compute_incremental_work = True,
+                       random_seed = None):
     """
     this function calls LocallyOptimalAnnealing.anneal;
     since we can only map functions with parallelisms (no actors), we need to submit a function that calls
@@ -594,9 +1234,319 @@ def call_anneal_method(remote_worker,
                                                                                       return_timer = return_timer,
                                                                                       return_sampler_state = return_sampler_state,
                                                                                       rethermalize = rethermalize,
-                                                                                      compute_incremental_work = compute_incremental_work)
+                                                                                      compute_incremental_work = compute_incremental_work,
+                                                                                      random_seed = random_seed)
     return incremental_work, new_sampler_state, timer, _pass, endstate_corrections
 
+def call_anneal_method_chunk(remote_worker,
+                             sampler_states,
+                             lambdas,
+                             noneq_trajectory_filenames,
+                             num_integration_steps = 1,
+                             return_timer = False,
+                             return_sampler_state = False,
+                             rethermalize = False,
+                             compute_incremental_work = True,
+                             random_seed = None):
+    """
+    this function calls call_anneal_method on a chunk of particles (resident on the same worker) in a single task
+    so that short annealing segments do not pay the scheduling overhead once per particle.
+
+    Returns
+    -------
+    results : list of tuple
+        the call_anneal_method returnables of each particle in the chunk
+    task_time : float
+        the time (seconds) spent annealing inside the task
+    task_timing : dict
+        the wall clock 'start' and 'end' of the task, and the 'executor' (host, process, thread) that ran it (see ParticleChunker)
+    """
+    start_timer = time.time()
+    results = [call_anneal_method(remote_worker,
+                                  sampler_state,
+                                  lambdas,
+                                  noneq_trajectory_filename = noneq_trajectory_filename,
+                                  num_integration_steps = num_integration_steps,
+                                  return_timer = return_timer,
+                                  return_sampler_state = return_sampler_state,
+                                  rethermalize = rethermalize,
+                                  compute_incremental_work = compute_incremental_work,
+                                  random_seed = random_seed) for sampler_state, noneq_trajectory_filename in zip(sampler_states, noneq_trajectory_filenames)]
+    end_timer = time.time()
+    return results, end_timer - start_timer, {'start': start_timer, 'end': end_timer, 'executor': (socket.gethostname(), os.getpid(), threading.get_ident())}
+
+class ParticleChunker():
+    """
+    Choose the number of particles that are annealed in a single task.
+    The scheduling (and serialization) overhead of every task is measured from its timings: the delay from its submission to its start
+    (not counting the time its executor spends on earlier tasks), and the delay from its end to its collection by the driver.  Tasks are
+    recorded in measurement windows (e.g. one per direction, when the directions are collected asynchronously).  With automatic chunking,
+    the chunk size is the smallest one for which the per-task overhead is at most overhead_tolerance of the time the task spends annealing,
+    but no larger than is needed to give every worker a chunk.  Worker and driver clocks are compared directly, so they should be synchronized.
+    """
+    def __init__(self, num_particles, num_workers, chunk_size = 'auto', overhead_tolerance = 0.1):
+        """
+        Arguments
+        ---------
+        num_particles : int
+            number of particles per direction
+        num_workers : int
+            number of workers that the chunks are distributed to
+        chunk_size : int or 'auto', default 'auto'
+            number of particles per task; if 'auto', it is tuned after every measurement window (starting at 1)
+        overhead_tolerance : float, default 0.1
+            maximum ratio of per-task overhead to per-task annealing time targeted by automatic chunking
+        """
+        assert chunk_size == 'auto' or (type(chunk_size) == int and chunk_size > 0), f"chunk_size must be a positive int or 'auto'"
+        self.num_particles = num_particles
+        self.num_workers = max(num_workers, 1)
+        self.auto = chunk_size == 'auto'
+        self.chunk_size = 1 if self.auto else min(chunk_size, num_particles)
+        self.overhead_tolerance = overhead_tolerance
+        self.particle_overheads = [] #the effective per-particle overhead of each measurement window
+        self._windows = {} #window : list of (num_particles, task_time, task timings, collection time) of the recorded chunks
+        self._executor_tasks = {} #executor : the (start, end) of its latest recorded tasks
+
+    def chunk(self, items):
+        """
+        split per-particle items into chunks of at most chunk_size
+        """
+        return [items[index:index + self.chunk_size] for index in range(0, len(items), self.chunk_size)]
+
+    def record(self, num_particles, task_time, timings, window = None):
+        """
+        record a chunk of num_particles that spent task_time (seconds) annealing, as it is collected
+
+        Arguments
+        ---------
+        num_particles : int
+            number of particles of the chunk
+        task_time : float
+            time (seconds) that the tasks of the chunk spent annealing
+        timings : list of dict
+            the 'submitted', 'start', 'end' and 'executor' of every task of the chunk (see AnnealingSupervisor)
+        window : object, default None
+            the measurement window of the chunk
+        """
+        self._windows.setdefault(window, []).append((num_particles, task_time, timings, time.time()))
+        for timing in timings:
+            self._executor_tasks.setdefault(timing['executor'], deque(maxlen = 1000)).append((timing['start'], timing['end']))
+
+    def update(self, window = None):
+        """
+        close a measurement window, compute its effective per-particle overhead, and (if automatic) tune the chunk size
+
+        Arguments
+        ---------
+        window : object, default None
+            the measurement window to close
+
+        Returns
+        -------
+        particle_overhead : float
+            the effective per-particle overhead (seconds) of the window; None if no chunks were recorded in it
+        """
+        records = self._windows.pop(window, [])
+        if len(records) == 0:
+            return None
+        overhead, num_tasks = 0., 0
+        for (_, _, timings, collected) in records:
+            for timing in timings:
+                #a task that waits for its executor to finish earlier tasks is queued, not delayed by scheduling
+                ready = max([timing['submitted']] + [end for (start, end) in self._executor_tasks[timing['executor']] if end <= timing['start']])
+                overhead += max(timing['start'] - ready, 0.) + max(collected - timing['end'], 0.)
+                num_tasks += 1
+        busy_time = sum(task_time for (_, task_time, _, _) in records)
+        num_particles = sum(_num_particles for (_num_particles, _, _, _) in records)
+        particle_overhead = overhead / num_particles
+        self.particle_overheads.append(particle_overhead)
+
+        if self.auto and busy_time > 0.:
+            particle_time = busy_time / num_particles
+            task_overhead = overhead / num_tasks
+            target_chunk_size = int(np.ceil(task_overhead / (self.overhead_tolerance * particle_time)))
+            max_chunk_size = int(np.ceil(self.num_particles / self.num_workers))
+            self.chunk_size = min(max(target_chunk_size, 1), max_chunk_size)
+            _logger.debug(f"particle time: {particle_time}; task overhead: {task_overhead}; chunk size: {self.chunk_size}")
+
+        return particle_overhead
+
+class AnnealingSupervisor():
+    """
+    Supervise the annealing jobs (chunks of particles, see call_anneal_method_chunk) of a SequentialMonteCarlo run.
+    Particles that fail (annealing returns _pass = False, or the task raises) are restarted from the configuration they were deployed with,
+    but along a fresh trajectory (velocities redrawn with a new random seed).  Jobs that have executed for longer than straggler_factor times the
+    straggler_percentile of the per-particle execution times of completed jobs (scaled to the job size) are speculatively re-executed on an idle
+    worker; whichever copy finishes first is kept and the other is cancelled.  Execution times exclude the time a job waits to be scheduled:
+    completed jobs report their own task time, and running jobs are timed from when a worker is first seen executing them.
+    Every restart, speculation (and which copy won), and error is recorded in events.
+    """
+    def __init__(self,
+                 parallelism,
+                 speculation = True,
+                 straggler_percentile = 90.,
+                 straggler_factor = 2.,
+                 min_latencies = 10,
+                 max_restarts = 3,
+                 poll_interval = 0.05):
+        """
+        Arguments
+        ---------
+        parallelism : perses.dispersed.parallel.Parallelism
+            the parallelism that the jobs are deployed with
+        speculation : bool, default True
+            whether to speculatively re-execute stragglers
+        straggler_percentile : float, default 90.
+            percentile of the per-particle latencies of completed jobs that defines the expected latency
+        straggler_factor : float, default 2.
+            a job is a straggler once it has run for straggler_factor times its expected latency
+        min_latencies : int, default 10
+            number of completed jobs before stragglers are identified
+        max_restarts : int, default 3
+            maximum number of times a failed particle is restarted before an Exception is raised
+        poll_interval : float, default 0.05
+            seconds between polls of the running jobs
+        """
+        self.parallelism = parallelism
+        self.speculation = speculation
+        self.straggler_percentile = straggler_percentile
+        self.straggler_factor = straggler_factor
+        self.min_latencies = min_latencies
+        self.max_restarts = max_restarts
+        self.poll_interval = poll_interval
+        self.events = []
+        self._latencies = [] #per-particle execution times of completed jobs
+        self._jobs = {} #running jobs
+        self._job_counter = 0
+        self._tags = {} #the particle results of each tag
+        self._ready = deque()
+        self._random = random.Random() #fresh seeds do not perturb the (checkpointed) driver random states
+
+    def add(self, tag, future, particles, resubmit):
+        """
+        supervise a deployed job
+
+        Arguments
+        ---------
+        tag : object
+            identifies the job to the caller; (tag, (results, task_time, timings)) is yielded once all of its particles have passed, where
+            timings are the task timings (see call_anneal_method_chunk) of the job and its restarts, with the time they were 'submitted'
+        future : <generalized> future
+            the future of the call_anneal_method_chunk deployment over particles
+        particles : list of int
+            the particle indices that are annealed by the job
+        resubmit : function
+            resubmit(particles, random_seed, workers, speculative) deploys call_anneal_method_chunk over (a subset of) the particles and returns
+            its future; random_seed is None for a speculative copy, workers is None unless the copy must run on specific workers, and a
+            speculative copy must not write to the trajectory files of the job it duplicates
+        """
+        self._tags[tag] = {'particles': list(particles), 'results': {}, 'task_time': 0., 'timings': []}
+        self._submit(tag, future, list(particles), resubmit, restarts = 0)
+
+    def _submit(self, tag, future, particles, resubmit, restarts):
+        job = {'tag': tag, 'futures': [future], 'particles': particles, 'resubmit': resubmit, 'restarts': restarts, 'start': None, 'submitted': time.time()}
+        if self.parallelism.client is None:
+            self._process(job, future) #local futures are results
+        else:
+            self._jobs[self._job_counter] = job
+            self._job_counter += 1
+
+    def _record(self, event, tag, particles, **kwargs):
+        _event = {'event': event, 'tag': tag, 'particles': list(particles), 'time': time.time()}
+        _event.update(kwargs)
+        _logger.info(f"annealing supervision event: {_event}")
+        self.events.append(_event)
+
+    def _process(self, job, result):
+        """
+        record the results of a finished job and restart its failed particles
+        """
+        tag, particles = job['tag'], job['particles']
+        if result is None: #the task raised
+            _results = [None] * len(particles)
+        else:
+            _results, task_time, task_timing = result
+            self._tags[tag]['task_time'] += task_time
+            self._tags[tag]['timings'].append(dict(task_timing, submitted = job['submitted']))
+            self._latencies.append(task_time / len(particles))
+
+        failed_particles = []
+        for particle, _result in zip(particles, _results):
+            if _result is not None and _result[3]:
+                self._tags[tag]['results'][particle] = _result
+            else:
+                failed_particles.append(particle)
+
+        if len(failed_particles) > 0:
+            if job['restarts'] >= self.max_restarts:
+                self._record('failure', tag, failed_particles)
+                raise Exception(f"particles {failed_particles} of {tag} failed after {self.max_restarts} restarts")
+            random_seed = self._random.randint(0, 2**31 - 1)
+            self._record('restart', tag, failed_particles, random_seed = random_seed, restart = job['restarts'] + 1)
+            self._submit(tag, job['resubmit'](failed_particles, random_seed, None, False), failed_particles, job['resubmit'], job['restarts'] + 1)
+        elif len(self._tags[tag]['results']) == len(self._tags[tag]['particles']):
+            _tag = self._tags.pop(tag)
+            self._ready.append((tag, ([_tag['results'][particle] for particle in _tag['particles']], _tag['task_time'], _tag['timings'])))
+
+    def _poll(self):
+        """
+        process the finished jobs and speculatively re-execute the stragglers
+        """
+        for job_id, job in list(self._jobs.items()):
+            finished = [future for future in job['futures'] if future.done()]
+            if len(finished) == 0:
+                continue
+            del self._jobs[job_id]
+            future = ([_future for _future in finished if _future.status == 'finished'] + finished)[0]
+            for _future in job['futures']:
+                if _future is not future:
+                    _future.cancel()
+            if len(job['futures']) > 1:
+                self._record('speculation_resolved', job['tag'], job['particles'], winner = 'original' if future is job['futures'][0] else 'speculative')
+            if future.status == 'finished':
+                result = future.result()
+            else:
+                self._record('error', job['tag'], job['particles'], exception = repr(future.exception()))
+                result = None
+            self._process(job, result)
+
+        if self.speculation:
+            #time the running jobs from when they start executing, so that jobs queued behind others are not taken for stragglers
+            waiting_jobs = [job for job in self._jobs.values() if job['start'] is None]
+            if len(waiting_jobs) > 0:
+                for job, executing in zip(waiting_jobs, self.parallelism.executing([job['futures'][0] for job in waiting_jobs])):
+                    if executing:
+                        job['start'] = time.time()
+
+        if self.speculation and len(self._latencies) >= self.min_latencies:
+            latency = self.straggler_factor * np.percentile(self._latencies, self.straggler_percentile)
+            idle_workers = self.parallelism.idle_workers()
+            for job in self._jobs.values():
+                if len(idle_workers) == 0:
+                    break
+                if len(job['futures']) == 1 and job['start'] is not None and time.time() - job['start'] > latency * len(job['particles']):
+                    worker = idle_workers.pop()
+                    job['futures'].append(job['resubmit'](job['particles'], None, [worker], True))
+                    self._record('speculation', job['tag'], job['particles'], worker = worker)
+
+    def __len__(self):
+        """
+        the number of tags that have not been yielded
+        """
+        return len(self._tags) + len(self._ready)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while len(self._ready) == 0:
+            if len(self._jobs) == 0:
+                raise StopIteration
+            self._poll()
+            if len(self._ready) == 0:
+                time.sleep(self.poll_interval)
+        return self._ready.popleft()
+
 
 
 class LocallyOptimalAnnealing():
@@ -619,10 +1569,27 @@ class LocallyOptimalAnnealing():
                    subset_atoms = None,
                    measure_shadow_work = False,
                    integrator = 'langevin',
-                   compute_endstate_correction = True):
+                   compute_endstate_correction = True,
+                   work_in_context = False,
+                   trajectory_chunk_size = 100,
+                   trajectory_quantization = None):
+        """
+        Create the integrator, lambda protocol, and (optionally) endstates for annealing.
 
+        Arguments
+        ---------
+        work_in_context : bool, default False
+            whether to accumulate the protocol work from the potential energies of the context (see compute_incremental_work_in_context)
+            rather than from reduced potentials of sampler states pulled from the context
+        trajectory_chunk_size : int, default 100
+            number of saved nonequilibrium frames buffered before they are appended to disk (see NonequilibriumTrajectoryWriter)
+        trajectory_quantization : str or float, default None
+            quantization of the saved nonequilibrium positions (see NonequilibriumTrajectoryWriter)
+        (the remaining arguments are described in SequentialMonteCarlo)
+        """
         try:
             self.context_cache = cache.global_context_cache
+            self.work_in_context = work_in_context
 
             if measure_shadow_work:
                 measure_heat = True
@@ -656,12 +1623,12 @@ class LocallyOptimalAnnealing():
             self.topology = topology
             self.subset_atoms = subset_atoms
 
-            #if we have a trajectory, set up some ancillary variables:
+            #if we have a trajectory, set up the (subset) topology of the chunked trajectory writer:
+            self.trajectory_chunk_size = trajectory_chunk_size
+            self.trajectory_quantization = trajectory_quantization
+            self._trajectory_writer = None
             if self.topology is not None:
-                n_atoms = self.topology.n_atoms
-                self._trajectory_positions = []
-                self._trajectory_box_lengths = []
-                self._trajectory_box_angles = []
+                self._trajectory_topology = self.topology if self.subset_atoms is None else self.topology.subset(self.subset_atoms)
 
             self.compute_endstate_correction = compute_endstate_correction
             if self.compute_endstate_correction:
@@ -690,7 +1657,8 @@ class LocallyOptimalAnnealing():
                return_timer = False,
                return_sampler_state = False,
                rethermalize = False,
-               compute_incremental_work = True):
+               compute_incremental_work = True,
+               random_seed = None):
         """
         conduct annealing across lambdas.
 
@@ -712,6 +1680,9 @@ class LocallyOptimalAnnealing():
             whether to re-initialize velocities after propagation step
         compute_incremental_work : bool, default True
             whether to compute the incremental work or simply anneal
+        random_seed : int, default None
+            if not None, the velocities are redrawn from the Maxwell-Boltzmann distribution with this seed before annealing
+            (used to restart a failed particle from its last good configuration along a fresh trajectory)
 
 
         Returns
@@ -758,18 +1729,26 @@ class LocallyOptimalAnnealing():
         else:
             endstate_rps = None
 
-        if compute_incremental_work:
+        if compute_incremental_work and not self.work_in_context:
             self.dummy_sampler_state = copy.deepcopy(sampler_state) #use dummy to not update velocities and save bandwidth
+        if noneq_trajectory_filename is not None:
+            self._trajectory_writer = NonequilibriumTrajectoryWriter(noneq_trajectory_filename,
+                                                                     self._trajectory_topology,
+                                                                     periodic = self.thermodynamic_state.is_periodic,
+                                                                     chunk_size = self.trajectory_chunk_size,
+                                                                     quantization = self.trajectory_quantization)
         self.thermodynamic_state.set_alchemical_parameters(lambdas[0], lambda_protocol = self.lambda_protocol_class)
         self.context, integrator = self.context_cache.get_context(self.thermodynamic_state, self.integrator)
         self.sampler_state.apply_to_context(self.context, ignore_velocities=False)
+        if random_seed is not None:
+            self.context.setVelocitiesToTemperature(self.thermodynamic_state.temperature, random_seed)
 
         for idx, _lambda in enumerate(lambdas[1:]): #skip the first lambda
             try:
                 if return_timer:
                     start_timer = time.time()
                 if compute_incremental_work: #compute incremental work and update the context
-                    _incremental_work = self.compute_incremental_work(_lambda)
+                    _incremental_work = self.compute_incremental_work_in_context(_lambda) if self.work_in_context else self.compute_incremental_work(_lambda)
                     assert np.isfinite(_incremental_work) #check to make sure that the incremental work doesn't blow up; not checking velocities
                     incremental_work[idx] = _incremental_work
                 else: #simply update the context from the thermodynamic state
@@ -780,7 +1759,7 @@ class LocallyOptimalAnnealing():
                 if rethermalize:
                     self.context.setVelocitiesToTemperature(self.thermodynamic_state.temperature) #rethermalize
                 if noneq_trajectory_filename is not None:
-                    self.save_configuration(idx, sampler_state, context)
+                    self.save_configuration(idx)
                 if return_timer:
                     timer[idx] = time.time() - start_timer
             except Exception as e:
@@ -839,18 +1818,16 @@ class LocallyOptimalAnnealing():
         """
         if noneq_trajectory_filename is not None:
             _logger.info(f"saving configuration")
-            trajectory = md.Trajectory(np.array(self._trajectory_positions), self.topology, unitcell_lengths=np.array(self._trajectory_box_lengths), unitcell_angles=np.array(self._trajectory_box_angles))
-            write_nonequilibrium_trajectory(trajectory, noneq_trajectory_filename)
 
         self.reset_dimensions()
 
     def reset_dimensions(self):
         """
-        utility method to reset trajectory positions, box_lengths, and box_angles.
+        utility method to flush and release the nonequilibrium trajectory writer.
         """
-        self._trajectory_positions = []
-        self._trajectory_box_lengths = []
-        self._trajectory_box_angles = []
+        if self._trajectory_writer is not None:
+            self._trajectory_writer.close()
+            self._trajectory_writer = None
 
     def compute_incremental_work(self, _lambda):
         """
@@ -883,6 +1860,33 @@ class LocallyOptimalAnnealing():
 
         return _incremental_work
 
+    def compute_incremental_work_in_context(self, _lambda):
+        """
+        compute the incremental work of a lambda update from the potential energies of the context;
+        positions and box vectors are never copied out of the context.
+        the update does not move the particles or the box, so the reduced potential difference is beta times the potential energy difference
+        (the pV term cancels).  function also updates the thermodynamic state and the context
+
+        Arguments
+        ---------
+        _lambda : float
+            the lambda value used to update the importance sample
+
+        Return
+        ------
+        _incremental_work : float
+            the incremental work returned from the lambda update; this is not finite if there is a numerical instability
+        """
+        old_potential_energy = self.context.getState(getEnergy = True).getPotentialEnergy()
+
+        #update thermodynamic state and context
+        self.update_context(_lambda)
+
+        new_potential_energy = self.context.getState(getEnergy = True).getPotentialEnergy()
+        _incremental_work = self.beta * (new_potential_energy - old_potential_energy)
+
+        return _incremental_work
+
     def update_context(self, _lambda):
         """
         utility function to update the class context
@@ -896,30 +1900,21 @@ class LocallyOptimalAnnealing():
         self.thermodynamic_state.apply_to_context(self.context)
 
 
-    def save_configuration(self, iteration, sampler_state, context):
+    def save_configuration(self, iteration):
         """
-        pass a conditional save function
+        pass a conditional save function; positions (and box vectors) are read from the context and appended to the chunked trajectory writer
 
         Arguments
         ---------
         iteration : int
             the iteration index
-        sampler_state : openmmtools.states.SamplerState
-            sampler state to save
-        context : simtk.openmm.app.Context
-            context used to update the sampler state
         """
-        if iteration % self.ncmc_save_interval == 0: #we save the protocol work if the remainder is zero
+        if iteration % self.save_interval == 0: #we save the protocol work if the remainder is zero
             _logger.debug(f"\t\tsaving protocol")
             #self._kinetic_energy.append(self._beta * context.getState(getEnergy=True).getKineticEnergy()) #maybe if we want kinetic energy in the future
-            sampler_state.update_from_context(self.context, ignore_velocities=True) #save bandwidth by not updating the velocities
-
-            if self.subset_atoms is None:
-                self._trajectory_positions.append(sampler_state.positions[:, :].value_in_unit_system(unit.md_unit_system))
-            else:
-                self._trajectory_positions.append(sampler_state.positions[self.subset_atoms, :].value_in_unit_system(unit.md_unit_system))
-
-                #get the box angles and lengths
-                a, b, c, alpha, beta, gamma = mdtrajutils.unitcell.box_vectors_to_lengths_and_angles(*sampler_state.box_vectors)
-                self._trajectory_box_lengths.append([a, b, c])
-                self._trajectory_box_angles.append([alpha, beta, gamma])
+            state = self.context.getState(getPositions = True) #save bandwidth by not pulling the velocities
+            positions = state.getPositions(asNumpy = True).value_in_unit_system(unit.md_unit_system)
+            if self.subset_atoms is not None:
+                positions = positions[self.subset_atoms, :]
+            box_vectors = state.getPeriodicBoxVectors(asNumpy = True).value_in_unit_system(unit.md_unit_system) if self._trajectory_writer.periodic else None
+            self._trajectory_writer.append(positions, box_vectors, time = iteration)
@@ -928,6 +928,49 @@ class ProposalEngine(object):
         """
         return TopologyProposal(new_topology=app.Topology(), old_topology=app.Topology(), old_system=current_system, old_chemical_state_key="C", new_chemical_state_key="C", logp_proposal=0.0, new_to_old_atom_map={0 : 0}, metadata={'molecule_smiles' : 'CC'})
 
+    def propose_chemical_state(self, current_chemical_state_key):
+        """
+        Draw the next chemical state without building its topology or system.
+
+        Together with propose_to_chemical_state, this is equivalent to propose(), and lets callers reuse proposals
+        between the same pair of chemical states (see ExpandedEnsembleSampler proposal_cache_size).
+
+        Arguments
+        ---------
+        current_chemical_state_key : str
+            The current chemical state key
+
+        Returns
+        -------
+        new_chemical_state_key : str
+            The proposed chemical state key
+        logp_proposal : float
+            contribution from the chemical proposal to the log probability of acceptance
+        """
+        raise NotImplementedError("This ProposalEngine does not support drawing the chemical state separately from the proposal.")
+
+    def propose_to_chemical_state(self, current_system, current_topology, new_chemical_state_key, logp_proposal):
+        """
+        Build the proposal to a chemical state drawn with propose_chemical_state.
+
+        Arguments
+        ---------
+        current_system : simtk.openmm.System object
+            The current system object
+        current_topology : simtk.openmm.app.Topology object
+            The current topology
+        new_chemical_state_key : str
+            The proposed chemical state key
+        logp_proposal : float
+            contribution from the chemical proposal to the log probability of acceptance
+
+        Returns
+        -------
+        proposal : TopologyProposal
+            The proposal to the new chemical state
+        """
+        raise NotImplementedError("This ProposalEngine does not support drawing the chemical state separately from the proposal.")
+
     def compute_state_key(self, topology):
         """
         Compute the corresponding state key of a given topology,
@@ -2913,6 +2956,29 @@ class SmallMoleculeSetProposalEngine(ProposalEngine):
             contribution from the chemical proposal to the log probability of acceptance (Eq. 36 for hybrid; Eq. 53 for two-stage)
             log [P(Mold | Mnew) / P(Mnew | Mold)]
         """
+        proposed_smiles, logp = self._choose_molecule(molecule_smiles)
+        proposed_smiles_idx = self._smiles_list.index(proposed_smiles)
+        from perses.utils.openeye import smiles_to_oemol
+        proposed_mol = smiles_to_oemol(proposed_smiles, "MOL_%d" %proposed_smiles_idx)
+        return proposed_smiles, proposed_mol, logp
+
+    def _choose_molecule(self, molecule_smiles):
+        """
+        Choose the SMILES of the next molecule given the current molecule, using the probability matrix computed via _calculate_probability_matrix.
+
+        Arguments
+        ---------
+        molecule_smiles : string
+            The current molecule smiles
+
+        Returns
+        -------
+        proposed_mol_smiles : str
+             The SMILES of the proposed molecule
+        logp_proposal : float
+            contribution from the chemical proposal to the log probability of acceptance (Eq. 36 for hybrid; Eq. 53 for two-stage)
+            log [P(Mold | Mnew) / P(Mnew | Mold)]
+        """
         # Compute contribution from the chemical proposal to the log probability of acceptance (Eq. 36 for hybrid; Eq. 53 for two-stage)
         # log [P(Mold | Mnew) / P(Mnew | Mold)]
 
@@ -2936,9 +3002,51 @@ class SmallMoleculeSetProposalEngine(ProposalEngine):
         proposed_smiles = self._smiles_list[proposed_smiles_idx]
         _logger.info(f"\tproposed smiles: {proposed_smiles}")
         logp = np.log(reverse_probability) - np.log(forward_probability)
+        return proposed_smiles, logp
+
+    def propose_chemical_state(self, current_chemical_state_key):
+        """
+        Draw the SMILES of the next molecule from the probability matrix, without building its topology or system.
+
+        Arguments
+        ---------
+        current_chemical_state_key : str
+            The SMILES of the current molecule
+
+        Returns
+        -------
+        new_chemical_state_key : str
+            The SMILES of the proposed molecule
+        logp_proposal : float
+            contribution from the chemical proposal to the log probability of acceptance
+        """
+        return self._choose_molecule(current_chemical_state_key)
+
+    def propose_to_chemical_state(self, current_system, current_topology, new_chemical_state_key, logp_proposal):
+        """
+        Build the proposal to a molecule drawn with propose_chemical_state.
+
+        Arguments
+        ---------
+        current_system : simtk.openmm.System object
+            The current system object
+        current_topology : simtk.openmm.app.Topology object
+            The current topology
+        new_chemical_state_key : str
+            The SMILES of the proposed molecule
+        logp_proposal : float
+            contribution from the chemical proposal to the log probability of acceptance
+
+        Returns
+        -------
+        proposal : TopologyProposal
+            The proposal to the new molecule
+        """
         from perses.utils.openeye import smiles_to_oemol
-        proposed_mol = smiles_to_oemol(proposed_smiles, "MOL_%d" %proposed_smiles_idx)
-        return proposed_smiles, proposed_mol, logp
+        proposed_mol = smiles_to_oemol(new_chemical_state_key, "MOL_%d" % self._smiles_list.index(new_chemical_state_key))
+        proposal = self.propose(current_system, current_topology, proposed_mol=proposed_mol)
+        proposal._logp_proposal = logp_proposal
+        return proposal
 
     def _calculate_probability_matrix(self, molecule_smiles_list):
         """
@@ -3055,6 +3163,12 @@ class PremappedSmallMoleculeSetProposalEngine(SmallMoleculeSetProposalEngine):
                  proposal_metadata=None, storage=storage,
                  always_change=True)
 
+    def propose_chemical_state(self, current_chemical_state_key):
+        raise NotImplementedError("PremappedSmallMoleculeSetProposalEngine does not support drawing the chemical state separately from the proposal.")
+
+    def propose_to_chemical_state(self, current_system, current_topology, new_chemical_state_key, logp_proposal):
+        raise NotImplementedError("PremappedSmallMoleculeSetProposalEngine does not support drawing the chemical state separately from the proposal.")
+
     def propose(self, current_system, current_topology, current_smiles=None, proposed_mol=None, map_index=None, current_metadata=None):
         """
         Propose the next state, given the current state
@@ -3192,6 +3306,12 @@ class TwoMoleculeSetProposalEngine(SmallMoleculeSetProposalEngine):
     def _propose_molecule(self, system, topology, molecule_smiles, exclude_self=False):
         return self._new_mol_smiles, self._new_mol, 0.0
 
+    def propose_chemical_state(self, current_chemical_state_key):
+        return self._new_mol_smiles, 0.0
+
+    def propose_to_chemical_state(self, current_system, current_topology, new_chemical_state_key, logp_proposal):
+        return self.propose(current_system, current_topology)
+
 class NullProposalEngine(SmallMoleculeSetProposalEngine):
     """
     Base class for NaphthaleneProposalEngine and ButantProposalEngine
@@ -3250,6 +3370,12 @@ class NullProposalEngine(SmallMoleculeSetProposalEngine):
     def _make_skewed_atom_map(topology):
         return dict()
 
+    def propose_chemical_state(self, current_chemical_state_key):
+        raise NotImplementedError("NullProposalEngine does not support drawing the chemical state separately from the proposal.")
+
+    def propose_to_chemical_state(self, current_system, current_topology, new_chemical_state_key, logp_proposal):
+        raise NotImplementedError("NullProposalEngine does not support drawing the chemical state separately from the proposal.")
+
     def compute_state_key(self, topology):
         """
         For this test system, the topologies for the two states are
@@ -22,6 +22,8 @@ import numpy as np
 from openmmtools import testsystems
 import copy
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from openmmtools.states import SamplerState, ThermodynamicState, CompoundThermodynamicState, group_by_compatibility
 from openmmtools.multistate import sams, replicaexchange
 from openmmtools import cache, utils
@@ -31,6 +33,7 @@ cache.global_context_cache.platform = configure_platform(utils.get_fastest_platf
 from perses.annihilation.ncmc_switching import NCMCEngine
 from perses.dispersed import feptasks
 from perses.storage import NetCDFStorageView
+from perses.rjmc.topology_proposal import TopologyProposal
 from perses.utils.openeye import smiles_to_oemol
 
 
@@ -57,6 +60,26 @@ def log_sum_exp(a_n):
     a_n = np.array(list(a_n.values()))
     return np.log( np.sum( np.exp(a_n - a_n.max() ) ) )
 
+def _residue_signature(topology, residue_name):
+    """
+    Describe the atom order of the residues with a given name, which determines the validity of the atom map of a topology proposal.
+
+    Parameters
+    ----------
+    topology : simtk.openmm.app.Topology
+        The topology
+    residue_name : str
+        The name of the residues (e.g. the residue of the proposed molecule)
+
+    Returns
+    -------
+    signature : tuple
+        The (index, name, element) of every atom of the residues and the bonds between them
+    """
+    atoms = tuple((atom.index, atom.name, atom.element.symbol if atom.element is not None else None) for residue in topology.residues() if residue.name == residue_name for atom in residue.atoms())
+    bonds = tuple(sorted((bond[0].index, bond[1].index) for bond in topology.bonds() if (bond[0].residue.name == residue_name) and (bond[1].residue.name == residue_name)))
+    return (atoms, bonds)
+
 
 ################################################################################
 # EXPANDED ENSEMBLE SAMPLER
@@ -131,7 +154,7 @@ class ExpandedEnsembleSampler(object):
     >>> exen_sampler.run()
 
     """
-    def __init__(self, sampler, topology, state_key, proposal_engine, geometry_engine, log_weights=None, options=None, platform=None, envname=None, storage=None, ncmc_write_interval=1):
+    def __init__(self, sampler, topology, state_key, proposal_engine, geometry_engine, log_weights=None, options=None, platform=None, envname=None, storage=None, ncmc_write_interval=1, storage_policy=None, proposal_cache_size=None, pipeline_proposals=False, delayed_acceptance=False):
         """
         Create an expanded ensemble sampler.
 
@@ -161,6 +184,24 @@ class ExpandedEnsembleSampler(object):
             If specified, use this storage layer.
         ncmc_write_interval : int, default 1
             How frequently to write out NCMC protocol steps.
+        storage_policy : perses.storage.StoragePolicy, optional, default=None
+            If specified, selects the atoms, write intervals and position precision of the stored records (also used by the NCMCEngine).
+            If None, all records are written every iteration with all atoms.
+        proposal_cache_size : int, optional, default=None
+            If specified, keep the new topology, system and atom map of the proposals between this many (old, new) chemical state pairs
+            (least recently used pairs are evicted), and reuse them instead of running the proposal engine for revisited pairs.
+            Requires a proposal engine that implements propose_chemical_state; otherwise every proposal is built by the proposal engine.
+        pipeline_proposals : bool, optional, default=False
+            If True, prepare the chemical proposal of each iteration on a background thread while the positions are updated (MD).
+            The proposal is drawn from the chemical state at the start of the iteration, and is only used if the chemical state is unchanged
+            when the state update starts; otherwise it is discarded and a new proposal is built.
+        delayed_acceptance : bool, optional, default=False
+            If True, screen chemical proposals with a cheap first stage before the geometry and NCMC stages (delayed acceptance).
+            The first stage accepts with min(1, exp(logP_surrogate)), where logP_surrogate is the sum of the SAMS log weight difference,
+            the chemical proposal log ratio and an (antisymmetrized) estimate of the instantaneous switching log weight of the chemical
+            state pair from previous proposals; the second stage accepts with min(1, exp(logP_accept - logP_surrogate)), which keeps
+            the target distribution exact. logP_surrogate and the second stage ratio ('logp_delayed_accept') are stored; for the proposals
+            rejected by the first stage, the stored logP_accept and its geometry and NCMC components are NaN.
         """
         # Keep copies of initializing arguments.
         # TODO: Make deep copies?
@@ -174,8 +215,11 @@ class ExpandedEnsembleSampler(object):
         if self.log_weights is None: self.log_weights = dict()
 
         self.storage = None
+        self.storage_policy = storage_policy
         if storage is not None:
             self.storage = NetCDFStorageView(storage, modname=self.__class__.__name__)
+            if self.storage_policy is not None:
+                self.storage.write_storage_policy(self.storage_policy)
 
         # Initialize
         self.iteration = 0
@@ -198,7 +242,7 @@ class ExpandedEnsembleSampler(object):
                                           timestep=options['timestep'], nsteps=options['nsteps'],
                                           functions=options['functions'], integrator_splitting=self._ncmc_splitting,
                                           platform=platform, storage=self.storage,
-                                          write_ncmc_interval=ncmc_write_interval)
+                                          write_ncmc_interval=ncmc_write_interval, storage_policy=self.storage_policy)
         else:
             self._switching_nsteps = 0
 
@@ -216,8 +260,58 @@ class ExpandedEnsembleSampler(object):
         self.geometry_pdbfile = None # if not None, write PDB file of geometry proposals
         self.accept_everything = False # if True, will accept anything that doesn't lead to NaNs
         self.logPs = list()
+        self.proposal_cache_size = proposal_cache_size
+        self._proposal_cache = OrderedDict() # (old_state_key, new_state_key) : (TopologyProposal, signature of the old residue it was built against)
+        self.proposal_cache_hits = 0
+        self.proposal_cache_misses = 0
+        self.pipeline_proposals = pipeline_proposals
+        self._proposal_executor = None
+        self.npipelined_proposals = 0 # number of proposals prepared during MD that were used
+        self.ndiscarded_proposals = 0 # number of proposals prepared during MD that were discarded
+        self.delayed_acceptance = delayed_acceptance
+        self._instantaneous_log_weights = dict() # (old_state_key, new_state_key) : (logsumexp of instantaneous switching log weights, number of switches)
+        self.nsurrogate_rejections = 0 # number of proposals rejected by the first (surrogate) stage
+        self.nsurrogate_acceptances = 0 # number of proposals passed to the geometry and NCMC stages
         self.sampler.minimize(max_iterations=40)
 
+    @property
+    def ncmc_avoided_fraction(self):
+        """
+        The fraction of chemical proposals rejected by the first stage of delayed acceptance, which avoided the geometry and NCMC stages
+        (None before the first delayed acceptance proposal).
+        """
+        nproposals = self.nsurrogate_rejections + self.nsurrogate_acceptances
+        return (float(self.nsurrogate_rejections) / nproposals) if nproposals > 0 else None
+
+    def _surrogate_switching_log_weight(self, old_state_key, new_state_key):
+        """
+        Estimate the log weight of switching from one chemical state to another from the instantaneous switches of previous proposals.
+
+        The estimate is antisymmetric (the estimate of the reverse switch is its negative), as required for the first stage of delayed acceptance.
+        """
+        def log_mean_weight(pair):
+            if pair not in self._instantaneous_log_weights:
+                return 0.0
+            (log_sum_weights, nswitches) = self._instantaneous_log_weights[pair]
+            return log_sum_weights - np.log(nswitches)
+        return 0.5 * (log_mean_weight((old_state_key, new_state_key)) - log_mean_weight((new_state_key, old_state_key)))
+
+    def _update_switching_log_weights(self, old_state_key, new_state_key, log_weight):
+        """
+        Add the log weight of an instantaneous switch to the estimates used by _surrogate_switching_log_weight.
+        """
+        pair = (old_state_key, new_state_key)
+        (log_sum_weights, nswitches) = self._instantaneous_log_weights.get(pair, (-np.inf, 0))
+        self._instantaneous_log_weights[pair] = (np.logaddexp(log_sum_weights, log_weight), nswitches + 1)
+
+    @property
+    def proposal_cache_hit_rate(self):
+        """
+        The fraction of proposals reused from the proposal cache (None before the first cached proposal).
+        """
+        nproposals = self.proposal_cache_hits + self.proposal_cache_misses
+        return (float(self.proposal_cache_hits) / nproposals) if nproposals > 0 else None
+
     @property
     def state_keys(self):
         return self.log_weights.keys()
@@ -394,6 +488,12 @@ class ExpandedEnsembleSampler(object):
 
         new_geometry_sampler_state, logP_geometry_forward = self._geometry_forward(topology_proposal, sampler_state)
 
+        if self.delayed_acceptance:
+            # Instantaneous (zero-step) switching log weight, for the surrogate of later proposals
+            logP_instantaneous = - feptasks.compute_reduced_potential(new_thermodynamic_state, new_geometry_sampler_state) - logP_initial_nonalchemical - logP_geometry_forward
+            if np.isfinite(logP_instantaneous):
+                self._update_switching_log_weights(topology_proposal.old_chemical_state_key, topology_proposal.new_chemical_state_key, logP_instantaneous)
+
         #if we aren't doing any switching, then skip running the NCMC engine at all.
         if self._switching_nsteps == 0:
             ncmc_old_sampler_state = sampler_state
@@ -428,7 +528,7 @@ class ExpandedEnsembleSampler(object):
             print("logP_accept = %+10.4e [logP_to_hybrid = %+10.4e, logP_chemical_proposal = %10.4e, logP_reverse = %+10.4e, -logP_forward = %+10.4e, logP_work = %+10.4e, logP_from_hybrid = %+10.4e, logP_sams_weight = %+10.4e]"
                 % (logP_accept, logP_to_hybrid, logP_chemical_proposal, logP_geometry_reverse, -logP_geometry_forward, logP_work, logP_from_hybrid, logP_sams_weight))
         # Write to storage.
-        if self.storage:
+        if self.storage and ((self.storage_policy is None) or self.storage_policy.should_write('quantity', self.iteration)):
             self.storage.write_quantity('logP_accept', logP_accept, iteration=self.iteration)
             # Write components to storage
             self.storage.write_quantity('logP_ncmc_work', logP_work, iteration=self.iteration)
@@ -444,26 +544,114 @@ class ExpandedEnsembleSampler(object):
 
         return logP_accept, ncmc_new_sampler_state
 
+    def _write_skipped_ncmc_quantities(self, topology_proposal, old_log_weight, new_log_weight):
+        """
+        Write the quantities of _geometry_ncmc_geometry for a proposal that was rejected by the first stage of delayed acceptance,
+        so that every iteration has a record. The components of the geometry and NCMC stages, which were not run, are NaN.
+
+        Parameters
+        ----------
+        topology_proposal : TopologyProposal
+            The rejected proposal
+        old_log_weight : float
+            Chemical state weight from SAMSSampler
+        new_log_weight : float
+            Chemical state weight from SAMSSampler
+        """
+        if self.storage and ((self.storage_policy is None) or self.storage_policy.should_write('quantity', self.iteration)):
+            for name in ['logP_accept', 'logP_ncmc_work', 'logP_from_hybrid', 'logP_to_hybrid', 'logP_reverse', 'logP_forward', 'logP_groups_geometry']:
+                self.storage.write_quantity(name, np.nan, iteration=self.iteration)
+            self.storage.write_quantity('logP_chemical_proposal', topology_proposal.logp_proposal, iteration=self.iteration)
+            self.storage.write_quantity('logP_sams_weight', new_log_weight - old_log_weight, iteration=self.iteration)
+            self.storage.write_quantity('logP_groups_chemical', topology_proposal.logp_proposal, iteration=self.iteration)
+
+    def _propose(self, system, topology):
+        """
+        Propose a new chemical state with the proposal engine, reusing the cached proposal of the (old, new) chemical state pair if there is one.
+
+        Parameters
+        ----------
+        system : simtk.openmm.System
+            The current system
+        topology : simtk.openmm.app.Topology
+            The current topology (with the current box vectors)
+
+        Returns
+        -------
+        topology_proposal : TopologyProposal
+            The proposal from the current topology and system
+        """
+        if not self.proposal_cache_size:
+            return self.proposal_engine.propose(system, topology)
+        try:
+            new_state_key, logp_proposal = self.proposal_engine.propose_chemical_state(self.state_key)
+        except NotImplementedError:
+            if self.verbose: print("The proposal engine does not support cached proposals; disabling the proposal cache")
+            self.proposal_cache_size = None
+            return self.proposal_engine.propose(system, topology)
+
+        pair = (self.state_key, new_state_key)
+        # The atom map of a cached proposal is only valid for the atom order of the old topology it was built against
+        if (pair not in self._proposal_cache) or (self._proposal_cache[pair][1] != _residue_signature(topology, self._proposal_cache[pair][0].old_residue_name)):
+            self.proposal_cache_misses += 1
+            topology_proposal = self.proposal_engine.propose_to_chemical_state(system, topology, new_state_key, logp_proposal)
+            self._proposal_cache[pair] = (topology_proposal, _residue_signature(topology, topology_proposal.old_residue_name))
+            self._proposal_cache.move_to_end(pair)
+            if len(self._proposal_cache) > self.proposal_cache_size:
+                self._proposal_cache.popitem(last=False)
+            return topology_proposal
+
+        # Rebind a copy of the cached new topology, system and atom map to the current topology and system
+        self.proposal_cache_hits += 1
+        self._proposal_cache.move_to_end(pair)
+        cached_proposal = self._proposal_cache[pair][0]
+        new_topology = copy.deepcopy(cached_proposal.new_topology)
+        new_topology.setPeriodicBoxVectors(topology.getPeriodicBoxVectors())
+        return TopologyProposal(new_topology=new_topology, new_system=copy.deepcopy(cached_proposal.new_system),
+                                old_topology=topology, old_system=system, logp_proposal=logp_proposal,
+                                new_to_old_atom_map=cached_proposal.new_to_old_atom_map, old_alchemical_atoms=cached_proposal.old_alchemical_atoms,
+                                old_chemical_state_key=cached_proposal.old_chemical_state_key, new_chemical_state_key=cached_proposal.new_chemical_state_key,
+                                old_residue_name=cached_proposal.old_residue_name, new_residue_name=cached_proposal.new_residue_name,
+                                metadata=cached_proposal.metadata)
+
     def update_positions(self, n_iterations=1):
         """
         Sample new positions.
         """
         self.sampler.run(n_iterations=n_iterations)
 
-    def update_state(self):
+    def _current_system_and_topology(self):
+        """
+        Get the current system (without thermostat) and OpenMM topology (with the current box vectors) to propose from.
+        """
+        system = self.sampler.thermodynamic_state.get_system(remove_thermostat=True)
+        omm_topology = self.topology.to_openmm() #convert to OpenMM topology for proposal engine
+        omm_topology.setPeriodicBoxVectors(self.sampler.sampler_state.box_vectors) #set the box vectors because in OpenMM topology has these...
+        return system, omm_topology
+
+    def update_state(self, topology_proposal=None):
         """
         Sample the thermodynamic state.
+
+        Parameters
+        ----------
+        topology_proposal : TopologyProposal, optional, default=None
+            If specified, use this proposal (prepared from the current chemical state) instead of proposing a new chemical state.
         """
 
         initial_time = time.time()
 
         # Propose new chemical state.
-        if self.verbose: print("Proposing new topology...")
-        [system, topology, positions] = [self.sampler.thermodynamic_state.get_system(remove_thermostat=True), self.topology, self.sampler.sampler_state.positions]
-        omm_topology = topology.to_openmm() #convert to OpenMM topology for proposal engine
-        omm_topology.setPeriodicBoxVectors(self.sampler.sampler_state.box_vectors) #set the box vectors because in OpenMM topology has these...
-        topology_proposal = self.proposal_engine.propose(system, omm_topology)
+        if topology_proposal is None:
+            if self.verbose: print("Proposing new topology...")
+            system, omm_topology = self._current_system_and_topology()
+            topology_proposal = self._propose(system, omm_topology)
+        else:
+            # The box vectors may have changed during the position update
+            for proposal_topology in [topology_proposal.old_topology, topology_proposal.new_topology]:
+                proposal_topology.setPeriodicBoxVectors(self.sampler.sampler_state.box_vectors)
         if self.verbose: print("Proposed transformation: %s => %s" % (topology_proposal.old_chemical_state_key, topology_proposal.new_chemical_state_key))
+        if self.verbose and self.proposal_cache_size: print("Proposal cache hit rate: %.3f" % self.proposal_cache_hit_rate)
 
         # Determine state keys
         old_state_key = self.state_key
@@ -473,14 +661,36 @@ class ExpandedEnsembleSampler(object):
         old_log_weight = self.get_log_weight(old_state_key)
         new_log_weight = self.get_log_weight(new_state_key)
 
-        logp_accept, ncmc_new_sampler_state = self._geometry_ncmc_geometry(topology_proposal, self.sampler.sampler_state, old_log_weight, new_log_weight)
+        surrogate_reject = False
+        if self.delayed_acceptance:
+            # First stage: screen the proposal with the surrogate acceptance probability
+            logP_surrogate = new_log_weight - old_log_weight + topology_proposal.logp_proposal + self._surrogate_switching_log_weight(old_state_key, new_state_key)
+            surrogate_reject = not ((logP_surrogate >= 0.0) or (np.random.uniform() < np.exp(logP_surrogate)))
+            if surrogate_reject:
+                self.nsurrogate_rejections += 1
+            else:
+                self.nsurrogate_acceptances += 1
+            if self.verbose: print("logP_surrogate = %+10.4e (%s); fraction of NCMC protocols avoided: %.3f" % (logP_surrogate, 'rejected' if surrogate_reject else 'accepted', self.ncmc_avoided_fraction))
+
+        if surrogate_reject:
+            # The geometry and NCMC stages are not run
+            logp_accept = np.nan
+            self._write_skipped_ncmc_quantities(topology_proposal, old_log_weight, new_log_weight)
+        else:
+            logp_accept, ncmc_new_sampler_state = self._geometry_ncmc_geometry(topology_proposal, self.sampler.sampler_state, old_log_weight, new_log_weight)
+        if self.delayed_acceptance:
+            # Second stage: the delayed acceptance ratio
+            logp_delayed_accept = logp_accept - logP_surrogate
 
         # Accept or reject.
-        if np.isnan(logp_accept):
+        logp_test = logp_delayed_accept if self.delayed_acceptance else logp_accept
+        if surrogate_reject:
+            accept = False
+        elif np.isnan(logp_test):
             accept = False
             print('logp_accept = NaN')
         else:
-            accept = ((logp_accept>=0.0) or (np.random.uniform() < np.exp(logp_accept)))
+            accept = ((logp_test>=0.0) or (np.random.uniform() < np.exp(logp_test)))
             if self.accept_everything:
                 print('accept_everything option is turned on; accepting')
                 accept = True
@@ -499,13 +709,26 @@ class ExpandedEnsembleSampler(object):
             if self.verbose: print("    rejected")
 
         if self.storage:
-            self.storage.write_configuration('positions', self.sampler.sampler_state.positions, self.topology, iteration=self.iteration)
-            self.storage.write_object('state_key', self.state_key, iteration=self.iteration)
-            self.storage.write_object('proposed_state_key', topology_proposal.new_chemical_state_key, iteration=self.iteration)
-            self.storage.write_quantity('naccepted', self.naccepted, iteration=self.iteration)
-            self.storage.write_quantity('nrejected', self.nrejected, iteration=self.iteration)
-            self.storage.write_quantity('logp_accept', logp_accept, iteration=self.iteration)
-            self.storage.write_quantity('logp_topology_proposal', topology_proposal.logp_proposal, iteration=self.iteration)
+            if self.storage_policy is None:
+                self.storage.write_configuration('positions', self.sampler.sampler_state.positions, self.topology, iteration=self.iteration)
+            elif self.storage_policy.should_write('configuration', self.iteration):
+                atom_indices, topology = self.storage_policy.select_atoms(self.topology)
+                self.storage.write_configuration('positions', self.sampler.sampler_state.positions[atom_indices, :], topology, iteration=self.iteration,
+                                                 precision=self.storage_policy.position_precision)
+            if (self.storage_policy is None) or self.storage_policy.should_write('key', self.iteration):
+                self.storage.write_key('state_key', self.state_key, iteration=self.iteration)
+                self.storage.write_key('proposed_state_key', topology_proposal.new_chemical_state_key, iteration=self.iteration)
+            if (self.storage_policy is None) or self.storage_policy.should_write('quantity', self.iteration):
+                self.storage.write_quantity('naccepted', self.naccepted, iteration=self.iteration)
+                self.storage.write_quantity('nrejected', self.nrejected, iteration=self.iteration)
+                self.storage.write_quantity('logp_accept', logp_accept, iteration=self.iteration)
+                self.storage.write_quantity('logp_topology_proposal', topology_proposal.logp_proposal, iteration=self.iteration)
+                if self.proposal_cache_size:
+                    self.storage.write_quantity('proposal_cache_hit_rate', self.proposal_cache_hit_rate, iteration=self.iteration)
+                if self.delayed_acceptance:
+                    self.storage.write_quantity('logP_surrogate', logP_surrogate, iteration=self.iteration)
+                    self.storage.write_quantity('logp_delayed_accept', logp_delayed_accept, iteration=self.iteration)
+                    self.storage.write_quantity('ncmc_avoided_fraction', self.ncmc_avoided_fraction, iteration=self.iteration)
 
 
         # Update statistics.
@@ -518,8 +741,26 @@ class ExpandedEnsembleSampler(object):
         if self.verbose:
             print("-" * 80)
             print("Expanded Ensemble sampler iteration %8d" % self.iteration)
-        self.update_positions(n_iterations=self._n_iterations_per_update)
-        self.update_state()
+        if self.pipeline_proposals:
+            # Prepare the chemical proposal while the positions are updated
+            if self._proposal_executor is None:
+                self._proposal_executor = ThreadPoolExecutor(max_workers=1)
+            state_key = self.state_key
+            system, omm_topology = self._current_system_and_topology()
+            proposal_future = self._proposal_executor.submit(self._propose, system, omm_topology)
+            self.update_positions(n_iterations=self._n_iterations_per_update)
+            initial_time = time.time()
+            topology_proposal = proposal_future.result()
+            if self.verbose: print("Waited %.3f s for the proposal prepared during MD" % (time.time() - initial_time))
+            if self.state_key == state_key:
+                self.npipelined_proposals += 1
+            else:
+                self.ndiscarded_proposals += 1
+                topology_proposal = None
+            self.update_state(topology_proposal=topology_proposal)
+        else:
+            self.update_positions(n_iterations=self._n_iterations_per_update)
+            self.update_state()
         self.iteration += 1
         if self.verbose:
             print("-" * 80)
@@ -608,7 +849,7 @@ class SAMSSampler(object):
     >>> sams_sampler.run() # doctest: +ELLIPSIS
     ...
     """
-    def __init__(self, sampler, logZ=None, log_target_probabilities=None, update_method='two-stage', storage=None, second_stage_start=1000):
+    def __init__(self, sampler, logZ=None, log_target_probabilities=None, update_method='two-stage', storage=None, second_stage_start=1000, storage_policy=None):
         """
         Create a SAMS Sampler.
 
@@ -625,6 +866,8 @@ class SAMSSampler(object):
         storage : NetCDFStorageView, optional, default=None
         second_state_start : int, optional, default None
             At what iteration number to switch to the optimal gain decay
+        storage_policy : perses.storage.StoragePolicy, optional, default=None
+            If specified, sets the interval at which the logZ and log weight ('state_dict') records are written.
 
         """
         from scipy.special import logsumexp
@@ -676,8 +919,11 @@ class SAMSSampler(object):
         self.update_method = update_method
 
         self.storage = None
+        self.storage_policy = storage_policy
         if storage is not None:
             self.storage = NetCDFStorageView(storage, modname=self.__class__.__name__)
+            if self.storage_policy is not None:
+                self.storage.write_storage_policy(self.storage_policy)
 
         # Initialize.
         self.iteration = 0
@@ -774,9 +1020,9 @@ class SAMSSampler(object):
         # Update log weights for sampler.
         self.sampler.log_weights = { state_key : - self.logZ[state_key] for state_key in self.logZ.keys()}
 
-        if self.storage:
-            self.storage.write_object('logZ', self.logZ, iteration=self.iteration)
-            self.storage.write_object('log_weights', self.sampler.log_weights, iteration=self.iteration)
+        if self.storage and ((self.storage_policy is None) or self.storage_policy.should_write('state_dict', self.iteration)):
+            self.storage.write_state_dict('logZ', self.logZ, iteration=self.iteration)
+            self.storage.write_state_dict('log_weights', self.sampler.log_weights, iteration=self.iteration)
 
     def update(self):
         """
@@ -804,6 +1050,158 @@ class SAMSSampler(object):
         for iteration in range(niterations):
             self.update()
 
+################################################################################
+# PROCESS-PARALLEL TARGET SAMPLERS
+################################################################################
+
+def _target_sampler_storage_views(sampler):
+    """
+    The storage views of a target sampler and of its ExpandedEnsembleSampler, NCMCEngine and proposal engine.
+
+    Parameters
+    ----------
+    sampler : SAMSSampler or ExpandedEnsembleSampler
+        The target sampler
+
+    Returns
+    -------
+    views : list of NetCDFStorageView
+        The distinct storage views of the sampler
+    """
+    exen_sampler = sampler.sampler if isinstance(sampler, SAMSSampler) else sampler
+    views = [sampler.storage, exen_sampler.storage,
+             getattr(getattr(exen_sampler, 'ncmc_engine', None), '_storage', None),
+             getattr(exen_sampler.proposal_engine, '_storage', None)]
+    distinct_views = list()
+    for view in views:
+        if (view is not None) and all(view is not distinct_view for distinct_view in distinct_views):
+            distinct_views.append(view)
+    return distinct_views
+
+def _target_sampler_worker(sampler, connection, shard_manifest, shard_name):
+    """
+    Serve the update requests of a target sampler in a forked worker process.
+
+    Parameters
+    ----------
+    sampler : SAMSSampler or ExpandedEnsembleSampler
+        The target sampler (the copy of the parent process sampler made by the fork)
+    connection : multiprocessing.Connection
+        Connection to the parent process
+    shard_manifest : str
+        If not None, the storage views of the sampler are bound to a shard of this manifest
+    shard_name : str
+        Name of the shard of the worker
+    """
+    # Draw different random numbers than the parent and the other workers
+    np.random.seed()
+    # Contexts created by the parent process cannot be used after the fork
+    context_cache = cache.global_context_cache
+    if isinstance(context_cache, cache.ContextCache):
+        cache.global_context_cache = cache.ContextCache(platform=context_cache.platform, capacity=context_cache.capacity, time_to_live=context_cache.time_to_live)
+
+    storage = None
+    if shard_manifest is not None:
+        from perses.storage import open_shard, rebind_views
+        storage = open_shard(shard_manifest, shard_name=shard_name)
+        rebind_views(storage, _target_sampler_storage_views(sampler))
+
+    exen_sampler = sampler.sampler if isinstance(sampler, SAMSSampler) else sampler
+    while True:
+        (command, log_weights) = connection.recv()
+        if command == 'stop':
+            break
+        try:
+            exen_sampler.log_weights = log_weights
+            sampler.update()
+            connection.send((getattr(sampler, 'logZ', None), exen_sampler.log_weights, exen_sampler.state_key))
+        except Exception as e:
+            connection.send(e)
+
+    if storage is not None:
+        storage.close()
+    connection.close()
+
+class _TargetSamplerProcess(object):
+    """
+    Run the updates of a target sampler (SAMSSampler or ExpandedEnsembleSampler) in a forked worker process.
+
+    Only the log weights (to the worker) and the logZ, log weights and chemical state (from the worker) are exchanged at each update;
+    they are mirrored in the sampler of the parent process, so that target probabilities are computed as in serial mode.
+    """
+    def __init__(self, sampler, shard_manifest=None, shard_name=None):
+        """
+        Fork the worker process of a target sampler.
+
+        Parameters
+        ----------
+        sampler : SAMSSampler or ExpandedEnsembleSampler
+            The target sampler
+        shard_manifest : str, optional, default=None
+            If specified, the worker writes the records of the sampler to a shard of this manifest (see perses.storage.open_shard).
+        shard_name : str, optional, default=None
+            Name of the shard of the worker
+        """
+        import multiprocessing
+        self.sampler = sampler
+        self._exen_sampler = sampler.sampler if isinstance(sampler, SAMSSampler) else sampler
+        if (shard_manifest is None) and ((sampler.storage is not None) or (self._exen_sampler.storage is not None)):
+            raise Exception("Target samplers with storage can only be run in worker processes with a shard_manifest (the parent storage file cannot be written by several processes)")
+        if any(view._root._writer is not None for view in _target_sampler_storage_views(sampler)):
+            raise Exception("Target samplers cannot be run in worker processes while their storage has write-behind running (the fork would copy its writer thread state and buffered records); call stop_write_behind() first")
+        context = multiprocessing.get_context('fork')
+        self._connection, worker_connection = context.Pipe()
+        self._process = context.Process(target=_target_sampler_worker, args=(sampler, worker_connection, shard_manifest, shard_name), daemon=True)
+        self._process.start()
+        worker_connection.close()
+
+    def start_update(self):
+        """
+        Start an update of the sampler in the worker process, with the current log weights of the sampler.
+        """
+        self._connection.send(('update', self._exen_sampler.log_weights))
+
+    def finish_update(self):
+        """
+        Wait for the update started with start_update, and mirror its logZ, log weights and chemical state.
+        """
+        result = self._connection.recv()
+        if isinstance(result, Exception):
+            raise result
+        (logZ, log_weights, state_key) = result
+        if logZ is not None:
+            self.sampler.logZ = logZ
+            self.sampler.iteration += 1
+        self._exen_sampler.log_weights = log_weights
+        self._exen_sampler.state_key = state_key
+        self._exen_sampler.iteration += 1
+
+    def close(self):
+        """
+        Stop the worker process.
+        """
+        if self._process.is_alive():
+            self._connection.send(('stop', None))
+            self._process.join()
+        self._connection.close()
+
+def _start_target_sampler_processes(samplers, shard_manifest=None, storage=None):
+    """
+    Start a worker process for each target sampler; storage is the storage of the design, which must not have write-behind running either.
+    """
+    if (storage is not None) and (storage._root._writer is not None):
+        raise Exception("Target samplers cannot be run in worker processes while the storage of the design has write-behind running; call stop_write_behind() first")
+    return [_TargetSamplerProcess(sampler, shard_manifest=shard_manifest, shard_name='target%d' % index) for (index, sampler) in enumerate(samplers)]
+
+def _update_target_sampler_processes(workers):
+    """
+    Update the target samplers of the worker processes concurrently.
+    """
+    for worker in workers:
+        worker.start_update()
+    for worker in workers:
+        worker.finish_update()
+
 ################################################################################
 # MULTITARGET OPTIMIZATION SAMPLER
 ################################################################################
@@ -825,7 +1223,7 @@ class MultiTargetDesign(object):
         If True, verbose output is printed.
 
     """
-    def __init__(self, target_samplers, storage=None, verbose=False):
+    def __init__(self, target_samplers, storage=None, verbose=False, parallel=False, shard_manifest=None):
         """
         Initialize a multi-objective design sampler with the specified target sampler powers.
 
@@ -837,6 +1235,12 @@ class MultiTargetDesign(object):
             If specified, will use the storage layer to write trajectory data.
         verbose : bool, optional, default=False
             If true, will print verbose output
+        parallel : bool, optional, default=False
+            If True, update each target sampler in its own (forked) worker process, so that the target samplers are updated concurrently;
+            only logZ and log weights are exchanged at each iteration. The OpenMM platform must support fork (e.g. CPU, not CUDA).
+            Call close() to stop the worker processes.
+        shard_manifest : str, optional, default=None
+            In parallel mode, target samplers with storage write to shards of this manifest (see perses.storage.open_shard).
 
         The target sampler weights for N samplers with specified exponents \alpha_n are given by
 
@@ -869,6 +1273,8 @@ class MultiTargetDesign(object):
         self.verbose = verbose
         self.iteration = 0
 
+        self._workers = _start_target_sampler_processes(self.samplers, shard_manifest=shard_manifest, storage=self.storage) if parallel else None
+
     @property
     def state_keys(self):
         return self.log_target_probabilities.keys()
@@ -877,9 +1283,21 @@ class MultiTargetDesign(object):
         """
         Update all samplers.
         """
+        if self._workers is not None:
+            _update_target_sampler_processes(self._workers)
+            return
         for sampler in self.samplers:
             sampler.update()
 
+    def close(self):
+        """
+        Stop the worker processes of the target samplers (parallel mode).
+        """
+        if self._workers is not None:
+            for worker in self._workers:
+                worker.close()
+            self._workers = None
+
     def update_target_probabilities(self):
         """
         Update all target probabilities.
@@ -908,7 +1326,7 @@ class MultiTargetDesign(object):
             print("log_target_probabilities = %s" % str(self.log_target_probabilities))
 
         if self.storage:
-            self.storage.write_object('log_target_probabilities', self.log_target_probabilities, iteration=self.iteration)
+            self.storage.write_state_dict('log_target_probabilities', self.log_target_probabilities, iteration=self.iteration)
 
     def update(self):
         """
@@ -958,7 +1376,7 @@ class ProtonationStateSampler(object):
         If True, verbose output is printed.
 
     """
-    def __init__(self, complex_sampler, solvent_sampler, log_state_penalties, storage=None, verbose=False):
+    def __init__(self, complex_sampler, solvent_sampler, log_state_penalties, storage=None, verbose=False, parallel=False, shard_manifest=None):
         """
         Initialize a protonation state sampler with fixed target probabilities for ligand in solvent.
 
@@ -974,6 +1392,10 @@ class ProtonationStateSampler(object):
             If specified, will use the storage layer to write trajectory data.
         verbose : bool, optional, default=False
             If true, will print verbose output
+        parallel : bool, optional, default=False
+            If True, update the complex and solvent samplers concurrently in their own (forked) worker processes (see MultiTargetDesign).
+        shard_manifest : str, optional, default=None
+            In parallel mode, samplers with storage write to shards of this manifest (see perses.storage.open_shard).
 
         """
         # Store target samplers.
@@ -991,6 +1413,8 @@ class ProtonationStateSampler(object):
         self.verbose = verbose
         self.iteration = 0
 
+        self._workers = _start_target_sampler_processes(self.samplers, shard_manifest=shard_manifest, storage=self.storage) if parallel else None
+
     @property
     def state_keys(self):
         return self.log_target_probabilities.keys()
@@ -999,9 +1423,21 @@ class ProtonationStateSampler(object):
         """
         Update all samplers.
         """
+        if self._workers is not None:
+            _update_target_sampler_processes(self._workers)
+            return
         for sampler in self.samplers:
             sampler.update()
 
+    def close(self):
+        """
+        Stop the worker processes of the target samplers (parallel mode).
+        """
+        if self._workers is not None:
+            for worker in self._workers:
+                worker.close()
+            self._workers = None
+
     def update_target_probabilities(self):
         """
         Update all target probabilities.
@@ -26,6 +26,16 @@ import json
 import mdtraj
 from simtk import unit
 import codecs
+import hashlib
+import re
+import threading
+import queue
+import atexit
+import weakref
+import functools
+import fcntl
+import socket
+from collections import OrderedDict
 
 ################################################################################
 # LOGGER
@@ -34,6 +44,323 @@ import codecs
 import logging
 logger = logging.getLogger(__name__)
 
+################################################################################
+# SCHEMAS
+################################################################################
+
+# 'legacy': one variable (and atoms dimension) per configuration, with a pickled topology per configuration
+# 'fixed': one appendable variable per (environment, module, varname) and atom count, with a table of distinct topologies
+STORAGE_SCHEMAS = ['legacy', 'fixed']
+
+# target size (bytes) and maximum number of rows of a chunk of stored configurations
+_CONFIGURATION_CHUNK_BYTES = 2**16
+_CONFIGURATION_CHUNK_ROWS = 1024
+
+# chunk length of the configuration index variables
+_INDEX_CHUNK_SIZE = 1024
+
+def _serialize_topology(topology):
+    """Serialize an mdtraj Topology to a canonical JSON string (equal topologies give equal strings).
+
+    Parameters
+    ----------
+    topology : md.Topology object
+        The topology to serialize
+
+    Returns
+    -------
+    serialized : str
+        The JSON serialization of the topology
+    """
+    chains = list()
+    for chain in topology.chains:
+        residues = list()
+        for residue in chain.residues:
+            atoms = [[atom.name, atom.element.symbol if atom.element is not None else None, atom.serial] for atom in residue.atoms]
+            residues.append({'name' : residue.name, 'resSeq' : residue.resSeq, 'segment_id' : residue.segment_id, 'atoms' : atoms})
+        chains.append(residues)
+    bonds = [[bond[0].index, bond[1].index] for bond in topology.bonds]
+    return json.dumps({'chains' : chains, 'bonds' : bonds}, sort_keys=True)
+
+def _deserialize_topology(serialized):
+    """Reconstruct an mdtraj Topology from its JSON serialization (see _serialize_topology).
+
+    Parameters
+    ----------
+    serialized : str
+        The JSON serialization of the topology
+
+    Returns
+    -------
+    topology : md.Topology object
+        The reconstructed topology
+    """
+    contents = json.loads(serialized)
+    topology = mdtraj.Topology()
+    for residues in contents['chains']:
+        chain = topology.add_chain()
+        for residue_contents in residues:
+            residue = topology.add_residue(residue_contents['name'], chain, resSeq=residue_contents['resSeq'], segment_id=residue_contents['segment_id'])
+            for (name, symbol, serial) in residue_contents['atoms']:
+                element = mdtraj.element.get_by_symbol(symbol) if symbol is not None else None
+                topology.add_atom(name, element, residue, serial=serial)
+    atoms = list(topology.atoms)
+    for (index1, index2) in contents['bonds']:
+        topology.add_bond(atoms[index1], atoms[index2])
+    return topology
+
+################################################################################
+# STORAGE POLICY
+################################################################################
+
+# record types whose write interval can be set by a StoragePolicy
+STORAGE_RECORD_TYPES = ['configuration', 'ncmc_configuration', 'quantity', 'key', 'state_dict', 'array']
+
+class StoragePolicy(object):
+    """Policy controlling which atoms of configurations are stored, how often each type of record is written, and how positions are encoded.
+
+    The policy is recorded in the storage file (see NetCDFStorage.write_storage_policy) so that frames can be reconstructed.
+
+    Examples
+    --------
+
+    Store the non-water atoms of every 10th configuration with 0.001 angstrom precision.
+
+    >>> policy = StoragePolicy(atom_selection='not water', write_intervals={'configuration' : 10}, position_precision=0.001)
+    >>> policy.should_write('configuration', iteration=20)
+    True
+
+    """
+    def __init__(self, atom_selection='not water', write_intervals=None, position_precision=None):
+        """Create a storage policy.
+
+        Parameters
+        ----------
+        atom_selection : str, optional, default='not water'
+            MDTraj DSL selection of the atoms of configurations to store; if None, all atoms are stored.
+        write_intervals : dict of str : int, optional, default=None
+            Interval (in iterations) at which each type of record (one of STORAGE_RECORD_TYPES) is written; unspecified types are written every iteration.
+        position_precision : float, optional, default=None
+            If specified, positions are stored as integers with this (lossy) precision in angstroms; otherwise they are stored as float32.
+
+        """
+        if write_intervals is None:
+            write_intervals = dict()
+        for record_type, interval in write_intervals.items():
+            if record_type not in STORAGE_RECORD_TYPES:
+                raise Exception("Record type '%s' is not one of %s" % (record_type, str(STORAGE_RECORD_TYPES)))
+            if int(interval) < 1:
+                raise Exception("The write interval of '%s' records must be a positive integer (got %s)" % (record_type, str(interval)))
+        self.atom_selection = atom_selection
+        self.write_intervals = { record_type : int(write_intervals.get(record_type, 1)) for record_type in STORAGE_RECORD_TYPES }
+        self.position_precision = position_precision
+        self._selections = dict() # id(topology) : (topology, atom indices, subset topology)
+
+    def should_write(self, record_type, iteration=None):
+        """Return True if a record of this type is written at this iteration (singletons are always written).
+
+        """
+        return (iteration is None) or (iteration % self.write_intervals[record_type] == 0)
+
+    def select_atoms(self, topology):
+        """Select the atoms of a topology to store.
+
+        Parameters
+        ----------
+        topology : md.Topology object
+            The topology of the configuration
+
+        Returns
+        -------
+        atom_indices : np.array of int
+            The indices of the stored atoms
+        subset_topology : md.Topology object
+            The topology of the stored atoms
+
+        """
+        if self.atom_selection is None:
+            return (np.arange(topology.n_atoms), topology)
+        if id(topology) not in self._selections:
+            if len(self._selections) > 16:
+                self._selections.clear()
+            atom_indices = topology.select(self.atom_selection)
+            # Keep a reference to the topology so that its id is not reused
+            self._selections[id(topology)] = (topology, atom_indices, topology.subset(atom_indices))
+        (_, atom_indices, subset_topology) = self._selections[id(topology)]
+        return (atom_indices, subset_topology)
+
+    def to_json(self):
+        """Serialize the policy to JSON.
+        """
+        return json.dumps({'atom_selection' : self.atom_selection, 'write_intervals' : self.write_intervals, 'position_precision' : self.position_precision}, sort_keys=True)
+
+    @classmethod
+    def from_json(cls, serialized):
+        """Create a policy from its JSON serialization.
+        """
+        return cls(**json.loads(serialized))
+
+################################################################################
+# WRITE-BEHIND BUFFERING
+################################################################################
+
+def _snapshot(value):
+    """Copy mutable write arguments (arrays, quantities, dicts) so that the caller may modify them after a buffered write.
+    """
+    if isinstance(value, (np.ndarray, unit.Quantity, dict, list)):
+        return copy.deepcopy(value)
+    return value
+
+def _write_behind(write):
+    """Decorator that queues a write to the write-behind thread of the storage, if it is buffered.
+    """
+    @functools.wraps(write)
+    def buffered_write(self, *args, **kwargs):
+        writer = self._root._writer
+        if (writer is None) or (threading.current_thread() is writer.thread):
+            self._root._begin_live_write()
+            return write(self, *args, **kwargs)
+        writer.put((self._envname, self._modname, write, tuple(_snapshot(arg) for arg in args), { key : _snapshot(value) for (key, value) in kwargs.items() }))
+    return buffered_write
+
+def _flushed(read):
+    """Decorator that writes the buffered records of the storage before a read.
+    """
+    @functools.wraps(read)
+    def flushed_read(self, *args, **kwargs):
+        if self._root._writer is not None:
+            self._root._writer.flush()
+        return read(self, *args, **kwargs)
+    return flushed_read
+
+class _WriteBehindWriter(object):
+    """Background thread that writes the records buffered by a NetCDFStorage in batches, and syncs the file according to a policy.
+    """
+
+    def __init__(self, storage, sync_interval=None, sync_records=None, max_buffered_records=10000):
+        self._storage = storage
+        self.sync_interval = sync_interval
+        self.sync_records = sync_records
+        self._queue = queue.Queue(maxsize=max_buffered_records)
+        self._views = dict()
+        self._error = None
+        self._sync_requested = False
+        self._records_since_sync = 0
+        self._last_sync = time.time()
+
+        # statistics
+        self.nrecords = 0
+        self.nbatches = 0
+        self.nsyncs = 0
+
+        self.thread = threading.Thread(target=self._run, name='NetCDFStorage write-behind', daemon=True)
+        self.thread.start()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise Exception("A buffered storage write failed: %s" % str(error)) from error
+
+    def put(self, record):
+        """Buffer a record (envname, modname, write method, args, kwargs), blocking if the buffer is full.
+        """
+        self._raise_error()
+        self._queue.put(record)
+
+    def request_sync(self):
+        """Request a sync; without a sync policy, all the requests of a batch are coalesced into a single sync.
+        """
+        self._raise_error()
+        self._queue.put('sync')
+
+    def flush(self):
+        """Block until all buffered records are written and synced.
+        """
+        if not self.thread.is_alive():
+            self._raise_error()
+            return
+        self._queue.put('flush')
+        self._queue.join()
+        self._raise_error()
+
+    def stop(self):
+        """Flush the buffered records and stop the thread.
+        """
+        if self.thread.is_alive():
+            self._queue.put('stop')
+            self.thread.join()
+        self._raise_error()
+
+    def _sync_due(self):
+        if (self.sync_interval is None) and (self.sync_records is None):
+            return self._sync_requested
+        if (self.sync_interval is not None) and (time.time() - self._last_sync >= self.sync_interval):
+            return True
+        return (self.sync_records is not None) and (self._records_since_sync >= self.sync_records)
+
+    def _sync(self):
+        self._storage._sync_file()
+        self.nsyncs += 1
+        self._sync_requested = False
+        self._records_since_sync = 0
+        self._last_sync = time.time()
+
+    def _write(self, record):
+        (envname, modname, write, args, kwargs) = record
+        if (envname, modname) not in self._views:
+            view = NetCDFStorageView(self._storage)
+            (view._envname, view._modname) = (envname, modname)
+            self._views[(envname, modname)] = view
+        self._storage._begin_live_write()
+        write(self._views[(envname, modname)], *args, **kwargs)
+        self.nrecords += 1
+        self._records_since_sync += 1
+
+    def _run(self):
+        stop = False
+        while not stop:
+            # wait for the first record of a batch (at most until the next timed sync), then take all buffered records
+            timeout = None if self.sync_interval is None else max(0., self._last_sync + self.sync_interval - time.time())
+            try:
+                batch = [self._queue.get(timeout=timeout)]
+            except queue.Empty:
+                batch = list()
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            flush = False
+            for record in batch:
+                try:
+                    if record == 'sync':
+                        self._sync_requested = True
+                    elif record in ['flush', 'stop']:
+                        flush = True
+                        stop = stop or (record == 'stop')
+                    elif self._error is None:
+                        self._write(record)
+                except Exception as e:
+                    logger.error("buffered storage write failed: %s" % str(e))
+                    self._error = e
+            try:
+                if (flush and self._records_since_sync > 0) or self._sync_due():
+                    self._sync()
+            except Exception as e:
+                self._error = e
+            if len(batch) > 0:
+                self.nbatches += 1
+            for _ in batch:
+                self._queue.task_done()
+
+def _stop_write_behind(storage_reference):
+    """Flush the buffered records of a storage (if it still exists) at interpreter exit.
+    """
+    storage = storage_reference()
+    if (storage is not None) and (storage._writer is not None):
+        storage.stop_write_behind()
+
 ################################################################################
 # STORAGE
 ################################################################################
@@ -42,7 +369,7 @@ class NetCDFStorage(object):
     """NetCDF storage layer.
     """
 
-    def __init__(self, filename, mode='w'):
+    def __init__(self, filename, mode='w', schema='fixed', write_behind=False, live=False, **write_behind_options):
         """Create NetCDF storage layer, creating or appending to an existing file.
 
         Parameters
@@ -51,12 +378,49 @@ class NetCDFStorage(object):
            Name of storage file to bind to.
         mode : str, optional, default='w'
            File open mode, 'w' for (over)write, 'a' for append.
+        schema : str, optional, default='fixed'
+           Storage schema of configurations (one of STORAGE_SCHEMAS) for a new file; existing files keep the schema they were written with
+           (files without a recorded schema are 'legacy'). Use convert_storage to convert a 'legacy' file.
+        write_behind : bool, optional, default=False
+           If True, buffer the writes and write them from a background thread (see start_write_behind).
+        live : bool, optional, default=False
+           If True, guarantee consistent snapshots to concurrent readers (see perses.analysis.tail.StorageTail): the file is only
+           modified while holding an exclusive lock on '<filename>.lock', which is released by every sync, so that readers only see
+           synced files. Since readers open the file while it is open for writing, HDF5 file locking must be disabled in the writing
+           process (HDF5_USE_FILE_LOCKING=FALSE in its environment before netCDF4 is imported).
+        write_behind_options : dict
+           Options of start_write_behind.
 
         """
+        if schema not in STORAGE_SCHEMAS:
+            raise Exception("Storage schema '%s' is not one of %s" % (schema, str(STORAGE_SCHEMAS)))
         self._filename = filename
-        self._ncfile = netcdf.Dataset(self._filename, mode=mode)
         self._envname = None
         self._modname = None
+        self._root = self
+        self._writer = None
+
+        # Hold the live lock while the file is created or modified; it is released by sync()
+        self._live_lock = None
+        self._live_locked = False
+        if live and (mode != 'r'):
+            if os.environ.get('HDF5_USE_FILE_LOCKING', '').upper() != 'FALSE':
+                raise Exception("Live storage requires HDF5 file locking to be disabled in the writing process; set HDF5_USE_FILE_LOCKING=FALSE in its environment")
+            self._live_lock = open(self._filename + '.lock', 'a')
+            self._begin_live_write()
+        self._ncfile = netcdf.Dataset(self._filename, mode=mode)
+
+        # Record or retrieve the configuration storage schema.
+        if mode == 'w':
+            self._ncfile.setncattr('perses_storage_schema', schema)
+        self._schema = self._ncfile.getncattr('perses_storage_schema') if 'perses_storage_schema' in self._ncfile.ncattrs() else 'legacy'
+
+        # Caches of the topology table and configuration indices, shared by all views of this storage.
+        self._topology_hashes = dict() # topology hash : topology index
+        self._topology_ids = dict() # id(topology) : (topology, topology index) of topologies written in this session
+        self._topologies = dict() # topology index : deserialized topology
+        self._configuration_indices = dict() # configuration group path : { (iteration, frame) : (natoms, row, record) }
+        self._key_indices = dict() # key : index in the key table
 
         # Create standard dimensions.
         if 'iterations' not in self._ncfile.dimensions:
@@ -64,6 +428,44 @@ class NetCDFStorage(object):
         if 'spatial' not in self._ncfile.dimensions:
             self._ncfile.createDimension('spatial', size=3)
 
+        if self._live_lock is not None:
+            self._sync_file()
+
+        if write_behind:
+            self.start_write_behind(**write_behind_options)
+
+    def start_write_behind(self, sync_interval=None, sync_records=None, max_buffered_records=10000):
+        """Buffer the writes of this storage (and all its views) in memory, and write them in batches from a background thread.
+
+        Reads (get_*) and close() first write all buffered records; the buffered records are also written at interpreter exit.
+
+        Parameters
+        ----------
+        sync_interval : float, optional, default=None
+            If specified, sync the file at most this often (seconds); explicit sync() calls are then ignored.
+        sync_records : int, optional, default=None
+            If specified, sync the file after this many records; explicit sync() calls are then ignored.
+            Without sync_interval and sync_records, the sync() calls of every batch are coalesced into a single sync.
+        max_buffered_records : int, optional, default=10000
+            Writes block while this many records are buffered.
+
+        """
+        if self._root is not self:
+            raise Exception("Write-behind buffering must be started on the storage, not on a view")
+        if self._writer is not None:
+            raise Exception("Write-behind buffering is already started")
+        self._writer = _WriteBehindWriter(self, sync_interval=sync_interval, sync_records=sync_records, max_buffered_records=max_buffered_records)
+        atexit.register(_stop_write_behind, weakref.ref(self))
+
+    def stop_write_behind(self):
+        """Write and sync all buffered records, and stop buffering.
+
+        """
+        if self._root._writer is not None:
+            writer = self._root._writer
+            self._root._writer = None
+            writer.stop()
+
     def _find_group(self):
         """Retrieve the specified group, creating it if it does not exist.
 
@@ -87,14 +489,38 @@ class NetCDFStorage(object):
     def sync(self):
         """Flush write buffer.
         """
+        if self._root._writer is not None:
+            self._root._writer.request_sync()
+        else:
+            self._root._sync_file()
+
+    def _begin_live_write(self):
+        """Take the live lock (if this is live storage) before modifying the file; it is held until the next sync.
+        """
+        if (self._live_lock is not None) and not self._live_locked:
+            fcntl.flock(self._live_lock, fcntl.LOCK_EX)
+            self._live_locked = True
+
+    def _sync_file(self):
+        """Sync the file, and release the live lock so that readers see the synced file.
+        """
         self._ncfile.sync()
+        if self._live_locked:
+            fcntl.flock(self._live_lock, fcntl.LOCK_UN)
+            self._live_locked = False
 
     def close(self):
         """Close the storage layer.
         """
+        self.stop_write_behind()
         self._ncfile.close()
+        if self._root._live_lock is not None:
+            self._root._live_lock.close() # releases the live lock
+            self._root._live_lock = None
+            self._root._live_locked = False
 
-    def write_configuration(self, varname, positions, topology, iteration=None, frame=None, nframes=None):
+    @_write_behind
+    def write_configuration(self, varname, positions, topology, iteration=None, frame=None, nframes=None, precision=None):
         """Write a configuration (or one of a sequence of configurations) to be stored as a native NetCDF array
 
         Parameters
@@ -111,6 +537,8 @@ class NetCDFStorage(object):
             If these coordinates are part of multiple frames in a sequence, the frame number
         nframes : int, optional, default=None
             If these coordinates are part of multiple frames in a sequence, the total number of frames in the sequence
+        precision : float, optional, default=None
+            If specified, store the positions as integers with this (lossy) precision in angstroms ('fixed' schema only); it must stay constant for a varname
 
         """
         ncgrp = self._find_group()
@@ -118,6 +546,12 @@ class NetCDFStorage(object):
         if ((nframes is not None) and (frame is None)) or ((nframes is None) and (frame is not None)):
             raise Exception("Both 'nfranes' and 'frame' must be used together.")
 
+        if self._schema == 'fixed':
+            self._write_configuration_fixed(ncgrp, varname, positions, topology, iteration=iteration, frame=frame, precision=precision)
+            return
+        elif precision is not None:
+            raise Exception("Fixed-precision positions require the 'fixed' storage schema")
+
         def dimension_name(iteration, suffix):
             dimension_name = ''
             if self._envname: dimension_name += self._envname + '_'
@@ -160,8 +594,207 @@ class NetCDFStorage(object):
         if (frame is not None):
             ncgrp.variables[varname][frame,:,:] = positions[:,:] / positions_unit
         else:
-            ncgrp.variables[varname] = positions[:,:] / positions_unit
+            ncgrp.variables[varname][:,:] = positions[:,:] / positions_unit
+
+    def _write_configuration_fixed(self, ncgrp, varname, positions, topology, iteration=None, frame=None, precision=None):
+        """Write a configuration with the 'fixed' schema.
+
+        The configurations of a varname are stored in the group '<varname>_configurations', in one appendable variable
+        'positions_<natoms>' per atom count, with an appendable index of (iteration, frame, natoms, row, topology) records.
+        Topologies are stored once per distinct topology in the root topology table (see _write_topology).
+        Fixed-precision positions are stored as int32 with a CF 'scale_factor' attribute, so that they are decoded on read;
+        they are compressed (zlib with byte shuffling), which stores the unused high-order bytes of the integers in a few bits.
+
+        """
+        cfggrp = self._configuration_group(ncgrp, varname, create=True)
+        index = self._configuration_index(cfggrp)
+        natoms = topology.n_atoms
+
+        positions_varname = 'positions_%d' % natoms
+        if positions_varname not in cfggrp.variables:
+            cfggrp.createDimension('atoms_%d' % natoms, natoms)
+            cfggrp.createDimension('rows_%d' % natoms, None)
+            chunk_rows = min(_CONFIGURATION_CHUNK_ROWS, max(1, _CONFIGURATION_CHUNK_BYTES // (natoms * 3 * 4)))
+            ncvar = cfggrp.createVariable(positions_varname, np.float32 if precision is None else 'i4', dimensions=('rows_%d' % natoms, 'atoms_%d' % natoms, 'spatial'), chunksizes=(chunk_rows, natoms, 3),
+                                          zlib=(precision is not None), complevel=1, shuffle=(precision is not None))
+            if precision is not None:
+                ncvar.setncattr('scale_factor', np.float32(precision))
+        elif ('scale_factor' in cfggrp.variables[positions_varname].ncattrs()) != (precision is not None):
+            raise Exception("Configurations '%s' of %d atoms were stored with a different precision" % (varname, natoms))
+
+        # Overwrite the configuration of this (iteration, frame) if it was already written with the same atom count
+        key = (-1 if iteration is None else iteration, -1 if frame is None else frame)
+        if (key in index) and (index[key][0] == natoms):
+            (_, row, record) = index[key]
+        else:
+            row = cfggrp.dimensions['rows_%d' % natoms].size
+            record = cfggrp.dimensions['records'].size
+            index[key] = (natoms, row, record)
+
+        cfggrp.variables['iteration'][record] = key[0]
+        cfggrp.variables['frame'][record] = key[1]
+        cfggrp.variables['natoms'][record] = natoms
+        cfggrp.variables['row'][record] = row
+        cfggrp.variables['topology'][record] = self._write_topology(topology)
+
+        positions_unit = unit.angstroms
+        cfggrp.variables[positions_varname][row,:,:] = positions[:,:] / positions_unit
+
+    def _configuration_group(self, ncgrp, varname, create=False):
+        """Retrieve the 'fixed' schema group holding the configurations of a varname, creating it (with its index) if requested.
+
+        """
+        groupname = varname + '_configurations'
+        if groupname in ncgrp.groups:
+            return ncgrp.groups[groupname]
+        if not create:
+            raise Exception("There are no configurations named '%s' in %s" % (varname, ncgrp.path))
+        cfggrp = ncgrp.createGroup(groupname)
+        cfggrp.createDimension('records', None)
+        for index_varname in ['iteration', 'frame', 'natoms', 'row', 'topology']:
+            cfggrp.createVariable(index_varname, 'i4', dimensions=('records',), chunksizes=(_INDEX_CHUNK_SIZE,))
+        return cfggrp
+
+    def _configuration_index(self, cfggrp):
+        """Retrieve the (cached) index { (iteration, frame) : (natoms, row, record) } of a configuration group.
+
+        """
+        if cfggrp.path not in self._configuration_indices:
+            index = dict()
+            nrecords = cfggrp.dimensions['records'].size
+            if nrecords > 0:
+                columns = [np.asarray(cfggrp.variables[index_varname][:nrecords]) for index_varname in ['iteration', 'frame', 'natoms', 'row']]
+                for (record, (iteration, frame, natoms, row)) in enumerate(zip(*columns)):
+                    index[(int(iteration), int(frame))] = (int(natoms), int(row), record)
+            self._configuration_indices[cfggrp.path] = index
+        return self._configuration_indices[cfggrp.path]
+
+    def _write_topology(self, topology):
+        """Add a topology to the root topology table if its contents are not already stored.
+
+        Parameters
+        ----------
+        topology : md.Topology object
+            The topology to store
+
+        Returns
+        -------
+        topology_index : int
+            The index of the topology in the topology table
+        """
+        # Topology objects written earlier in this session are not serialized again
+        if id(topology) in self._topology_ids:
+            return self._topology_ids[id(topology)][1]
+
+        if 'topologies' not in self._ncfile.dimensions:
+            self._ncfile.createDimension('topologies', None)
+            self._ncfile.createVariable('topology_hashes', str, dimensions=('topologies',), chunksizes=(1,))
+            self._ncfile.createVariable('topologies', str, dimensions=('topologies',), chunksizes=(1,))
+        if len(self._topology_hashes) != self._ncfile.dimensions['topologies'].size:
+            self._topology_hashes = { str(topology_hash) : topology_index for (topology_index, topology_hash) in enumerate(self._ncfile.variables['topology_hashes'][:]) }
+
+        serialized = _serialize_topology(topology)
+        topology_hash = hashlib.sha256(serialized.encode()).hexdigest()
+        if topology_hash not in self._topology_hashes:
+            topology_index = self._ncfile.dimensions['topologies'].size
+            self._ncfile.variables['topology_hashes'][topology_index] = topology_hash
+            self._ncfile.variables['topologies'][topology_index] = serialized
+            self._topology_hashes[topology_hash] = topology_index
+        # Keep a reference to the topology so that its id is not reused
+        self._topology_ids[id(topology)] = (topology, self._topology_hashes[topology_hash])
+        return self._topology_hashes[topology_hash]
+
+    def _read_topology(self, topology_index):
+        """Retrieve (and cache) a topology of the topology table.
+
+        """
+        if topology_index not in self._topologies:
+            self._topologies[topology_index] = _deserialize_topology(str(self._ncfile.variables['topologies'][topology_index]))
+        return self._topologies[topology_index]
+
+    @_flushed
+    def get_configuration(self, envname, modname, varname, iteration=None, frame=None):
+        """Get a stored configuration and its topology.
+
+        Parameters
+        ----------
+        envname : str
+            The name of the environment for the variable
+        modname : str
+            The name of the module for the variable
+        varname : str
+            The variable name of the configuration
+        iteration : int, optional, default=None
+            The local iteration for the module, or `None` if this is a singleton
+        frame : int, optional, default=None
+            If the configuration is part of multiple frames in a sequence, the frame number
+
+        Returns
+        -------
+        positions : simtk.unit.Quantity of size [natoms,3] with units compatible with angstroms
+            The stored positions
+        topology : md.Topology object
+            The corresponding Topology object
+
+        """
+        ncgrp = self._ncfile['/' + '/'.join(name for name in [envname, modname] if name)]
+        positions_unit = unit.angstroms
+
+        if self._schema == 'legacy':
+            legacy_varname = varname if iteration is None else varname + '_' + str(iteration)
+            topology_varname = legacy_varname + '_topology' + ('' if iteration is None else '_' + str(iteration))
+            positions = ncgrp.variables[legacy_varname][:] if frame is None else ncgrp.variables[legacy_varname][frame]
+            topology_variable = ncgrp.variables[topology_varname]
+            pickled = topology_variable[iteration] if iteration is not None else topology_variable.getValue()
+            topology = pickle.loads(codecs.decode(str(pickled).encode(), "base64"))
+            return (np.array(positions, np.float32) * positions_unit, topology)
+
+        cfggrp = self._configuration_group(ncgrp, varname)
+        key = (-1 if iteration is None else iteration, -1 if frame is None else frame)
+        index = self._configuration_index(cfggrp)
+        if key not in index:
+            raise Exception("There is no configuration '%s' of iteration %s (frame %s) in %s" % (varname, str(iteration), str(frame), ncgrp.path))
+        (natoms, row, record) = index[key]
+        positions = np.array(cfggrp.variables['positions_%d' % natoms][row], np.float32)
+        topology = self._read_topology(int(cfggrp.variables['topology'][record]))
+        return (positions * positions_unit, topology)
+
+    @_write_behind
+    def write_storage_policy(self, policy):
+        """Record the storage policy used to write the records of this environment and module.
 
+        Parameters
+        ----------
+        policy : StoragePolicy
+            The storage policy
+
+        """
+        ncgrp = self._find_group()
+        ncgrp.setncattr('storage_policy', policy.to_json())
+
+    @_flushed
+    def get_storage_policy(self, envname, modname):
+        """Get the storage policy recorded for an environment and module.
+
+        Parameters
+        ----------
+        envname : str
+            The name of the environment
+        modname : str
+            The name of the module
+
+        Returns
+        -------
+        policy : StoragePolicy or None
+            The recorded storage policy, or None if no policy was recorded (all records were written every iteration, with all atoms)
+
+        """
+        ncgrp = self._ncfile['/' + '/'.join(name for name in [envname, modname] if name)]
+        if 'storage_policy' not in ncgrp.ncattrs():
+            return None
+        return StoragePolicy.from_json(ncgrp.getncattr('storage_policy'))
+
+    @_write_behind
     def write_object(self, varname, obj, iteration=None):
         """Serialize a Python object, encoding as pickle when storing as string in NetCDF.
 
@@ -189,6 +822,7 @@ class NetCDFStorage(object):
         else:
             ncgrp.variables[varname] = pickled
 
+    @_flushed
     def get_object(self, envname, modname, varname, iteration=None):
         """Get the serialized Python object.
 
@@ -212,6 +846,16 @@ class NetCDFStorage(object):
 
         nc_path = "/{envname}/{modname}/{varname}".format(envname=envname, modname=modname, varname=varname)
 
+        # Typed records are decoded from their columns
+        record_type = self._record_type(self._ncfile[nc_path])
+        if record_type == 'key':
+            code = self._ncfile[nc_path][iteration] if iteration is not None else self._ncfile[nc_path].getValue()
+            return self._key_names()[int(code)]
+        elif record_type == 'state_dict':
+            key_names = self._key_names()
+            values = self._read_state_dict_values(self._ncfile[nc_path], iteration, len(key_names))
+            return { key_names[index] : float(values[index]) for index in np.where(~np.isnan(values))[0] }
+
         if iteration is not None:
             pickled = self._ncfile[nc_path][iteration]
         else:
@@ -220,6 +864,191 @@ class NetCDFStorage(object):
         obj = pickle.loads(codecs.decode(pickled.encode(), "base64"))
         return obj
 
+    def _record_type(self, ncvar):
+        """Return the typed record type ('key' or 'state_dict') of a variable, or None for other variables.
+
+        """
+        return ncvar.getncattr('perses_record') if 'perses_record' in ncvar.ncattrs() else None
+
+    def _key_names(self):
+        """Return the names in the key table, in order of their index.
+
+        """
+        if 'keys' not in self._ncfile.dimensions:
+            return list()
+        if len(self._key_indices) != self._ncfile.dimensions['keys'].size:
+            self._key_indices.clear()
+            self._key_indices.update({ str(key) : index for (index, key) in enumerate(self._ncfile.variables['key_names'][:]) })
+        return sorted(self._key_indices.keys(), key=self._key_indices.get)
+
+    def _intern_key(self, key):
+        """Return the index of a key in the root key (enumeration) table, adding the key if it is new.
+
+        Parameters
+        ----------
+        key : str
+            The key to intern
+
+        Returns
+        -------
+        index : int
+            The index of the key in the key table
+        """
+        if not isinstance(key, str):
+            raise Exception("Only str keys can be stored as typed records (got %s)" % str(type(key)))
+        if 'keys' not in self._ncfile.dimensions:
+            self._ncfile.createDimension('keys', None)
+            self._ncfile.createVariable('key_names', str, dimensions=('keys',), chunksizes=(1,))
+        if len(self._key_indices) != self._ncfile.dimensions['keys'].size:
+            self._key_names()
+        if key not in self._key_indices:
+            index = self._ncfile.dimensions['keys'].size
+            self._ncfile.variables['key_names'][index] = key
+            self._key_indices[key] = index
+        return self._key_indices[key]
+
+    @_write_behind
+    def write_key(self, varname, key, iteration=None):
+        """Write a string key (e.g. a chemical state key), interned in the key table and stored as an integer.
+
+        Parameters
+        ----------
+        varname : str
+            The variable name to be stored
+        key : str
+            The key to be written
+        iteration : int, optional, default=None
+            The local iteration for the module, or `None` if this is a singleton
+        """
+        ncgrp = self._find_group()
+        index = self._intern_key(key)
+
+        if varname not in ncgrp.variables:
+            if iteration is not None:
+                ncvar = ncgrp.createVariable(varname, 'i4', dimensions=('iterations',), chunksizes=(_INDEX_CHUNK_SIZE,))
+            else:
+                ncvar = ncgrp.createVariable(varname, 'i4', dimensions=())
+            ncvar.setncattr('perses_record', 'key')
+
+        if iteration is not None:
+            ncgrp.variables[varname][iteration] = index
+        else:
+            ncgrp.variables[varname].assignValue(index)
+
+    @_write_behind
+    def write_state_dict(self, varname, state_dict, iteration=None):
+        """Write a dict of str key : float (e.g. log weights of chemical states) as a dense float array over the key table.
+
+        Keys that are not in the dict are stored as NaN.
+
+        Parameters
+        ----------
+        varname : str
+            The variable name to be stored
+        state_dict : dict of str : float
+            The dict to be written
+        iteration : int, optional, default=None
+            The local iteration for the module, or `None` if this is a singleton
+        """
+        ncgrp = self._find_group()
+        indices = [self._intern_key(key) for key in state_dict.keys()]
+
+        if varname not in ncgrp.variables:
+            if iteration is not None:
+                ncvar = ncgrp.createVariable(varname, 'f8', dimensions=('iterations', 'keys'), chunksizes=(_INDEX_CHUNK_SIZE // 16, 16), fill_value=np.nan)
+            else:
+                ncvar = ncgrp.createVariable(varname, 'f8', dimensions=('keys',), chunksizes=(16,), fill_value=np.nan)
+            ncvar.setncattr('perses_record', 'state_dict')
+
+        values = np.full(self._ncfile.dimensions['keys'].size, np.nan)
+        values[indices] = [float(value) for value in state_dict.values()]
+        if iteration is not None:
+            ncgrp.variables[varname][iteration, :] = values
+        else:
+            ncgrp.variables[varname][:] = values
+
+    def _read_state_dict_values(self, ncvar, iteration, nkeys):
+        """Read the dense values of a state dict record (or of all iterations if iteration is Ellipsis), padded with NaN to nkeys keys.
+
+        """
+        if iteration is None:
+            values = ncvar[:]
+        elif iteration is Ellipsis:
+            values = ncvar[:, :] if ncvar.shape[0] > 0 else np.zeros([0, ncvar.shape[1]])
+        else:
+            values = ncvar[iteration, :]
+        values = np.ma.filled(np.ma.asarray(values, dtype=np.float64), np.nan)
+        padding = [(0, 0)] * (values.ndim - 1) + [(0, nkeys - values.shape[-1])]
+        return np.pad(values, padding, constant_values=np.nan)
+
+    @_flushed
+    def get_keys(self, envname, modname, varname):
+        """Get the keys of all iterations of a variable with a single read.
+
+        Variables written with write_object (pickled keys) are decoded iteration by iteration.
+
+        Parameters
+        ----------
+        envname : str
+            The name of the environment for the variable
+        modname : str
+            The name of the module for the variable
+        varname : str
+            The variable name
+
+        Returns
+        -------
+        keys : np.array of object of shape [niterations]
+            The key of every iteration
+        """
+        nc_path = "/{envname}/{modname}/{varname}".format(envname=envname, modname=modname, varname=varname)
+        ncvar = self._ncfile[nc_path]
+        keys = np.empty(len(ncvar), dtype=object)
+        if self._record_type(ncvar) == 'key':
+            key_names = np.array(self._key_names() + [None], dtype=object)
+            keys[:] = key_names[np.asarray(ncvar[:], dtype=np.int64)]
+        else:
+            keys[:] = [self.get_object(envname, modname, varname, iteration) for iteration in range(len(ncvar))]
+        return keys
+
+    @_flushed
+    def get_state_dicts(self, envname, modname, varname):
+        """Get the state dicts of all iterations of a variable as a dense array with a single read.
+
+        Variables written with write_object (pickled dicts) are decoded iteration by iteration.
+
+        Parameters
+        ----------
+        envname : str
+            The name of the environment for the variable
+        modname : str
+            The name of the module for the variable
+        varname : str
+            The variable name
+
+        Returns
+        -------
+        keys : list of str
+            The keys of the columns of values
+        values : np.array of shape [niterations, nkeys]
+            The value of every key at every iteration (NaN if the key is not in the dict of the iteration)
+        """
+        nc_path = "/{envname}/{modname}/{varname}".format(envname=envname, modname=modname, varname=varname)
+        ncvar = self._ncfile[nc_path]
+        if self._record_type(ncvar) == 'state_dict':
+            key_names = self._key_names()
+            values = self._read_state_dict_values(ncvar, Ellipsis, len(key_names))
+            columns = np.where(~np.all(np.isnan(values), axis=0))[0]
+            return ([key_names[column] for column in columns], values[:, columns])
+
+        state_dicts = [self.get_object(envname, modname, varname, iteration) for iteration in range(len(ncvar))]
+        keys = list()
+        for state_dict in state_dicts:
+            keys.extend(key for key in state_dict.keys() if key not in keys)
+        values = np.array([[state_dict.get(key, np.nan) for key in keys] for state_dict in state_dicts], dtype=np.float64).reshape(len(state_dicts), len(keys))
+        return (keys, values)
+
+    @_write_behind
     def write_quantity(self, varname, value, iteration=None):
         """Write a floating-point number
 
@@ -245,6 +1074,7 @@ class NetCDFStorage(object):
         else:
             ncgrp.variables[varname] = value
 
+    @_write_behind
     def write_array(self, varname, array, iteration=None):
         """Write a numpy array as a native NetCDF array
 
@@ -312,10 +1142,405 @@ class NetCDFStorageView(NetCDFStorage):
         modname : str, optional, default=None
             Set the name of the module in the code writing the variable
         """
-        self._filename = storage._filename
-        self._ncfile = storage._ncfile
+        self._bind(storage)
         self._envname = storage._envname
         self._modname = storage._modname
 
         if envname: self._envname = envname
         if modname: self._modname = modname
+
+    def _bind(self, storage):
+        """Share the file and caches of a storage (keeping the environment and module names of this view).
+        """
+        self._filename = storage._filename
+        self._ncfile = storage._ncfile
+        self._root = storage._root
+        self._schema = storage._schema
+        self._topology_hashes = storage._topology_hashes
+        self._topology_ids = storage._topology_ids
+        self._topologies = storage._topologies
+        self._configuration_indices = storage._configuration_indices
+        self._key_indices = storage._key_indices
+
+def rebind_views(storage, views):
+    """Bind storage views to another storage, keeping their environment and module names.
+
+    This is used in forked worker processes (see MultiTargetDesign parallel mode), which must not write to the file of the parent process:
+    the views of the samplers of a worker are bound to the shard of the worker (see open_shard).
+
+    Parameters
+    ----------
+    storage : NetCDFStorage
+        The storage to write to
+    views : list of NetCDFStorageView
+        The views to bind
+    """
+    for view in views:
+        if view._root is not storage._root:
+            view._bind(storage)
+
+################################################################################
+# SCHEMA CONVERSION
+################################################################################
+
+def convert_storage(input_filename, output_filename, schema='fixed'):
+    """Convert a storage file written with the 'legacy' schema into a new file with the given schema.
+
+    Configurations (and their pickled topologies) are rewritten with write_configuration; all other variables are copied unchanged.
+
+    Parameters
+    ----------
+    input_filename : str
+        Name of the storage file to convert.
+    output_filename : str
+        Name of the converted storage file to create.
+    schema : str, optional, default='fixed'
+        Storage schema of the converted file.
+
+    """
+    input_storage = NetCDFStorage(input_filename, mode='r')
+    if input_storage._schema != 'legacy':
+        input_storage.close()
+        raise Exception("%s is written with the '%s' schema; only 'legacy' files can be converted" % (input_filename, input_storage._schema))
+    output_storage = NetCDFStorage(output_filename, mode='w', schema=schema)
+    output_groups = { '/' : output_storage._ncfile } # input group path : output group
+
+    def configurations(ncgrp):
+        """Find the legacy configurations of a group, returning { positions varname : (varname, iteration, topology varname) }."""
+        found = dict()
+        for legacy_varname, ncvar in ncgrp.variables.items():
+            if (len(ncvar.dimensions) < 2) or (ncvar.dimensions[-1] != 'spatial'):
+                continue
+            if legacy_varname + '_topology' in ncgrp.variables:
+                found[legacy_varname] = (legacy_varname, None, legacy_varname + '_topology')
+                continue
+            match = re.match(r'^(.*)_(\d+)$', legacy_varname)
+            if (match is not None) and ('%s_topology_%s' % (legacy_varname, match.group(2)) in ncgrp.variables):
+                found[legacy_varname] = (match.group(1), int(match.group(2)), '%s_topology_%s' % (legacy_varname, match.group(2)))
+        return found
+
+    def convert_group(ncgrp):
+        names = [name for name in ncgrp.path.split('/') if name]
+        view = NetCDFStorageView(output_storage)
+        view._envname = names[0] if len(names) > 0 else None
+        view._modname = '/'.join(names[1:]) if len(names) > 1 else None
+        found = configurations(ncgrp)
+        skipped = set(found.keys()) | set(topology_varname for (_, _, topology_varname) in found.values())
+
+        for legacy_varname, (varname, iteration, topology_varname) in found.items():
+            ncvar = ncgrp.variables[legacy_varname]
+            topology_variable = ncgrp.variables[topology_varname]
+            pickled = topology_variable[iteration] if iteration is not None else topology_variable.getValue()
+            topology = pickle.loads(codecs.decode(str(pickled).encode(), "base64"))
+            if len(ncvar.dimensions) == 3:
+                nframes = ncvar.shape[0]
+                for frame in range(nframes):
+                    view.write_configuration(varname, np.array(ncvar[frame]) * unit.angstroms, topology, iteration=iteration, frame=frame, nframes=nframes)
+            else:
+                view.write_configuration(varname, np.array(ncvar[:]) * unit.angstroms, topology, iteration=iteration)
+
+        output_group = view._find_group() if len(names) > 0 else output_storage._ncfile
+        output_groups[ncgrp.path] = output_group
+        for name, ncvar in ncgrp.variables.items():
+            if name in skipped:
+                continue
+            _copy_variable(ncvar, output_group, _copy_dimensions(ncvar, output_groups))
+
+        for subgroup in ncgrp.groups.values():
+            convert_group(subgroup)
+
+    convert_group(input_storage._ncfile)
+    output_storage.close()
+    input_storage.close()
+
+def _copy_dimensions(ncvar, output_groups, suffix=None):
+    """Create the dimensions of a variable in the output groups that mirror the groups in which they are defined, and return their output names.
+
+    A dimension of the output root that already exists with a different size is created as '<name>@<suffix>'.
+
+    Parameters
+    ----------
+    ncvar : netCDF4.Variable
+        The variable whose dimensions to create
+    output_groups : dict of str : netCDF4.Group
+        The output group of every input group path (at least of the groups in which the dimensions are defined)
+    suffix : str, optional, default=None
+        Suffix of renamed dimensions
+
+    Returns
+    -------
+    dimension_names : tuple of str
+        The output names of the dimensions of the variable
+
+    """
+    dimension_names = list()
+    for dimension in ncvar.get_dims():
+        output_group = output_groups[dimension.group().path]
+        name = dimension.name
+        size = None if dimension.isunlimited() else dimension.size
+        if name in output_group.dimensions:
+            existing = output_group.dimensions[name]
+            if (existing.isunlimited() != (size is None)) or ((size is not None) and (existing.size != size)):
+                name = '%s@%s' % (name, suffix)
+        if name not in output_group.dimensions:
+            output_group.createDimension(name, size)
+        dimension_names.append(name)
+    return tuple(dimension_names)
+
+def _copy_variable(ncvar, output_group, dimension_names):
+    """Copy the raw (unscaled) values, chunking and attributes of a variable into a group.
+
+    Parameters
+    ----------
+    ncvar : netCDF4.Variable
+        The variable to copy
+    output_group : netCDF4.Group
+        The group into which to copy the variable
+    dimension_names : tuple of str
+        The names of the dimensions of the copy (see _copy_dimensions)
+
+    Returns
+    -------
+    output_variable : netCDF4.Variable
+        The copy
+
+    """
+    chunking = ncvar.chunking()
+    attributes = { name : ncvar.getncattr(name) for name in ncvar.ncattrs() }
+    fill_value = attributes.pop('_FillValue', None)
+    output_variable = output_group.createVariable(ncvar.name, ncvar.datatype, dimensions=dimension_names, chunksizes=None if chunking == 'contiguous' else chunking, fill_value=fill_value)
+    output_variable.setncatts(attributes)
+    ncvar.set_auto_maskandscale(False)
+    output_variable.set_auto_maskandscale(False)
+    if len(dimension_names) == 0:
+        output_variable.assignValue(ncvar.getValue())
+    elif ncvar.size > 0:
+        output_variable[:] = ncvar[:]
+    ncvar.set_auto_maskandscale(True)
+    output_variable.set_auto_maskandscale(True)
+    return output_variable
+
+################################################################################
+# SHARDED STORAGE
+################################################################################
+
+def _read_manifest(manifest_filename):
+    """Read the shards { shard name : shard filename } of a manifest.
+    """
+    with open(manifest_filename, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    directory = os.path.dirname(os.path.abspath(manifest_filename))
+    return OrderedDict((shard_name, os.path.join(directory, shard_filename)) for (shard_name, shard_filename) in manifest['shards'])
+
+def is_manifest(filename):
+    """Return True if a file is a shard manifest (see open_shard) rather than a NetCDF storage file.
+    """
+    try:
+        _read_manifest(filename)
+        return True
+    except Exception:
+        return False
+
+def open_shard(manifest_filename, shard_name=None, **storage_options):
+    """Create the storage shard of this process and register it in the shared manifest.
+
+    Every writer process (e.g. each MultiTargetDesign target or ExpandedEnsembleSampler chain) writes its own shard file
+    next to the manifest; ShardedStorageView presents the shards as one storage, and merge_shards combines them into one file.
+
+    Parameters
+    ----------
+    manifest_filename : str
+        Name of the shared (JSON) manifest, created if it does not exist.
+    shard_name : str, optional, default=None
+        Unique name of the shard; if None, '<hostname>-<pid>' is used.
+    storage_options : dict
+        Options of NetCDFStorage (e.g. schema, write_behind).
+
+    Returns
+    -------
+    storage : NetCDFStorage
+        The storage of the shard, opened for writing.
+
+    """
+    if shard_name is None:
+        shard_name = '%s-%d' % (socket.gethostname(), os.getpid())
+    manifest_filename = os.path.abspath(manifest_filename)
+    shard_filename = '%s.%s.nc' % (os.path.splitext(os.path.basename(manifest_filename))[0], shard_name)
+
+    # Register the shard while holding an exclusive lock on the manifest
+    with open(manifest_filename + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            manifest = {'shards' : list()}
+            if os.path.exists(manifest_filename):
+                with open(manifest_filename, 'r') as manifest_file:
+                    manifest = json.load(manifest_file)
+            if shard_name in [name for (name, _) in manifest['shards']]:
+                raise Exception("Shard '%s' is already registered in %s" % (shard_name, manifest_filename))
+            manifest['shards'].append([shard_name, shard_filename])
+            with open(manifest_filename + '.tmp', 'w') as manifest_file:
+                json.dump(manifest, manifest_file)
+            os.replace(manifest_filename + '.tmp', manifest_filename)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    return NetCDFStorage(os.path.join(os.path.dirname(manifest_filename), shard_filename), mode='w', **storage_options)
+
+class _ShardedDataset(object):
+    """Read-only stand-in for the netCDF4.Dataset of a ShardedStorageView: root groups resolve to the groups of the shards.
+    """
+    def __init__(self, view):
+        self._view = view
+
+    @property
+    def groups(self):
+        return OrderedDict((name, shard._ncfile.groups[shard_group_name]) for (name, (shard, shard_group_name)) in self._view._environments.items())
+
+    def __getitem__(self, path):
+        names = [name for name in path.split('/') if name]
+        (shard, shard_group_name) = self._view._route(names[0])
+        return shard._ncfile['/' + '/'.join([shard_group_name] + names[1:])]
+
+    def sync(self):
+        pass
+
+    def close(self):
+        for shard in self._view._shards.values():
+            shard.close()
+
+class ShardedStorageView(NetCDFStorage):
+    """Read-only view presenting the shards of a manifest as one NetCDFStorage, without copying data.
+
+    The root groups (environments) of all shards are presented together; a group name that is written by several shards
+    is presented as '<name>@<shard name>'. Reads are routed to the shard of the environment, so that typed records and
+    configurations are decoded with the key and topology tables of their own shard.
+    """
+    def __init__(self, manifest_filename):
+        """Open the shards of a manifest for reading.
+
+        Parameters
+        ----------
+        manifest_filename : str
+            Name of the shard manifest (see open_shard)
+
+        """
+        self._filename = manifest_filename
+        self._envname = None
+        self._modname = None
+        self._root = self
+        self._writer = None
+        self._live_lock = None
+        self._live_locked = False
+        self._shards = OrderedDict((shard_name, NetCDFStorage(shard_filename, mode='r')) for (shard_name, shard_filename) in _read_manifest(manifest_filename).items())
+
+        # Present the root groups of the shards, disambiguating the names written by several shards
+        counts = dict()
+        for shard in self._shards.values():
+            for group_name in shard._ncfile.groups:
+                counts[group_name] = counts.get(group_name, 0) + 1
+        self._environments = OrderedDict()
+        for (shard_name, shard) in self._shards.items():
+            for group_name in shard._ncfile.groups:
+                name = group_name if counts[group_name] == 1 else '%s@%s' % (group_name, shard_name)
+                self._environments[name] = (shard, group_name)
+        self._ncfile = _ShardedDataset(self)
+
+    def _route(self, envname):
+        """Return the (shard storage, group name in the shard) of a presented root group.
+        """
+        if envname not in self._environments:
+            raise Exception("There is no environment '%s' in the shards of %s" % (envname, self._filename))
+        return self._environments[envname]
+
+    def _find_group(self):
+        raise Exception("ShardedStorageView is read-only; write to a shard opened with open_shard")
+
+    def sync(self):
+        pass
+
+    def close(self):
+        self._ncfile.close()
+
+    def get_object(self, envname, modname, varname, iteration=None):
+        (shard, shard_envname) = self._route(envname)
+        return shard.get_object(shard_envname, modname, varname, iteration=iteration)
+
+    def get_configuration(self, envname, modname, varname, iteration=None, frame=None):
+        (shard, shard_envname) = self._route(envname)
+        return shard.get_configuration(shard_envname, modname, varname, iteration=iteration, frame=frame)
+
+    def get_keys(self, envname, modname, varname):
+        (shard, shard_envname) = self._route(envname)
+        return shard.get_keys(shard_envname, modname, varname)
+
+    def get_state_dicts(self, envname, modname, varname):
+        (shard, shard_envname) = self._route(envname)
+        return shard.get_state_dicts(shard_envname, modname, varname)
+
+    def get_storage_policy(self, envname, modname):
+        (shard, shard_envname) = self._route(envname)
+        return shard.get_storage_policy(shard_envname, modname)
+
+def merge_shards(manifest_filename, output_filename):
+    """Merge the shards of a manifest into a single storage file, with the environments presented by ShardedStorageView.
+
+    Typed records and configurations are re-indexed into the key and topology tables of the merged file.
+    All shards must be written with the 'fixed' schema.
+
+    Parameters
+    ----------
+    manifest_filename : str
+        Name of the shard manifest (see open_shard)
+    output_filename : str
+        Name of the merged storage file to create
+
+    """
+    view = ShardedStorageView(manifest_filename)
+    for (shard_name, shard) in view._shards.items():
+        if shard._schema != 'fixed':
+            view.close()
+            raise Exception("Shard '%s' of %s is written with the '%s' schema; convert it with convert_storage before merging" % (shard_name, manifest_filename, shard._schema))
+    output_storage = NetCDFStorage(output_filename, mode='w', schema='fixed')
+
+    def merge_group(shard_name, shard, ncgrp, output_group, output_groups):
+        output_groups[ncgrp.path] = output_group
+        output_group.setncatts({ name : ncgrp.getncattr(name) for name in ncgrp.ncattrs() })
+        for (name, ncvar) in ncgrp.variables.items():
+            record_type = shard._record_type(ncvar)
+            if record_type == 'key':
+                # re-index the keys into the merged key table
+                key_names = shard._key_names()
+                key_indices = np.array([output_storage._intern_key(key) for key in key_names] + [-1], dtype=np.int32)
+                output_variable = _copy_variable(ncvar, output_group, _copy_dimensions(ncvar, output_groups, suffix=shard_name))
+                if ncvar.size > 0:
+                    codes = np.asarray(ncvar[:] if len(ncvar.dimensions) > 0 else ncvar.getValue(), dtype=np.int64)
+                    if len(ncvar.dimensions) > 0:
+                        output_variable[:] = key_indices[codes]
+                    else:
+                        output_variable.assignValue(key_indices[codes])
+            elif record_type == 'state_dict':
+                # re-index the columns into the merged key table
+                key_names = shard._key_names()
+                key_indices = [output_storage._intern_key(key) for key in key_names]
+                values = shard._read_state_dict_values(ncvar, Ellipsis if len(ncvar.dimensions) > 1 else None, len(key_names))
+                dimension_names = _copy_dimensions(ncvar, output_groups, suffix=shard_name)
+                output_variable = output_group.createVariable(name, 'f8', dimensions=dimension_names, chunksizes=ncvar.chunking(), fill_value=np.nan)
+                output_variable.setncattr('perses_record', 'state_dict')
+                merged_values = np.full(values.shape[:-1] + (output_storage._ncfile.dimensions['keys'].size,), np.nan)
+                merged_values[..., key_indices] = values
+                if values.size > 0:
+                    output_variable[:] = merged_values
+            else:
+                output_variable = _copy_variable(ncvar, output_group, _copy_dimensions(ncvar, output_groups, suffix=shard_name))
+                if ncgrp.name.endswith('_configurations') and (name == 'topology') and (ncvar.size > 0):
+                    # re-index the topologies into the merged topology table
+                    topology_indices = np.asarray(ncvar[:], dtype=np.int64)
+                    output_variable[:] = [output_storage._write_topology(shard._read_topology(int(index))) if index >= 0 else -1 for index in topology_indices]
+        for subgroup in ncgrp.groups.values():
+            merge_group(shard_name, shard, subgroup, output_group.createGroup(subgroup.name), output_groups)
+
+    shard_names = { id(shard) : shard_name for (shard_name, shard) in view._shards.items() }
+    for (name, (shard, shard_group_name)) in view._environments.items():
+        merge_group(shard_names[id(shard)], shard, shard._ncfile.groups[shard_group_name], output_storage._ncfile.createGroup(name), { '/' : output_storage._ncfile })
+    output_storage.close()
+    view.close()
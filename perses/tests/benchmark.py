@@ -201,6 +201,40 @@ def benchmark_ncmc_work_during_protocol():
                 analyses[ncmc_nsteps] = analysis
             benchmark_exen_ncmc_protocol(analyses, molecule_name, name)
 
+def benchmark_storage_write_behind(niterations=50, ncmc_nsteps=0):
+    """
+    Compare the ExpandedEnsembleSampler iterations per second of a vacuum ButaneTestSystem
+    with unbuffered storage and with write-behind buffered storage (see NetCDFStorage.start_write_behind).
+
+    Parameters
+    ----------
+    niterations : int, optional, default=50
+        Number of ExpandedEnsembleSampler iterations to time for each storage mode
+    ncmc_nsteps : int, optional, default=0
+        Number of NCMC steps per proposal
+
+    Returns
+    -------
+    iterations_per_second : dict of str : float
+        The iterations per second of the 'unbuffered' and 'write-behind' storage
+    """
+    import time
+    import tempfile
+    from perses.tests.testsystems import ButaneTestSystem
+    iterations_per_second = dict()
+    for mode, write_behind_options in [('unbuffered', None), ('write-behind', {'sync_interval' : 5.0}), ('write-behind (coalesced syncs)', {})]:
+        tmpfile = tempfile.NamedTemporaryFile(suffix='.nc')
+        testsystem = ButaneTestSystem(storage_filename=tmpfile.name, scheme='geometry-ncmc-geometry', options={'functions' : functions_hybrid, 'nsteps' : ncmc_nsteps})
+        if write_behind_options is not None:
+            testsystem.storage.start_write_behind(**write_behind_options)
+        # the first iteration compiles the kernels; it is not timed
+        testsystem.exen_samplers[ENV].run(niterations=1)
+        initial_time = time.time()
+        testsystem.exen_samplers[ENV].run(niterations=niterations)
+        testsystem.storage.close()
+        iterations_per_second[mode] = niterations / (time.time() - initial_time)
+        print('{0}: {1:.2f} iterations per second'.format(mode, iterations_per_second[mode]))
+    return iterations_per_second
 
 if __name__ == "__main__":
     benchmark_ncmc_work_during_protocol()
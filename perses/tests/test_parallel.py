@@ -5,7 +5,7 @@ from simtk.openmm import app
 from simtk import unit, openmm
 import numpy as np
 import os
-from nose.tools import nottest
+from nose.tools import nottest, assert_raises
 from unittest import skipIf
 
 import copy
@@ -37,6 +37,17 @@ def test_Parallelism_local():
 
     run_parallelism(_parallel, data)
 
+    #a local queue returns the items in the order they were put, and cannot wait for items that were never put
+    queue = _parallel.queue('local_queue')
+    for i in data:
+        queue.put(i)
+    assert queue.get() == 0
+    assert queue.get(batch = 3) == [1, 2, 3]
+    assert queue.get(batch = True) == list(data[4:])
+    with assert_raises(Exception) as context:
+        queue.get()
+    assert 'were put' in str(context.exception)
+
 @skipIf(istravis, "Skip helper function on travis")
 def test_Parallelism_distributed():
     """
@@ -51,6 +62,63 @@ def test_Parallelism_distributed():
     run_parallelism(_parallel, data)
 
 
+@skipIf(istravis, "Skip helper function on travis")
+def test_Parallelism_local_cluster():
+    """
+    following function will create a Parallelism instance with a local multiprocess cluster and run all of the used methods.
+    """
+    _parallel = parallel.Parallelism()
+
+    #test client activation
+    _parallel.activate_client(library = ('dask', 'local'), num_processes = 2, threads_per_process = 1, count_bytes = True)
+    assert _parallel.client is not None
+    assert len(_parallel.workers) == 2
+    data = np.arange(10)
+    run_parallelism(_parallel, data)
+
+    #the distributed results must match the local results
+    futures = _parallel.deploy(dummy_function, (_parallel.scatter(list(data)),))
+    assert _parallel.gather_results(futures) == [dummy_function(i) for i in data]
+
+    #a broadcast constant is shipped once and deployed as a handle
+    constant = list(range(1000))
+    handle = _parallel.broadcast(constant)
+    _bytes_shipped = _parallel.bytes_shipped
+    assert _bytes_shipped > 0
+    assert _parallel.broadcast(constant).key == handle.key and _parallel.bytes_shipped == _bytes_shipped, f"an identical constant should only be broadcast once"
+    futures = _parallel.deploy(dummy_function, ([handle] * len(data),))
+    assert _parallel.gather_results(futures) == [constant] * len(data)
+
+    #futures added while iterating are collected too, and the task stream measures the worker utilization
+    with _parallel.task_stream() as task_stream:
+        completed = _parallel.as_completed([(('first', index), future) for index, future in enumerate(_parallel.deploy(dummy_function, (list(data),)))])
+        collected = []
+        for (tag, index), result in completed:
+            collected.append((tag, result))
+            if tag == 'first' and index == 0:
+                completed.add([(('second', index), future) for index, future in enumerate(_parallel.deploy(dummy_function, (list(data + 10),)))])
+    assert sorted(collected) == sorted([('first', i) for i in data] + [('second', i + 10) for i in data])
+
+    #identical tasks (e.g. a wave that draws the same snapshot twice) share a future key, but every tag is yielded once
+    duplicates = _parallel.deploy(dummy_function, (_parallel.scatter([5, 5, 7, 5]),))
+    assert duplicates[0].key == duplicates[1].key
+    collected = dict(_parallel.as_completed([(index, future) for index, future in enumerate(duplicates)]))
+    assert collected == {0: 5, 1: 5, 2: 7, 3: 5}, f"as_completed is returning {collected}"
+
+    #futures that raise are yielded with a None result if errors are omitted
+    collected = dict(_parallel.as_completed([(index, future) for index, future in enumerate(_parallel.deploy(failing_function, (list(data),)))], omit_errors = True))
+    assert collected == {index: (None if i == 3 else i) for index, i in enumerate(data)}, f"as_completed is returning {collected}"
+    utilization = _parallel.worker_utilization(task_stream, wall_time = 1.)
+    assert utilization is not None and utilization >= 0.
+
+    #workers can publish to a shared queue while the driver consumes it
+    queue = _parallel.queue('cluster_queue')
+    futures = _parallel.deploy(queue_function, ([queue] * len(data), list(data)))
+    assert sorted(queue.get(batch = len(data))) == list(data)
+    _parallel.wait(futures)
+    _parallel.deactivate_client()
+    assert not hasattr(_parallel, 'client')
+
 @nottest
 @skipIf(istravis, "Skip helper function on travis")
 def run_parallelism(_parallel, data):
@@ -73,6 +141,11 @@ def run_parallelism(_parallel, data):
         pass
 
 
+    #test broadcast
+    handle = _parallel.broadcast(data)
+    if not _remote:
+        assert handle is data, f"local worker but broadcast data is not data"
+
     #test deploy
     futures = _parallel.deploy(dummy_function,
                               (df,),
@@ -105,6 +178,11 @@ def run_parallelism(_parallel, data):
         pass
 
 
+    #as completed
+    completed = _parallel.as_completed([(index, future) for index, future in enumerate(futures)])
+    collected = {index: result for index, result in completed}
+    assert collected == {index: dummy_function(i) for index, i in enumerate(data)}, f"as_completed is returning {collected}"
+
     #attempt a run all
     run_all_futures = _parallel.run_all(dummy_function,
                                         (data,),
@@ -121,3 +199,18 @@ def dummy_function(_arg):
     dummy function to distribute;
     """
     return _arg
+
+def failing_function(_arg):
+    """
+    dummy function that raises for the argument 3
+    """
+    if _arg == 3:
+        raise ValueError(f"failing on purpose")
+    return _arg
+
+def queue_function(queue, _arg):
+    """
+    dummy function that publishes its argument to a shared queue
+    """
+    queue.put(_arg)
+    return _arg
@@ -161,6 +161,133 @@ def test_hybrid_scheme():
         f.description = "Testing expanded ensemble sampler with AlanineDipeptideTestSystem '%s'" % environment
         yield f
 
+def _alkanes_exen_sampler(environment='vacuum', **kwargs):
+    """
+    Build an AlkanesTestSystem and an ExpandedEnsembleSampler without position updates in the given environment
+
+    Parameters
+    ----------
+    environment : str, optional, default='vacuum'
+        The environment of the test system to sample
+    kwargs
+        Additional keyword arguments passed to ExpandedEnsembleSampler
+
+    Returns
+    -------
+    testsystem : AlkanesTestSystem
+        The test system
+    exen_sampler : ExpandedEnsembleSampler
+        The sampler of the test system in the given environment
+    """
+    from perses.tests.testsystems import AlkanesTestSystem
+    from perses.samplers.samplers import ExpandedEnsembleSampler
+    testsystem = AlkanesTestSystem()
+    chemical_state_key = testsystem.proposal_engines[environment].compute_state_key(testsystem.topologies[environment])
+    exen_sampler = ExpandedEnsembleSampler(testsystem.mcmc_samplers[environment], testsystem.topologies[environment], chemical_state_key, testsystem.proposal_engines[environment], geometry.FFAllAngleGeometryEngine(metadata={}), options={'nsteps':0}, **kwargs)
+    return testsystem, exen_sampler
+
+def test_proposal_cache():
+    """
+    Test reuse of cached proposals between revisited chemical state pairs
+    """
+    niterations = 10 # number of iterations to run
+    environment = 'vacuum'
+    testsystem, exen_sampler = _alkanes_exen_sampler(environment, proposal_cache_size=4)
+    exen_sampler.run(niterations)
+    assert exen_sampler.proposal_cache_hits + exen_sampler.proposal_cache_misses == niterations
+    assert len(exen_sampler._proposal_cache) <= 4
+    assert 0.0 <= exen_sampler.proposal_cache_hit_rate <= 1.0
+
+    # A proposal rebuilt from the cache matches a proposal built from scratch, and does not share the cached new topology
+    proposal_engine = testsystem.proposal_engines[environment]
+    system, omm_topology = exen_sampler._current_system_and_topology()
+    new_state_key, logp_proposal = proposal_engine.propose_chemical_state(exen_sampler.state_key)
+    proposal_engine.propose_chemical_state = lambda state_key: (new_state_key, logp_proposal)
+    exen_sampler._proposal_cache.clear()
+    first_proposal = exen_sampler._propose(system, omm_topology)
+    nhits = exen_sampler.proposal_cache_hits
+    cached_proposal = exen_sampler._propose(system, omm_topology)
+    assert exen_sampler.proposal_cache_hits == nhits + 1
+    fresh_proposal = proposal_engine.propose_to_chemical_state(system, omm_topology, new_state_key, logp_proposal)
+    assert cached_proposal.new_to_old_atom_map == fresh_proposal.new_to_old_atom_map
+    assert [atom.name for atom in cached_proposal.new_topology.atoms()] == [atom.name for atom in fresh_proposal.new_topology.atoms()]
+    assert cached_proposal.new_system.getNumParticles() == fresh_proposal.new_system.getNumParticles()
+    assert cached_proposal.new_topology is not first_proposal.new_topology
+
+def test_pipelined_proposals():
+    """
+    Test preparation of chemical proposals during the position updates
+    """
+    niterations = 5 # number of iterations to run
+    _, exen_sampler = _alkanes_exen_sampler(pipeline_proposals=True)
+    exen_sampler.run(niterations)
+    assert exen_sampler.npipelined_proposals + exen_sampler.ndiscarded_proposals == niterations
+    assert exen_sampler.naccepted + exen_sampler.nrejected == niterations
+
+def test_delayed_acceptance():
+    """
+    Test screening of chemical proposals with the surrogate stage of delayed acceptance
+    """
+    import tempfile
+    import netCDF4
+    from perses.storage import NetCDFStorage, NetCDFStorageView
+    niterations = 10 # number of iterations to run
+    environment = 'vacuum'
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        storage_filename = os.path.join(tmpdirname, 'delayed_acceptance.nc')
+        storage = NetCDFStorage(storage_filename, mode='w')
+        _, exen_sampler = _alkanes_exen_sampler(environment, storage=NetCDFStorageView(storage, envname=environment), delayed_acceptance=True)
+        exen_sampler.run(niterations)
+        storage.close()
+        assert exen_sampler.naccepted + exen_sampler.nrejected == niterations
+        assert exen_sampler.nsurrogate_rejections + exen_sampler.nsurrogate_acceptances == niterations
+        assert exen_sampler.nsurrogate_rejections <= exen_sampler.nrejected
+        assert 0.0 <= exen_sampler.ncmc_avoided_fraction <= 1.0
+
+        # Every iteration has a record; the proposals rejected by the surrogate stage have NaN placeholders
+        ncfile = netCDF4.Dataset(storage_filename, 'r')
+        group = ncfile.groups[environment]['ExpandedEnsembleSampler']
+        logP_accept = np.ma.filled(group['logP_accept'][:niterations], -1.0)
+        logp_delayed_accept = np.ma.filled(group['logp_delayed_accept'][:niterations], -1.0)
+        logP_surrogate = np.ma.filled(group['logP_surrogate'][:niterations], np.nan)
+        assert len(logP_accept) == niterations
+        assert np.sum(np.isnan(logP_accept)) == exen_sampler.nsurrogate_rejections
+        assert np.all(np.isnan(group['logP_ncmc_work'][:niterations][np.isnan(logP_accept)]))
+        assert np.all(np.isfinite(logP_surrogate))
+        # logp_accept keeps the full log acceptance probability; the second stage ratio is stored on its own
+        assert np.allclose(np.ma.filled(group['logp_accept'][:niterations], np.nan), logP_accept, equal_nan=True)
+        ncmc = ~np.isnan(logP_accept)
+        assert np.allclose(logp_delayed_accept[ncmc], logP_accept[ncmc] - logP_surrogate[ncmc])
+        ncfile.close()
+
+def test_parallel_multitarget_design():
+    """
+    Test updating the target samplers of MultiTargetDesign in worker processes
+    """
+    import tempfile
+    from nose.tools import assert_raises
+    from perses.tests.testsystems import AlkanesTestSystem
+    from perses.samplers.samplers import MultiTargetDesign
+    from perses.storage import NetCDFStorage
+    niterations = 2 # number of iterations to run
+    testsystem = AlkanesTestSystem()
+    target_samplers = { testsystem.sams_samplers['explicit'] : 1.0, testsystem.sams_samplers['vacuum'] : -1.0 }
+    designer = MultiTargetDesign(target_samplers, parallel=True)
+    try:
+        designer.run(niterations)
+    finally:
+        designer.close()
+    for sampler in target_samplers:
+        assert sampler.iteration == niterations
+        assert sampler.sampler.state_key in sampler.logZ
+    assert set(designer.log_target_probabilities.keys()) >= set(testsystem.sams_samplers['vacuum'].state_keys)
+
+    # Worker processes are refused while the storage has write-behind running
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        storage = NetCDFStorage(os.path.join(tmpdirname, 'design.nc'), mode='w', write_behind=True)
+        assert_raises(Exception, MultiTargetDesign, target_samplers, storage=storage, parallel=True)
+        storage.close()
+
 
 if __name__=="__main__":
     for t in test_hybrid_scheme():
@@ -5,7 +5,7 @@ from simtk.openmm import app
 from simtk import unit, openmm
 import numpy as np
 import os
-from nose.tools import nottest
+from nose.tools import nottest, assert_raises
 from unittest import skipIf
 from perses.app.setup_relative_calculation import *
 from perses.annihilation.relative import HybridTopologyFactory
@@ -98,14 +98,20 @@ def sMC_setup():
     assert all(len(ne_fep._eq_dict[f"{state}_reduced_potentials"]) == 10 for state in [0,1]), f"there should be 10 reduced potentials per endstate"
     assert all(len(ne_fep._eq_dict[f"{state}_decorrelated"]) <= 10 for state in [0,1]), f"the decorrelated indices must be less than or equal to the total number of snapshots"
 
-    #now to check for decorrelation in ne_fep._eq_files_dict...
-    _filenames_0, _filenames_1 = [ne_fep._eq_dict[0][i][0] for i in range(len(ne_fep._eq_dict[0]))], [ne_fep._eq_dict[1][i][0] for i in range(len(ne_fep._eq_dict[1]))]
-    decorrelated_0 = [item for sublist in [ne_fep._eq_files_dict[0][filename] for filename in _filenames_0] for item in sublist]
-    decorrelated_1 = [item for sublist in [ne_fep._eq_files_dict[1][filename] for filename in _filenames_1] for item in sublist]
-    decorrelated_0_files = [subitem for ssublist in [item for sublist in [list(ne_fep._eq_files_dict[0].values())] for item in sublist] for subitem in ssublist]
-    decorrelated_1_files = [subitem for ssublist in [item for sublist in [list(ne_fep._eq_files_dict[1].values())] for item in sublist] for subitem in ssublist]
-    assert decorrelated_0 == sorted(decorrelated_0_files), f"there is a discrepancy between the decorrelated 0 equilibrium states and the decorrelated equilibria saved to disk"
-    assert decorrelated_1 == sorted(decorrelated_1_files), f"there is a discrepancy between the decorrelated 1 equilibrium states and the decorrelated equilibria saved to disk"
+    #now to check the snapshot pools built from the decorrelated snapshots
+    for state in [0,1]:
+        assert len(ne_fep.snapshot_pools[state]) == len(ne_fep._eq_dict[f"{state}_decorrelated"]), f"the snapshot pool of state {state} does not hold every decorrelated snapshot"
+
+    #independent replicas write their own files, and their decorrelated snapshots are merged into the pool
+    ne_fep.equilibrate(n_equilibration_iterations = 5,
+                       n_steps_per_equilibration = 1,
+                       endstates = [0],
+                       decorrelate = True,
+                       n_replicas = 2)
+    assert ne_fep._eq_dict['0_replicas'] == [0] * 10 + [0] * 5 + [1] * 5
+    assert any('replica_1' in filename for filename, _ in ne_fep._eq_dict[0]), f"the second replica should write its own trajectory file"
+    assert (0, 1) in ne_fep.sampler_states
+    assert len(ne_fep.snapshot_pools[0]) == len(ne_fep._eq_dict['0_decorrelated'])
     return ne_fep
 
 def test_local_AIS():
@@ -143,6 +149,15 @@ def test_local_AIS():
         assert  incremental_work is not None and sampler_state is not None and timer is not None, f"no returns can be None if the method passes"
     ne_fep._deactivate_annealing_workers()
 
+    #the protocol work accumulated from the context energies must match the work computed from sampler states (without propagation)
+    ne_fep._activate_annealing_workers()
+    anneal_kwargs = {'sampler_state': ne_fep.sampler_states[0], 'lambdas': np.linspace(0, 1, 5), 'num_integration_steps': 0, 'compute_incremental_work': True}
+    sampler_state_works = ne_fep.annealing_class.anneal(**copy.deepcopy(anneal_kwargs))[0]
+    ne_fep.annealing_class.work_in_context = True
+    context_works = ne_fep.annealing_class.anneal(**copy.deepcopy(anneal_kwargs))[0]
+    assert np.allclose(sampler_state_works, context_works, atol = 1e-6), f"the in-context works ({context_works}) do not match the sampler state works ({sampler_state_works})"
+    ne_fep._deactivate_annealing_workers()
+
     #3. call a dummy compute_sMC_free_energy with artificial values
     cumulative_work_dict = {'forward': np.array([[0., 0.5, 1.]]*3),
                             'reverse': np.array([[0., -0.5, -1.]]*3)}
@@ -157,6 +172,41 @@ def test_local_AIS():
                return_timer = True,
                rethermalize = False)
 
+    #test AIS with directions collected as they complete
+    print('run asynchronous AIS with protocol')
+    ne_fep.AIS(num_particles = 10,
+               protocols = {'forward': np.linspace(0,1,9), 'reverse': np.linspace(1,0,9)},
+               num_integration_steps = 1,
+               return_timer = True,
+               rethermalize = False,
+               asynchronous = True)
+    assert all(ne_fep.sMC_timers[_direction] is not None for _direction in ['forward', 'reverse'])
+
+    #test AIS that stops launching waves once the free energy uncertainty is below the target
+    print('run AIS with a target uncertainty')
+    ne_fep.AIS(num_particles = 10,
+               protocols = {'forward': np.linspace(0,1,9), 'reverse': np.linspace(1,0,9)},
+               num_integration_steps = 1,
+               target_uncertainty = 1e3,
+               min_particles = 8,
+               wave_size = 4)
+    assert ne_fep.particle_budget['particles_used'] == {'forward': 8, 'reverse': 8}, f"a loose target uncertainty should be met as soon as min_particles are collected"
+    assert ne_fep.particle_budget['max_particles'] == 10
+
+    #test AIS that draws its waves from snapshots published by the endstate equilibration
+    print('run AIS with pipelined equilibration')
+    ne_fep.AIS(num_particles = 4,
+               protocols = {'forward': np.linspace(0,1,9), 'reverse': np.linspace(1,0,9)},
+               num_integration_steps = 1,
+               wave_size = 2,
+               equilibration = {'n_steps_per_equilibration': 1, 'snapshot_spacing': 2, 'n_equilibration_iterations': 500})
+    assert ne_fep.particle_budget['particles_used'] == {'forward': 4, 'reverse': 4}
+    assert ne_fep.pipeline_report['serial_wall_time_estimate'] > 0.
+
+    #an equilibration that is too short to publish a snapshot for every particle is rejected
+    assert_raises(Exception, ne_fep.AIS, num_particles = 4, protocols = {'forward': np.linspace(0,1,9), 'reverse': np.linspace(1,0,9)},
+                  num_integration_steps = 1, equilibration = {'n_steps_per_equilibration': 1, 'n_equilibration_iterations': 3, 'burn_in': 0})
+
     try:
         os.system(f"rm -r {trajectory_directory}")
     except Exception as e:
@@ -225,6 +275,284 @@ def test_compute_timeseries():
     data = compute_timeseries(reduced_potentials)
     assert len(data[3]) <= len(reduced_potentials), f"the length of uncorrelated data is at most the length of the raw data"
 
+def _carbon_topology(n_atoms):
+    """
+    an mdtraj topology of a single residue of n_atoms carbon atoms
+    """
+    import mdtraj as md
+    topology = md.Topology()
+    residue = topology.add_residue('RES', topology.add_chain())
+    for _ in range(n_atoms):
+        topology.add_atom('C', md.element.carbon, residue)
+    return topology
+
+def test_snapshot_pool():
+    """
+    test the indexed equilibrium snapshot pool
+    """
+    import mdtraj as md
+    import tempfile
+    topology = _carbon_topology(3)
+
+    tmpdir = tempfile.mkdtemp()
+    file_numsnapshots, xyz = [], []
+    for file_index, num_snapshots in enumerate([4, 6]):
+        _xyz = np.random.rand(num_snapshots, 3, 3).astype(np.float32)
+        traj = md.Trajectory(_xyz, topology, unitcell_lengths = np.ones((num_snapshots, 3)), unitcell_angles = 90. * np.ones((num_snapshots, 3)))
+        filename = os.path.join(tmpdir, f"eq.{file_index:04}.h5")
+        write_equilibrium_trajectory(traj, filename)
+        file_numsnapshots.append((filename, num_snapshots))
+        xyz.append(_xyz)
+    xyz = np.concatenate(xyz)
+
+    decorrelated_indices = [1, 3, 4, 9]
+    pool = SnapshotPool(file_numsnapshots, decorrelated_indices)
+    assert len(pool) == len(decorrelated_indices)
+    sampler_states = pool.get(np.arange(len(pool)))
+    for sampler_state, index in zip(sampler_states, decorrelated_indices):
+        assert np.allclose(sampler_state.positions.value_in_unit(unit.nanometers), xyz[index], atol = 1e-5), f"pooled snapshot {index} does not match the written snapshot"
+
+    pool.draw(100)
+    statistics = pool.statistics
+    assert statistics['n_file_reads'] == 2, f"each file should be read once; read {statistics['n_file_reads']} times"
+    assert statistics['n_draws'] == 100 + len(decorrelated_indices)
+
+def test_equilibrium_trajectory_writer():
+    """
+    test the append-only equilibrium trajectory writer
+    """
+    import mdtraj as md
+    import tempfile
+    topology = _carbon_topology(3)
+
+    filename = os.path.join(tempfile.mkdtemp(), 'eq.0000.h5')
+    #a buffer of 2 frames forces several flushes
+    writer = EquilibriumTrajectoryWriter(filename, topology, buffer_size = 2 * 3 * 3 * 4)
+    xyz, reduced_potentials = np.random.rand(5, 3, 3).astype(np.float32), np.random.rand(5)
+    for positions, reduced_potential in zip(xyz, reduced_potentials):
+        writer.append(positions, np.eye(3), reduced_potential)
+    writer.close()
+    assert writer.n_frames == 5 and writer.n_flushes == 3
+
+    traj = md.load_hdf5(filename)
+    assert np.allclose(traj.xyz, xyz, atol = 1e-5), f"the written positions do not match"
+    assert np.allclose(traj.unitcell_lengths, 1.0), f"the written box does not match"
+    import tables
+    with tables.open_file(filename, 'r') as handle:
+        assert np.allclose(handle.root.reduced_potentials[:], reduced_potentials), f"the written reduced potentials do not match"
+
+    #a periodic trajectory cannot be extended with nonperiodic frames
+    writer = EquilibriumTrajectoryWriter(filename, topology, append = True)
+    assert writer.n_frames == 5
+    assert_raises(Exception, writer.append, xyz[0], None, 0.0)
+
+def test_nonequilibrium_trajectory_writer():
+    """
+    test the chunked (and quantized) nonequilibrium trajectory writer
+    """
+    import tempfile
+    topology = _carbon_topology(3)
+
+    xyz = np.random.rand(7, 3, 3).astype(np.float32)
+    for quantization, tolerance in zip([None, 'float16', 1e-3], [1e-6, 1e-3, 1e-3]):
+        filename = os.path.join(tempfile.mkdtemp(), 'neq.h5')
+        writer = NonequilibriumTrajectoryWriter(filename, topology, chunk_size = 3, quantization = quantization)
+        for positions in xyz:
+            writer.append(positions, 2. * np.eye(3))
+        writer.close()
+        assert writer.n_frames == 7 and writer.n_flushes == 3
+        traj = read_nonequilibrium_trajectory(filename)
+        assert np.allclose(traj.xyz, xyz, atol = tolerance), f"the written positions do not match with quantization {quantization}"
+        assert np.allclose(traj.unitcell_lengths, 2.0), f"the written box does not match"
+
+def test_checkpoint():
+    """
+    test the atomic checkpoint round trip (including the random number generator states)
+    """
+    import tempfile
+    import random
+    checkpoint_filename = os.path.join(tempfile.mkdtemp(), 'sMC.checkpoint')
+    checkpoint = {'cumulative_works': {'forward': [np.zeros(3), np.random.rand(3)]},
+                  'random_state': random.getstate(),
+                  'numpy_random_state': np.random.get_state()}
+    write_checkpoint(checkpoint, checkpoint_filename)
+    assert not os.path.exists(checkpoint_filename + '.tmp'), f"the temporary checkpoint was not replaced"
+    draws = (random.random(), np.random.rand())
+
+    _checkpoint = read_checkpoint(checkpoint_filename)
+    assert all(np.array_equal(i, j) for i, j in zip(_checkpoint['cumulative_works']['forward'], checkpoint['cumulative_works']['forward']))
+    random.setstate(_checkpoint['random_state'])
+    np.random.set_state(_checkpoint['numpy_random_state'])
+    assert (random.random(), np.random.rand()) == draws, f"the restored random number generators do not reproduce the draws"
+
+def test_checkpoint_resume():
+    """
+    test that sMC and AIS runs that are interrupted after a checkpoint and resumed from it reproduce the works of uninterrupted runs with the same seeds
+    """
+    import tempfile
+    import random
+    ne_fep = sMC_setup()
+    checkpoint_filename = os.path.join(tempfile.mkdtemp(), 'sMC.checkpoint')
+    #without propagation, the works are determined by the random draws of the snapshots and of resampling; sMC is interrupted in its
+    #third lambda increment, and AIS after its first wave
+    protocols = {'forward': np.linspace(0,1,6), 'reverse': np.linspace(1,0,6)}
+    runs = [(ne_fep.sMC, 'compute_lambda_increment', 3, {'num_particles': 4, 'protocols': protocols, 'num_integration_steps': 0,
+                                                          'resample': {'criterion': 'ESS', 'method': 'multinomial', 'threshold': 0.9}}),
+            (ne_fep.AIS, 'compute_AIS_uncertainty', 1, {'num_particles': 4, 'protocols': protocols, 'num_integration_steps': 0, 'wave_size': 2})]
+    for method, interrupted_method, interrupted_call, kwargs in runs:
+        for asynchronous in [False, True]:
+            random.seed(0); np.random.seed(0)
+            method(asynchronous = asynchronous, **kwargs)
+            uninterrupted_works = copy.deepcopy(ne_fep.cumulative_work)
+
+            random.seed(0); np.random.seed(0)
+            _interrupted_method, calls = getattr(ne_fep, interrupted_method), []
+            def interrupt(*args, **_kwargs):
+                calls.append(args)
+                if len(calls) == interrupted_call:
+                    raise KeyboardInterrupt
+                return _interrupted_method(*args, **_kwargs)
+            setattr(ne_fep, interrupted_method, interrupt)
+            assert_raises(KeyboardInterrupt, method, checkpoint_filename = checkpoint_filename, asynchronous = asynchronous, **kwargs)
+            delattr(ne_fep, interrupted_method)
+
+            #the resumed run restores the random number generator states of the checkpoint
+            random.seed(1); np.random.seed(1)
+            method(resume_from = checkpoint_filename, checkpoint_filename = checkpoint_filename, asynchronous = asynchronous, **kwargs)
+            for _direction in ['forward', 'reverse']:
+                assert np.allclose(ne_fep.cumulative_work[_direction], uninterrupted_works[_direction]), f"the resumed {method.__name__} works do not match the uninterrupted works"
+
+def test_particle_chunker():
+    """
+    test that particles are chunked and that automatic chunking grows the chunks when the scheduling overhead dominates
+    """
+    chunker = ParticleChunker(num_particles = 10, num_workers = 1, chunk_size = 4)
+    assert chunker.chunk(list(range(10))) == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+    chunker = ParticleChunker(num_particles = 100, num_workers = 2, chunk_size = 'auto')
+    assert chunker.chunk_size == 1
+    #short annealing tasks, submitted together, that run on one executor with a scheduling delay of 0.009 seconds before each of them
+    submitted = time.time() - 0.1
+    for task in range(10):
+        start = submitted + 0.009 + 0.01 * task
+        chunker.record(1, 0.001, [{'submitted': submitted, 'start': start, 'end': start + 0.001, 'executor': 'worker'}], window = 'forward')
+    assert chunker.update(window = 'reverse') is None
+    particle_overhead = chunker.update(window = 'forward')
+    #the scheduling delays (0.09 seconds) and the collection delays (0.45 seconds) are overhead, but the time spent queued behind earlier tasks is not
+    assert 0.054 <= particle_overhead < 0.06 and chunker.particle_overheads == [particle_overhead]
+    assert 1 < chunker.chunk_size <= 50, f"the chunk size ({chunker.chunk_size}) should grow, but leave every worker a chunk"
+
+def test_annealing_supervisor():
+    """
+    test that the annealing supervisor restarts failed particles with a fresh seed and records the events
+    """
+    _parallel = parallel.Parallelism()
+    _parallel.activate_client(library = None, num_processes = None)
+
+    def dummy_chunk(particles, random_seed):
+        #particle 1 fails unless it is restarted along a fresh trajectory
+        return [(np.zeros(2), None, None, particle != 1 or random_seed is not None, None) for particle in particles], 0., {'start': 0., 'end': 0., 'executor': None}
+
+    def resubmit(particles, random_seed, workers, speculative):
+        return _parallel.deploy(dummy_chunk, ([particles], [random_seed]))[0]
+
+    supervisor = AnnealingSupervisor(parallelism = _parallel, max_restarts = 1)
+    chunks = [[0, 1], [2, 3]]
+    for index, (chunk, future) in enumerate(zip(chunks, _parallel.deploy(dummy_chunk, (chunks, [None] * len(chunks))))):
+        supervisor.add(index, future, chunk, resubmit)
+    results = dict(supervisor)
+    assert sorted(results.keys()) == [0, 1]
+    assert all(len(results[index][0]) == len(chunk) and all(_result[3] for _result in results[index][0]) for index, chunk in enumerate(chunks))
+    assert [(event['event'], event['particles']) for event in supervisor.events] == [('restart', [1])]
+
+    #a particle that keeps failing is not silently dropped
+    supervisor = AnnealingSupervisor(parallelism = _parallel, max_restarts = 0)
+    with assert_raises(Exception) as context:
+        supervisor.add(0, dummy_chunk([0, 1], None), [0, 1], resubmit)
+    assert 'failed after 0 restarts' in str(context.exception)
+    assert supervisor.events[-1]['event'] == 'failure'
+
+def straggling_chunk(particles, speculative):
+    """
+    annealing chunk stand-in in which particle 0 straggles unless it is annealed by a speculative copy
+    """
+    task_time = 5. if (0 in particles and not speculative) else 0.1
+    start = time.time()
+    time.sleep(task_time)
+    return [(np.zeros(2), None, None, True, None) for particle in particles], task_time, {'start': start, 'end': time.time(), 'executor': None}
+
+def test_annealing_supervisor_speculation():
+    """
+    test that only an executing straggler is speculatively re-executed (not a job queued behind it), and that the speculative copy wins
+    """
+    _parallel = parallel.Parallelism()
+    _parallel.activate_client(library = ('dask', 'local'), num_processes = 2, threads_per_process = 1)
+
+    def resubmit(particles, random_seed, workers, speculative):
+        return _parallel.deploy(straggling_chunk, ([particles], [speculative]), workers = workers, pure = False)[0]
+
+    supervisor = AnnealingSupervisor(parallelism = _parallel, min_latencies = 2)
+    chunks = [[0], [1], [2], [3]]
+    for index, (chunk, future) in enumerate(zip(chunks, _parallel.deploy(straggling_chunk, (chunks, [False] * len(chunks)), pure = False))):
+        supervisor.add(index, future, chunk, resubmit)
+    results = dict(supervisor)
+    _parallel.deactivate_client()
+    assert sorted(results.keys()) == [0, 1, 2, 3]
+    assert [(event['event'], event['tag']) for event in supervisor.events] == [('speculation', 0), ('speculation_resolved', 0)]
+    assert supervisor.events[-1]['winner'] == 'speculative'
+
+def test_estimators():
+    """
+    test the vectorized work estimators against the per-step estimators
+    """
+    from perses.dispersed import estimators
+    cumulative_works = np.concatenate((np.zeros((20, 1)), np.cumsum(np.random.randn(20, 30) + 0.5, axis = 1)), axis = 1)
+    free_energies, uncertainties = estimators.EXP(cumulative_works)
+    for step in range(cumulative_works.shape[1]):
+        DeltaF, dDeltaF = pymbar.EXP(cumulative_works[:, step])
+        assert abs(free_energies[step] - DeltaF) < 1e-8 and abs(uncertainties[step] - dDeltaF) < 1e-8, f"the vectorized EXP does not match pymbar at step {step}"
+    _ESS, _CESS = estimators.ESS(cumulative_works), estimators.CESS(cumulative_works)
+    for step in range(1, cumulative_works.shape[1]):
+        incremental_works = cumulative_works[:, step] - cumulative_works[:, step - 1]
+        assert abs(_ESS[step] - ESS(cumulative_works[:, step - 1], incremental_works)) < 1e-8
+        assert abs(_CESS[step - 1] - CESS(cumulative_works[:, step - 1], incremental_works)) < 1e-8
+
+    #both directions at once and incremental updates
+    assert estimators.EXP(np.stack((cumulative_works, -cumulative_works)))[0].shape == (2, cumulative_works.shape[1])
+    estimator = estimators.WorkEstimator()
+    for columns in np.array_split(np.arange(cumulative_works.shape[1]), 4):
+        estimator.update(cumulative_works[:, columns])
+    assert len(estimator) == cumulative_works.shape[1]
+    assert np.allclose(estimator.free_energies[0], free_energies) and np.allclose(estimator.ESS, _ESS) and np.allclose(estimator.CESS, _CESS)
+
+def test_statistical_inefficiency_estimator():
+    """
+    test the statistical inefficiency estimator against pymbar
+    """
+    from pymbar import timeseries
+    #correlated AR(1) timeseries
+    A_t = np.zeros(500)
+    for t in range(1, len(A_t)):
+        A_t[t] = 0.9 * A_t[t-1] + np.random.randn()
+    assert abs(statistical_inefficiency(A_t) - timeseries.statisticalInefficiency(A_t, fast = False)) < 1e-6, f"the statistical inefficiency does not match pymbar"
+    assert statistical_inefficiency(np.ones(10)) == 11., f"a timeseries without variance should be treated as in pymbar.timeseries.detectEquilibration"
+
+    estimator = StatisticalInefficiencyEstimator()
+    for block in np.split(A_t, 10):
+        estimator.update(block)
+    assert len(estimator) == len(A_t)
+    t0, g, Neff_max = estimator.estimate()
+    uncorrelated_indices = estimator.uncorrelated_indices()
+    assert all(index >= t0 for index in uncorrelated_indices)
+    assert uncorrelated_indices == sorted(set(uncorrelated_indices)), f"the uncorrelated indices must be unique and sorted"
+    assert estimator.n_uncorrelated_samples <= len(A_t) - t0
+
+    #estimates requested on the geometric schedule are logarithmic (not linear) in the length of the timeseries
+    checks = [10]
+    while checks[-1] < 100000:
+        checks.append(next_check(checks[-1], 10))
+    assert checks[1] == 20 and len(checks) < 100
+
 def test_create_endstates():
     """
     test the creation of unsampled endstates
@@ -133,6 +133,239 @@ def test_write_object():
         assert ('iteration' in obj)
         assert (obj['iteration'] == iteration)
 
+def test_write_typed_records():
+    """Test writing of interned keys and state dicts, and reading them back as columns.
+    """
+    tmpfile = tempfile.NamedTemporaryFile()
+    storage = NetCDFStorage(tmpfile.name, mode='w')
+    view = NetCDFStorageView(storage, 'envname', 'modname')
+
+    state_keys = ['CC', 'CCC', 'CCO']
+    for iteration in range(10):
+        view.write_key('state_key', state_keys[iteration % 3], iteration=iteration)
+        view.write_state_dict('logZ', { state_key : float(iteration) for state_key in state_keys[:(iteration % 3) + 1] }, iteration=iteration)
+    storage.close()
+
+    storage = NetCDFStorage(tmpfile.name, mode='r')
+    assert storage.get_object('envname', 'modname', 'state_key', iteration=4) == 'CCC'
+    assert storage.get_object('envname', 'modname', 'logZ', iteration=4) == { 'CC' : 4.0, 'CCC' : 4.0 }
+    keys = storage.get_keys('envname', 'modname', 'state_key')
+    assert list(keys) == [state_keys[iteration % 3] for iteration in range(10)]
+    (keys, values) = storage.get_state_dicts('envname', 'modname', 'logZ')
+    assert keys == state_keys
+    assert values.shape == (10, 3)
+    assert np.isnan(values[0, 1]) and (values[5, 2] == 5.0)
+
+def test_write_behind():
+    """Test buffered writes from the write-behind thread.
+    """
+    tmpfile = tempfile.NamedTemporaryFile()
+    storage = NetCDFStorage(tmpfile.name, mode='w', write_behind=True, sync_records=100)
+    view = NetCDFStorageView(storage, 'envname', 'modname')
+
+    values = np.zeros(3)
+    for iteration in range(250):
+        values[:] = iteration # the buffered arrays must not be affected by later changes
+        view.write_array('array', values, iteration=iteration)
+        view.write_quantity('varname', float(iteration), iteration=iteration)
+        view.write_key('state_key', 'CC', iteration=iteration)
+        storage.sync()
+    # reads see the buffered records
+    assert storage.get_object('envname', 'modname', 'state_key', iteration=249) == 'CC'
+    storage.close()
+
+    storage = NetCDFStorage(tmpfile.name, mode='r')
+    for iteration in range(250):
+        assert np.all(storage._ncfile['/envname/modname/array'][iteration] == iteration)
+        assert storage._ncfile['/envname/modname/varname'][iteration] == float(iteration)
+
+def _chain_topology(natoms):
+    """Create a linear chain topology of carbon atoms.
+    """
+    import mdtraj as md
+    topology = md.Topology()
+    residue = topology.add_residue('LIG', topology.add_chain())
+    atoms = [topology.add_atom('C%d' % index, md.element.carbon, residue) for index in range(natoms)]
+    for index in range(natoms - 1):
+        topology.add_bond(atoms[index], atoms[index + 1])
+    return topology
+
+def test_write_configuration():
+    """Test writing of configurations with the fixed schema.
+    """
+    tmpfile = tempfile.NamedTemporaryFile()
+    storage = NetCDFStorage(tmpfile.name, mode='w')
+    view = NetCDFStorageView(storage, 'envname', 'modname')
+
+    # Alternate between two chemical states; equal topologies are stored once
+    positions = dict()
+    for iteration in range(10):
+        topology = _chain_topology(5 if (iteration % 2 == 0) else 7)
+        positions[iteration] = unit.Quantity(np.random.random([topology.n_atoms, 3]), unit.angstroms)
+        view.write_configuration('positions', positions[iteration], topology, iteration=iteration)
+    storage.close()
+
+    storage = NetCDFStorage(tmpfile.name, mode='r')
+    assert storage._ncfile.dimensions['topologies'].size == 2
+    assert len(storage._ncfile['/envname/modname'].variables) == 0, "configurations should not add a variable per iteration"
+    for iteration in range(10):
+        (stored_positions, topology) = storage.get_configuration('envname', 'modname', 'positions', iteration=iteration)
+        assert topology.n_atoms == positions[iteration].shape[0]
+        assert np.allclose(stored_positions / unit.angstroms, positions[iteration] / unit.angstroms, atol=1e-6)
+
+def test_convert_storage():
+    """Test conversion of a legacy storage file to the fixed schema.
+    """
+    from perses.storage import convert_storage
+    legacy_file = tempfile.NamedTemporaryFile()
+    storage = NetCDFStorage(legacy_file.name, mode='w', schema='legacy')
+    view = NetCDFStorageView(storage, 'envname', 'modname')
+    topology = _chain_topology(5)
+    positions = dict()
+    for iteration in range(5):
+        positions[iteration] = unit.Quantity(np.random.random([topology.n_atoms, 3]), unit.angstroms)
+        view.write_configuration('positions', positions[iteration], topology, iteration=iteration)
+        view.write_quantity('varname', float(iteration), iteration=iteration)
+    storage.close()
+
+    converted_file = tempfile.NamedTemporaryFile()
+    convert_storage(legacy_file.name, converted_file.name)
+    storage = NetCDFStorage(converted_file.name, mode='r')
+    assert storage._schema == 'fixed'
+    for iteration in range(5):
+        (stored_positions, _) = storage.get_configuration('envname', 'modname', 'positions', iteration=iteration)
+        assert np.allclose(stored_positions / unit.angstroms, positions[iteration] / unit.angstroms, atol=1e-6)
+        assert storage._ncfile['/envname/modname/varname'][iteration] == float(iteration)
+
+def test_sharded_storage():
+    """Test writing shards from several writers, reading them through a view, and merging them.
+    """
+    from perses.storage import open_shard, ShardedStorageView, merge_shards
+    tmpdir = tempfile.mkdtemp()
+    manifest_filename = os.path.join(tmpdir, 'output.json')
+    for (shard_index, state_keys) in enumerate([['CC', 'CCC'], ['CCO', 'CC']]):
+        storage = open_shard(manifest_filename, shard_name='writer%d' % shard_index)
+        for envname in ['envname', 'writer%d' % shard_index]:
+            view = NetCDFStorageView(storage, envname, 'modname')
+            for iteration in range(4):
+                view.write_key('state_key', state_keys[iteration % 2], iteration=iteration)
+                view.write_state_dict('logZ', { state_keys[iteration % 2] : float(iteration) }, iteration=iteration)
+                view.write_configuration('positions', unit.Quantity(np.ones([5 + shard_index, 3]) * shard_index, unit.angstroms), _chain_topology(5 + shard_index), iteration=iteration)
+        storage.close()
+
+    merged_filename = os.path.join(tmpdir, 'merged.nc')
+    merge_shards(manifest_filename, merged_filename)
+    for storage in [ShardedStorageView(manifest_filename), NetCDFStorage(merged_filename, mode='r')]:
+        assert set(storage._ncfile.groups) == set(['envname@writer0', 'envname@writer1', 'writer0', 'writer1'])
+        assert list(storage.get_keys('writer1', 'modname', 'state_key')) == ['CCO', 'CC', 'CCO', 'CC']
+        assert storage.get_object('envname@writer1', 'modname', 'logZ', iteration=2) == { 'CCO' : 2.0 }
+        (positions, topology) = storage.get_configuration('envname@writer1', 'modname', 'positions', iteration=3)
+        assert (topology.n_atoms == 6) and np.allclose(positions / unit.angstroms, 1.0)
+        storage.close()
+
+def test_live_storage():
+    """Test incremental reads of live storage while it is written by another process.
+    """
+    import subprocess
+    from perses.analysis.tail import StorageTail
+    tmpfile = tempfile.NamedTemporaryFile()
+    writer_script = """
+import sys
+from perses.storage import NetCDFStorage, NetCDFStorageView
+storage = NetCDFStorage(sys.argv[1], mode='w', live=True)
+view = NetCDFStorageView(storage, 'envname', 'ExpandedEnsembleSampler')
+for iteration in range(10):
+    view.write_quantity('naccepted', iteration, iteration=iteration)
+    view.write_quantity('nrejected', iteration, iteration=iteration)
+    view.write_key('state_key', 'CC', iteration=iteration)
+    storage.sync()
+    sys.stdout.write('%d\\n' % iteration)
+    sys.stdout.flush()
+    sys.stdin.readline()
+storage.close()
+"""
+    writer = subprocess.Popen([sys.executable, '-c', writer_script, tmpfile.name], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              env=dict(os.environ, HDF5_USE_FILE_LOCKING='FALSE'), universal_newlines=True)
+    tail = StorageTail(tmpfile.name)
+    for iteration in range(10):
+        assert int(writer.stdout.readline()) == iteration
+        new_values = tail.refresh()
+        assert new_values['/envname/ExpandedEnsembleSampler/state_key'] == ['CC'], "only the new iteration should be loaded"
+        assert len(tail.get('envname', 'ExpandedEnsembleSampler', 'naccepted')) == iteration + 1
+        writer.stdin.write('\n')
+        writer.stdin.flush()
+    assert writer.wait() == 0
+    assert tail.acceptance_rate('envname') == 0.5
+
+def test_storage_tail_cadence():
+    """Test incremental reads of variables that are written at different cadences.
+    """
+    from perses.analysis.tail import StorageTail
+    tmpfile = tempfile.NamedTemporaryFile()
+    storage = NetCDFStorage(tmpfile.name, mode='w')
+    exen_view = NetCDFStorageView(storage, 'envname', 'ExpandedEnsembleSampler')
+    sams_view = NetCDFStorageView(storage, 'envname', 'SAMSSampler')
+    tail = StorageTail(tmpfile.name)
+    for iteration in range(6):
+        exen_view.write_quantity('naccepted', iteration, iteration=iteration)
+        exen_view.write_key('state_key', 'C' * (iteration + 1), iteration=iteration)
+        storage.sync()
+        # the SAMS records of this iteration are not written yet, so they must not be loaded
+        tail.refresh()
+        assert len(tail.get('envname', 'SAMSSampler', 'logZ')) <= iteration
+        if iteration % 2 == 0:
+            sams_view.write_state_dict('logZ', {'C' : float(iteration)}, iteration=iteration)
+            sams_view.write_quantity('gamma', float(iteration), iteration=iteration)
+        storage.sync()
+        tail.refresh()
+    storage.close()
+    assert tail.get('envname', 'ExpandedEnsembleSampler', 'state_key') == ['C' * (iteration + 1) for iteration in range(6)]
+    # iterations skipped between written ones are empty, and the unwritten last iteration is not loaded
+    assert tail.get('envname', 'SAMSSampler', 'logZ') == [{'C' : 0.0}, {}, {'C' : 2.0}, {}, {'C' : 4.0}]
+    assert np.allclose(tail.get('envname', 'SAMSSampler', 'gamma'), [0.0, np.nan, 2.0, np.nan, 4.0], equal_nan=True)
+    assert tail.logZ('envname') == {'C' : 4.0}
+
+def test_storage_policy():
+    """Test selective, decimated and fixed-precision configuration storage.
+    """
+    from perses.storage import StoragePolicy
+    import mdtraj as md
+    topology = _chain_topology(5)
+    for index in range(10):
+        residue = topology.add_residue('HOH', topology.add_chain())
+        for (name, element) in [('O', md.element.oxygen), ('H1', md.element.hydrogen), ('H2', md.element.hydrogen)]:
+            topology.add_atom(name, element, residue)
+
+    policy = StoragePolicy(atom_selection='not water', write_intervals={'configuration' : 3}, position_precision=0.001)
+    tmpfile = tempfile.NamedTemporaryFile()
+    storage = NetCDFStorage(tmpfile.name, mode='w')
+    view = NetCDFStorageView(storage, 'envname', 'modname')
+    view.write_storage_policy(policy)
+    positions = dict()
+    for iteration in range(10):
+        if policy.should_write('configuration', iteration):
+            atom_indices, subset_topology = policy.select_atoms(topology)
+            positions[iteration] = unit.Quantity(10.0 * np.random.random([topology.n_atoms, 3]), unit.angstroms)[atom_indices, :]
+            view.write_configuration('positions', positions[iteration], subset_topology, iteration=iteration, precision=policy.position_precision)
+    storage.close()
+
+    storage = NetCDFStorage(tmpfile.name, mode='r')
+    stored_policy = storage.get_storage_policy('envname', 'modname')
+    assert stored_policy.atom_selection == 'not water' and stored_policy.write_intervals['configuration'] == 3
+    assert sorted(positions.keys()) == [0, 3, 6, 9]
+    for iteration in positions.keys():
+        (stored_positions, stored_topology) = storage.get_configuration('envname', 'modname', 'positions', iteration=iteration)
+        assert stored_topology.n_atoms == 5
+        assert np.allclose(stored_positions / unit.angstroms, positions[iteration] / unit.angstroms, atol=0.001)
+    storage.close()
+
+    # Fixed-precision positions are compressed
+    import netCDF4
+    ncfile = netCDF4.Dataset(tmpfile.name, 'r')
+    filters = ncfile.groups['envname'].groups['modname'].groups['positions_configurations'].variables['positions_5'].filters()
+    assert filters['zlib'] and filters['shuffle']
+    ncfile.close()
+
 def run_sampler(sampler, niterations):
     sampler.run(niterations)
 